@@ -1,116 +1,1183 @@
+import io
 import os
-from flask import Flask, render_template, request, jsonify, send_file
-from PIL import Image
-from werkzeug.utils import secure_filename
+import math
+import click
+import random
+import time
+from flask import Flask, Request, Response, after_this_request, current_app, render_template, request, jsonify, send_file
+from PIL import Image, UnidentifiedImageError, features
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
 import uuid
+import hashlib
+import threading
 from datetime import datetime
+from collections import Counter
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
+
+from decoding import open_region
+from resampling import FILTERS, REDUCING_GAP, RESAMPLING_METHODS, resize, resize_into
+from jobs import JobQueue, QueueFull
+from result_cache import ResultCache, make_key
+from uploads import UploadStream, ImageTooLarge
+from budget import MemoryBusy, MemoryReservations, OverBudget, bitmap_bytes, estimate_decode, read_header
+from presets import DEFAULT_PRESETS, PresetError, build_presets, load_presets
+from metrics import BYTES_BUCKETS, Registry, megapixel_bucket, merge_timings, stage
+from profiling import ProfileRing, start_profile
+from retention import FolderIndex, Retention
+from storage import LocalStorage, MemoryStorage
+
+class UploadRequest(Request):
+    """Request that streams uploaded files into storage as they are parsed"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadStream(
+            get_storage('uploads').temp_path(uuid.uuid4().hex),
+            max_pixels=current_app.config['MAX_IMAGE_PIXELS']
+        )
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['PROCESSED_FOLDER'] = 'processed'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_IMAGE_PIXELS'] = 120_000_000  # reject larger images at upload and processing
+# Estimated decoded-bitmap memory all processing in one web process may use
+# at once, including its background jobs (0 disables). A single request over
+# it is refused; others wait up to PROCESSING_MEMORY_WAIT seconds for room.
+app.config['PROCESSING_MEMORY_BUDGET'] = 2 * 1024 * 1024 * 1024
+app.config['PROCESSING_MEMORY_WAIT'] = 10
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'webp', 'bmp'}
 
+# Storage backend: 'local' (files under UPLOAD_FOLDER / PROCESSED_FOLDER) or
+# 'memory' (LRU-bounded, lost on restart; for ephemeral deployments and tests)
+app.config['STORAGE_BACKEND'] = 'local'
+app.config['MEMORY_STORAGE_MAX_BYTES'] = 256 * 1024 * 1024  # per area
+
+# Local files are stored in hash-prefix subdirectories (ab/cd/<name>); 0
+# keeps them flat. Existing flat folders are migrated on startup.
+app.config['STORAGE_SHARD_DEPTH'] = 2
+
+# Background processing: requests opt in with "async": true, or set
+# ASYNC_PROCESSING to make it the default
+app.config['ASYNC_PROCESSING'] = False
+app.config['JOB_WORKERS'] = os.cpu_count() or 2
+app.config['JOB_QUEUE_SIZE'] = 32  # queued + running jobs before 429
+app.config['JOB_EXECUTOR'] = 'process'  # 'process' or 'thread'
+# Job status files shared by all web processes, so /jobs/<id> works
+# whichever worker a poll reaches (None keeps status per process)
+app.config['JOB_STATE_FOLDER'] = 'jobs'
+
+# Default resampling method: 'single' (one Lanczos pass) or 'progressive'
+# (box pre-shrink for big reductions, staged Lanczos for big enlargements).
+# Requests can choose with "resampling".
+app.config['RESAMPLING'] = 'single'
+
+# Default resampling filter (see resampling.FILTERS): 'lanczos' is the
+# sharpest; 'bicubic', 'hamming' and 'bilinear' are cheaper. Presets and
+# requests can choose with "filter".
+app.config['RESAMPLING_FILTER'] = 'lanczos'
+
+# Default encode profile (see ENCODE_PROFILES); requests can choose with
+# "encode_profile"
+app.config['ENCODE_PROFILE'] = 'balanced'
+
+# Default output format: 'jpeg', 'webp' or 'avif' (where Pillow supports
+# it). Requests can choose with "format"; inline requests also by Accept.
+app.config['OUTPUT_FORMAT'] = 'jpeg'
+
+# JSON file of output presets (see presets.py), e.g. to add 8K, 1440p or
+# portrait panels or give a preset its own encode profile, resampling method
+# and filter. None uses the built-in 4K and Full HD presets. Loaded and
+# validated once, at import when set here.
+app.config['PRESETS_FILE'] = None
+
+# Cropper previews: longest edge in pixels and format ('webp', or 'jpeg'
+# where Pillow cannot encode WebP). Previews are kept in the result cache.
+app.config['PREVIEW_MAX_EDGE'] = 2048
+app.config['PREVIEW_FORMAT'] = 'webp'
+
+# Decode and resize the two diptych panels on separate threads (only
+# worthwhile with more than one core)
+app.config['DIPTYCH_PARALLEL'] = (os.cpu_count() or 1) > 1
+
+# Most output specs accepted by one /process-batch request
+app.config['BATCH_MAX_SPECS'] = 16
+
+# Reuse processed outputs for repeated requests (0 disables)
+app.config['RESULT_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+
+# Retention: files not accessed within the TTL are deleted, then the least
+# recently used ones while a folder is over its size budget (0 disables)
+app.config['UPLOAD_RETENTION_SECONDS'] = 24 * 60 * 60
+app.config['UPLOAD_FOLDER_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
+app.config['PROCESSED_RETENTION_SECONDS'] = 24 * 60 * 60
+app.config['PROCESSED_FOLDER_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
+app.config['RETENTION_SWEEP_INTERVAL'] = 5 * 60
+app.config['RETENTION_SWEEPER'] = True  # background sweeper thread
+
+# Stored uploads and outputs never change under their (UUID-based) names,
+# so browsers may cache them this long without revalidating; 0 makes them
+# revalidate by ETag on every use
+app.config['FILE_CACHE_MAX_AGE'] = 365 * 24 * 60 * 60
+
+# Hand stored files on local disk to a front proxy instead of streaming
+# them through the worker: 'x-sendfile' (Apache mod_xsendfile, lighttpd;
+# the header carries the absolute path), 'x-accel-redirect' (nginx; the
+# header carries FILE_OFFLOAD_PREFIX/<area>/<path under the area folder>)
+# or 'auto' (use X-Accel-Redirect when the request has an X-Sendfile-Type:
+# X-Accel-Redirect header set by nginx, and stream it otherwise). Clients can
+# send that header too, so 'auto' never uses X-Sendfile, which would show
+# them absolute paths. None always streams; so do backends without local
+# files, such as memory storage
+app.config['FILE_OFFLOAD'] = None
+app.config['FILE_OFFLOAD_PREFIX'] = '/protected'
+
+# Add a Server-Timing header with per-stage durations to upload and
+# processing responses (shows up in browser dev tools)
+app.config['SERVER_TIMING'] = False
+
+# Profiling: a PROFILE_SAMPLE_RATE fraction of /process and /process-diptych
+# requests run under cProfile, and those slower than PROFILE_THRESHOLD_SECONDS
+# are saved to PROFILE_FOLDER (the newest PROFILE_MAX_FILES are kept). With
+# PROFILE_HEADER on, requests sent with "X-Profile: 1" are always captured.
+app.config['PROFILE_SAMPLE_RATE'] = 0.0
+app.config['PROFILE_HEADER'] = False
+app.config['PROFILE_THRESHOLD_SECONDS'] = 1.0
+app.config['PROFILE_FOLDER'] = 'profiles'
+app.config['PROFILE_MAX_FILES'] = 50
+
 # Ensure directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
 
-# Preset resolutions
-PRESETS = {
-    '4k': {'width': 3840, 'height': 2160, 'name': '4K Ultra HD'},
-    'fhd': {'width': 1920, 'height': 1080, 'name': 'Full HD'}
+# Output formats: file extension, MIME type, Pillow format and the Pillow
+# feature needed to encode it
+OUTPUT_FORMATS = {
+    'jpeg': {'extension': 'jpg', 'mimetype': 'image/jpeg', 'pillow_format': 'JPEG', 'feature': None},
+    'webp': {'extension': 'webp', 'mimetype': 'image/webp', 'pillow_format': 'WEBP', 'feature': 'webp'},
+    'avif': {'extension': 'avif', 'mimetype': 'image/avif', 'pillow_format': 'AVIF', 'feature': 'avif'},
+}
+
+# Encode settings per profile and output format, from quickest to encode to
+# highest fidelity. WebP 'method' (0-6, higher is slower) and AVIF 'speed'
+# (0-10, lower is slower) bound the CPU time of an encode.
+ENCODE_PROFILES = {
+    'fast': {
+        'jpeg': {'quality': 90, 'optimize': False, 'progressive': False, 'subsampling': '4:2:0'},
+        'webp': {'quality': 85, 'method': 0},
+        'avif': {'quality': 70, 'speed': 10},
+    },
+    'balanced': {
+        'jpeg': {'quality': 95, 'optimize': True, 'progressive': False, 'subsampling': '4:2:0'},
+        'webp': {'quality': 90, 'method': 4},
+        'avif': {'quality': 80, 'speed': 8},
+    },
+    'archival': {
+        'jpeg': {'quality': 98, 'optimize': True, 'progressive': True, 'subsampling': '4:4:4'},
+        'webp': {'quality': 95, 'method': 6},
+        'avif': {'quality': 90, 'speed': 8},
+    },
 }
 
+# Built-in preset resolutions, used unless PRESETS_FILE is set
+PRESETS = build_presets(DEFAULT_PRESETS, ENCODE_PROFILES)
+
+presets = None
+# PresetError from loading PRESETS_FILE, kept so the file is not re-read
+presets_error = None
+
+def get_presets():
+    """
+    Return the preset registry, loading and validating PRESETS_FILE on first use
+
+    A file that fails to load raises PresetError here and on every later
+    call until the registry is reset.
+    """
+    global presets, presets_error
+    if presets_error is not None:
+        raise presets_error
+    if presets is None:
+        path = app.config['PRESETS_FILE']
+        try:
+            presets = load_presets(path, ENCODE_PROFILES) if path else PRESETS
+        except PresetError as e:
+            presets_error = e
+            raise
+    return presets
+
+# A PRESETS_FILE set above is checked at import, so a bad file stops the
+# server from starting instead of failing requests
+if app.config['PRESETS_FILE']:
+    get_presets()
+
+def default_preset():
+    """Key of the preset used when a request names none (the first one)"""
+    return next(iter(get_presets()))
+
+@app.cli.command('check-presets')
+@click.argument('path', required=False)
+def check_presets(path):
+    """Validate a presets file (default: PRESETS_FILE) and list its presets"""
+    try:
+        registry = load_presets(path, ENCODE_PROFILES) if path else get_presets()
+    except PresetError as e:
+        raise click.ClickException(str(e))
+    for key, preset in registry.items():
+        print(f"{key}: {preset['name']}, {preset['width']}x{preset['height']} "
+              f"(aspect {preset['aspect']:.3f}), suffix {preset['suffix']!r}, "
+              f"encode profile {preset['encode_profile'] or 'default'}, "
+              f"resampling {preset['resampling'] or 'default'}, "
+              f"filter {preset['filter'] or 'default'}")
+
+@lru_cache(maxsize=None)
+def output_formats():
+    """Output formats the installed Pillow can encode"""
+    return tuple(name for name, spec in OUTPUT_FORMATS.items()
+                 if spec['feature'] is None or features.check(spec['feature']))
+
+def encode_settings(profile, output_format):
+    """Pillow save() options for an encode profile and output format"""
+    return {'format': OUTPUT_FORMATS[output_format]['pillow_format'], **ENCODE_PROFILES[profile][output_format]}
+
+def mimetype_for(filename):
+    """MIME type of an output file from its extension, or None if unknown"""
+    extension = os.path.splitext(filename)[1][1:].lower()
+    for spec in OUTPUT_FORMATS.values():
+        if spec['extension'] == extension:
+            return spec['mimetype']
+    return None
+
+# Folder config key for each storage area
+STORAGE_FOLDERS = {'uploads': 'UPLOAD_FOLDER', 'processed': 'PROCESSED_FOLDER'}
+
+storages = {}
+
+def get_storage(area):
+    """Return the storage for 'uploads' or 'processed', creating it on first use"""
+    storage = storages.get(area)
+    if storage is None:
+        backend = app.config['STORAGE_BACKEND']
+        if backend == 'memory':
+            storage = MemoryStorage(
+                app.config['MEMORY_STORAGE_MAX_BYTES'],
+                on_evict=lambda name: storage_evicted(area, name)
+            )
+        elif backend == 'local':
+            storage = LocalStorage(
+                app.config[STORAGE_FOLDERS[area]],
+                shard_depth=app.config['STORAGE_SHARD_DEPTH']
+            )
+        else:
+            raise ValueError(f'Unknown STORAGE_BACKEND: {backend!r}')
+        storage.migrate()
+        storages[area] = storage
+    return storage
+
+def storage_evicted(area, filename):
+    """Drop a file the storage backend evicted for space from the indexes tracking it"""
+    get_retention().indexes[area].forget(filename)
+    if area == 'uploads':
+        forget_upload(filename)
+    else:
+        get_result_cache().discard(filename)
+
+def send_stored(storage, filename, **kwargs):
+    """send_file() for a stored file, from disk or straight from the backend"""
+    path = storage.local_path(filename)
+    if path:
+        return send_file(path, **kwargs)
+    kwargs.setdefault('download_name', filename)
+    return send_file(storage.open(filename), **kwargs)
+
+# FILE_OFFLOAD mode -> response header naming the file for the proxy
+OFFLOAD_HEADERS = {'x-sendfile': 'X-Sendfile', 'x-accel-redirect': 'X-Accel-Redirect'}
+
+def offload_mode():
+    """FILE_OFFLOAD mode for the current request, or None to stream the file"""
+    mode = app.config['FILE_OFFLOAD']
+    if mode == 'auto':
+        # The request header may come from the client rather than the proxy
+        requested = request.headers.get('X-Sendfile-Type', '').lower()
+        mode = requested if requested == 'x-accel-redirect' else None
+    return mode if mode in OFFLOAD_HEADERS else None
+
+def send_offloaded(area, storage, path, mode, **kwargs):
+    """
+    Response that leaves sending a file on disk to the front proxy
+
+    The body is empty; the proxy swaps in the file named by the X-Sendfile
+    or X-Accel-Redirect header and keeps the other headers. If-None-Match
+    is answered here, Range requests are left to the proxy.
+    """
+    path = os.path.abspath(path)
+    response = werkzeug_send_file(path, request.environ, use_x_sendfile=True, conditional=False,
+                                  response_class=app.response_class, **kwargs)
+    response.make_conditional(request.environ)
+    del response.headers['X-Sendfile']
+    if response.status_code != 200:
+        # Nothing for the proxy to send with a 304 or 412
+        return response
+    if mode == 'x-accel-redirect':
+        relative = os.path.relpath(path, os.path.abspath(storage.root)).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = f"{app.config['FILE_OFFLOAD_PREFIX'].rstrip('/')}/{area}/{relative}"
+    else:
+        response.headers['X-Sendfile'] = path
+    return response
+
+def send_immutable(area, filename, **kwargs):
+    """
+    Serve a stored file that never changes under its name
+
+    The response has a strong content-hash ETag and, unless
+    FILE_CACHE_MAX_AGE is 0, a long-lived immutable Cache-Control.
+    send_file answers a matching If-None-Match with 304 and Range requests
+    (honouring If-Range) with 206 partial content. With FILE_OFFLOAD the
+    bytes are sent by the front proxy instead (see send_offloaded).
+    """
+    storage = get_storage(area)
+    max_age = app.config['FILE_CACHE_MAX_AGE']
+    etag = source_digest(storage, filename)
+    mode = offload_mode()
+    path = storage.local_path(filename) if mode else None
+    if path:
+        response = send_offloaded(area, storage, path, mode, etag=etag, max_age=max_age, **kwargs)
+    else:
+        response = send_stored(storage, filename, etag=etag, max_age=max_age, **kwargs)
+    if max_age:
+        response.cache_control.immutable = True
+    # werkzeug only advertises ranges on 206 responses; download managers
+    # look for it on the full response before offering to resume
+    response.headers.setdefault('Accept-Ranges', 'bytes')
+    return response
+
+def stored_input(storage, filename):
+    """Return a stored upload as processing input: a path, or a file object"""
+    return storage.local_path(filename) or storage.open(filename)
+
+@app.cli.command('migrate-storage')
+def migrate_storage():
+    """Move files from flat upload/output folders into shard directories"""
+    for area in STORAGE_FOLDERS:
+        storage = LocalStorage(
+            app.config[STORAGE_FOLDERS[area]],
+            shard_depth=app.config['STORAGE_SHARD_DEPTH']
+        )
+        print(f"{area}: moved {storage.migrate()} files")
+
+job_queue = None
+
+def get_job_queue():
+    """Return the job queue, creating it from app config on first use"""
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(
+            max_workers=app.config['JOB_WORKERS'],
+            max_pending=app.config['JOB_QUEUE_SIZE'],
+            executor=app.config['JOB_EXECUTOR'],
+            state_folder=app.config['JOB_STATE_FOLDER']
+        )
+    return job_queue
+
+memory_reservations = None
+
+def get_memory_reservations():
+    """Return this process's processing memory reservations, created from app config on first use"""
+    global memory_reservations
+    if memory_reservations is None:
+        memory_reservations = MemoryReservations(app.config['PROCESSING_MEMORY_BUDGET'])
+    return memory_reservations
+
+def reserve_memory(needed):
+    """Hold an estimated number of bytes of the memory budget while processing"""
+    return get_memory_reservations().reserve(needed or 0, app.config['PROCESSING_MEMORY_WAIT'])
+
+@app.errorhandler(PresetError)
+def presets_unavailable(e):
+    """Report a presets file that failed to load (set after startup)"""
+    return jsonify({'error': f'Presets unavailable: {e}'}), 500
+
+@app.errorhandler(MemoryBusy)
+def memory_busy(e):
+    """Ask the client to retry when other processing holds the memory budget"""
+    response = jsonify({'error': 'Server busy, try again shortly'})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+result_cache = None
+
+def get_result_cache():
+    """Return the processed-output cache, creating it from app config on first use"""
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache(
+            get_storage('processed'),
+            app.config['RESULT_CACHE_MAX_BYTES'],
+            on_evict=lambda name: get_retention().indexes['processed'].forget(name)
+        )
+    return result_cache
+
+retention = None
+
+def get_retention():
+    """Return the retention manager, creating it from app config on first use"""
+    global retention
+    if retention is None:
+        retention = Retention(app.config['RETENTION_SWEEP_INTERVAL'])
+        retention.add('uploads', FolderIndex(
+            get_storage('uploads'),
+            app.config['UPLOAD_RETENTION_SECONDS'],
+            app.config['UPLOAD_FOLDER_MAX_BYTES'],
+            on_delete=forget_upload
+        ))
+        retention.add('processed', FolderIndex(
+            get_storage('processed'),
+            app.config['PROCESSED_RETENTION_SECONDS'],
+            app.config['PROCESSED_FOLDER_MAX_BYTES'],
+            on_delete=lambda name: get_result_cache().discard(name)
+        ))
+    return retention
+
+# Histograms exposed on /metrics. Stage timings come from the processing
+# functions (see metrics.stage); input_megapixels is a coarse bucket to keep
+# the number of series small.
+PROCESSING_LABELS = ('endpoint', 'preset', 'letterbox', 'input_format', 'input_megapixels',
+                     'encode_profile', 'output_format')
+metrics = Registry()
+stage_seconds = metrics.histogram(
+    'image_stage_seconds', 'Time spent in each processing stage', PROCESSING_LABELS + ('stage',))
+processing_seconds = metrics.histogram(
+    'image_processing_seconds', 'Total processing time of a request', PROCESSING_LABELS)
+decoded_bytes = metrics.histogram(
+    'image_decoded_bytes', 'Estimated decoded-bitmap memory of a request', PROCESSING_LABELS, BYTES_BUCKETS)
+upload_seconds = metrics.histogram(
+    'upload_stage_seconds', 'Time spent in each upload stage', ('input_format', 'input_megapixels', 'stage'))
+
+def metric_labels(endpoint, headers, preset, letterbox, encode_profile, output_format):
+    """Histogram labels of a processing request; headers are the inputs' (format, size, mode)"""
+    if headers:
+        formats = {header[0] for header in headers}
+        input_format = formats.pop().lower() if len(formats) == 1 else 'mixed'
+        input_megapixels = megapixel_bucket(sum(width * height for _, (width, height), _ in headers))
+    else:
+        input_format = input_megapixels = 'unknown'
+    return {
+        'endpoint': endpoint,
+        'preset': preset,
+        'letterbox': str(bool(letterbox)).lower(),
+        'input_format': input_format,
+        'input_megapixels': input_megapixels,
+        'encode_profile': encode_profile,
+        'output_format': output_format,
+    }
+
+def record_timings(labels, timings):
+    """Observe the stage timings of a finished request; 'total' is the whole run"""
+    for name, seconds in timings.items():
+        if name == 'total':
+            processing_seconds.observe(seconds, **labels)
+        else:
+            stage_seconds.observe(seconds, stage=name, **labels)
+
+def server_timing(response, timings):
+    """Add a Server-Timing header listing timings (if SERVER_TIMING is enabled)"""
+    if app.config['SERVER_TIMING'] and timings:
+        response.headers['Server-Timing'] = ', '.join(
+            f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items())
+    return response
+
+def record_upload(upload, response):
+    """Observe the stage timings of an upload and add them to its response"""
+    labels = {
+        'input_format': (upload.format or 'unknown').lower(),
+        'input_megapixels': megapixel_bucket(upload.width * upload.height),
+    }
+    for name, seconds in upload.timings.items():
+        upload_seconds.observe(seconds, stage=name, **labels)
+    return server_timing(response, upload.timings)
+
+def run_timed(func, *args, **kwargs):
+    """Call a processing function with a timings dict; returns (result, timings)"""
+    timings = {}
+    start = time.perf_counter()
+    returned = func(*args, timings=timings, **kwargs)
+    timings['total'] = time.perf_counter() - start
+    return returned, timings
+
+profile_ring = None
+
+def get_profile_ring():
+    """Return the profile capture directory, creating it from app config on first use"""
+    global profile_ring
+    if profile_ring is None:
+        profile_ring = ProfileRing(app.config['PROFILE_FOLDER'], app.config['PROFILE_MAX_FILES'])
+    return profile_ring
+
+def profile_metadata(endpoint, seconds, response):
+    """Request parameters and input image metadata saved alongside a profile"""
+    data = request.get_json(silent=True) or {}
+    uploads = get_storage('uploads')
+    images = {}
+    for key in ('filename', 'filename1', 'filename2'):
+        name = data.get(key)
+        if not isinstance(name, str) or not uploads.exists(name):
+            continue
+        try:
+            image_format, (width, height), mode = upload_header(uploads, name)
+        except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+            continue
+        images[key] = {'format': image_format, 'width': width, 'height': height, 'mode': mode,
+                       'bytes': uploads.size(name)}
+
+    return {
+        'endpoint': endpoint,
+        'timestamp': datetime.now().isoformat(),
+        'seconds': round(seconds, 4),
+        'status': response.status_code,
+        'request': data,
+        'query': request.args.to_dict(),
+        'images': images,
+    }
+
+def profiled(endpoint):
+    """
+    Run a route under cProfile when it is sampled or asked to be (see PROFILE_*)
+
+    Sampled requests are saved when slower than PROFILE_THRESHOLD_SECONDS,
+    requested ones always; the response names the capture in X-Profile-Id.
+    Only the web process is profiled, so async jobs show just the enqueue.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            requested = app.config['PROFILE_HEADER'] and \
+                request.headers.get('X-Profile', '').lower() in ('1', 'true')
+            sampled = random.random() < app.config['PROFILE_SAMPLE_RATE']
+            profile = start_profile() if requested or sampled else None
+            if profile is None:
+                return view(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            finally:
+                profile.disable()
+            seconds = time.perf_counter() - start
+
+            if requested or seconds >= app.config['PROFILE_THRESHOLD_SECONDS']:
+                capture_id = get_profile_ring().save(
+                    profile, profile_metadata(endpoint, seconds, response), label=endpoint)
+                response.headers['X-Profile-Id'] = capture_id
+            return response
+        return wrapper
+    return decorator
+
+def store_result(filename, output, cache_key=None):
+    """
+    Store, index and cache a processed output
+
+    output is what the processing function returned: a BytesIO holding the
+    image when the processed storage has no local path to write to.
+    """
+    if isinstance(output, io.BytesIO):
+        get_storage('processed').put_bytes(filename, output.getvalue())
+    record_file('processed', filename)
+    if cache_key:
+        get_result_cache().put(cache_key, filename)
+
+def record_file(folder, filename):
+    """Add a newly written file to its folder's retention index"""
+    index = get_retention().indexes[folder]
+    index.record(filename)
+    if index.over_budget():
+        index.sweep()
+
+def touch_file(folder, filename):
+    """Mark a file as accessed so retention keeps it"""
+    get_retention().indexes[folder].touch(filename)
+
+def pin_while_sending(folder, filename, response):
+    """Protect a file from retention until its response has been sent"""
+    index = get_retention().indexes[folder]
+    index.touch(filename)
+    index.pin(filename)
+    response.call_on_close(lambda: index.unpin(filename))
+    return response
+
+@app.before_request
+def enforce_retention():
+    """Sweep opportunistically and make sure the background sweeper runs"""
+    manager = get_retention()
+    if app.config['RETENTION_SWEEPER']:
+        manager.start()
+    manager.maybe_sweep()
+
+# Content hash -> (filename, width, height) of stored uploads, for dedup
+upload_index = {}
+# Uploaded filename -> content hash, computed while the upload was saved
+upload_digests = {}
+upload_index_lock = threading.Lock()
+
+@lru_cache(maxsize=4096)
+def _file_digest(path, mtime_ns, size):
+    """SHA-256 of a file's content, memoized per (path, mtime, size)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def source_digest(storage, filename):
+    """Return the content hash of a stored upload or output"""
+    digest = upload_digests.get(filename)
+    if digest:
+        return digest
+    path = storage.local_path(filename)
+    if path is None:
+        with storage.open(filename) as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+    stat = os.stat(path)
+    return _file_digest(path, stat.st_mtime_ns, stat.st_size)
+
+def result_cache_key(**params):
+    """
+    Build a result cache key, or return None if caching does not apply
+
+    Crop dicts are normalized to integer boxes so equivalent requests share
+    an entry; malformed crops are left for the processing step to reject.
+    """
+    if not get_result_cache().enabled:
+        return None
+    try:
+        for name in ('crop', 'crop1', 'crop2'):
+            if name in params:
+                params[name] = crop_box(params[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return make_key(**params)
+
+def find_upload(digest):
+    """Return (filename, width, height) of a stored upload with this content hash"""
+    with upload_index_lock:
+        entry = upload_index.get(digest)
+        if entry and not get_storage('uploads').exists(entry[0]):
+            # The stored copy is gone; forget it
+            del upload_index[digest]
+            upload_digests.pop(entry[0], None)
+            entry = None
+        return entry
+
+def forget_upload(filename):
+    """Drop a deleted upload from the dedup index"""
+    with upload_index_lock:
+        digest = upload_digests.pop(filename, None)
+        if digest and upload_index.get(digest, (None,))[0] == filename:
+            del upload_index[digest]
+
+def register_upload(digest, filename, width, height):
+    """Record a stored upload so identical content can reuse it"""
+    with upload_index_lock:
+        upload_index[digest] = (filename, width, height)
+        upload_digests[filename] = digest
+
+def negotiate_output_format(data, inline=False):
+    """
+    Pick the output format of a processing request
+
+    An explicit "format" wins. Inline requests, whose response body is the
+    image, otherwise get the best supported type in their Accept header.
+    Everything else falls back to OUTPUT_FORMAT. Responses whose format
+    came from Accept are marked Vary: Accept for shared caches.
+    """
+    if 'format' in data:
+        return data['format']
+
+    default = app.config['OUTPUT_FORMAT']
+    if inline:
+        @after_this_request
+        def vary_on_accept(response):
+            response.vary.add('Accept')
+            return response
+
+        offered = [default] + [name for name in output_formats() if name != default]
+        best = request.accept_mimetypes.best_match([OUTPUT_FORMATS[name]['mimetype'] for name in offered])
+        for name in offered:
+            if OUTPUT_FORMATS[name]['mimetype'] == best:
+                return name
+    return default
+
+def wants_inline(data):
+    """Check whether a processing request wants the image in the response body"""
+    if 'inline' in data:
+        return bool(data['inline'])
+    return request.args.get('inline', '').lower() in ('1', 'true')
+
+def upload_header(storage, filename):
+    """Read the header of a stored upload: (format, (width, height), mode)"""
+    path = storage.local_path(filename)
+    if path:
+        return read_header(path)
+    with storage.open(filename) as f:
+        return read_header(f)
+
+def check_budget(inputs, output_sizes):
+    """
+    Enforce the pixel and memory budgets before processing
+
+    Args:
+        inputs: (header, box, draft_scale) for each image decoded
+        output_sizes: Sizes of the output frames, canvases and resized
+                      copies held in memory
+
+    Returns:
+        Estimated decoded-bitmap bytes. Raises ImageTooLarge for images over
+        MAX_IMAGE_PIXELS and OverBudget beyond PROCESSING_MEMORY_BUDGET.
+    """
+    max_pixels = app.config['MAX_IMAGE_PIXELS']
+    for header, _, _ in inputs:
+        width, height = header[1]
+        if max_pixels and width * height > max_pixels:
+            raise ImageTooLarge(width, height, max_pixels)
+
+    needed = sum(estimate_decode(header, box, draft_scale) for header, box, draft_scale in inputs) \
+        + sum(bitmap_bytes(size) for size in output_sizes)
+    budget = app.config['PROCESSING_MEMORY_BUDGET']
+    if budget and needed > budget:
+        raise OverBudget(needed, budget)
+    return needed
+
+def draft_scale_for(header, box, output_size):
+    """JPEG draft scale load_crop() will use for an input (1 for other formats)"""
+    if header[0] != 'JPEG':
+        return 1
+    return plan_jpeg_draft((box[2] - box[0], box[3] - box[1]), output_size)
+
+def guard_single(uploads, filename, crop_coords, target_width, target_height, letterbox, resampling='single'):
+    """Check the budgets of a /process request"""
+    header = upload_header(uploads, filename)
+    box = crop_box(crop_coords)
+    size = fit_size(box, target_width, target_height, letterbox)
+    # Single-pass resizes go straight into the output frame in bands (see
+    # resize_into); other methods make a resized copy first
+    frame = (target_width, target_height) if letterbox else size
+    copies = [size] if resampling != 'single' else []
+    return [header], check_budget([(header, box, draft_scale_for(header, box, size))], [frame] + copies)
+
+def guard_preview(uploads, filename):
+    """Check the budgets of a /preview request"""
+    header = upload_header(uploads, filename)
+    size = preview_size(*header[1], app.config['PREVIEW_MAX_EDGE'])
+    box = (0, 0) + header[1]
+    return [header], check_budget([(header, box, draft_scale_for(header, box, size))], [size])
+
+def guard_diptych(uploads, filename1, filename2, crop1, crop2, target_width, target_height, resampling='single'):
+    """Check the budgets of a /process-diptych request"""
+    box1 = crop_box(crop1)
+    box2 = crop_box(crop2)
+    _, sw1, sw2 = diptych_layout(box1, target_width, target_height)
+    inputs = []
+    for filename, box, width in ((filename1, box1, sw1), (filename2, box2, sw2)):
+        header = upload_header(uploads, filename)
+        inputs.append((header, box, draft_scale_for(header, box, (width, target_height))))
+    # Both panels are resized into the canvas, via resized copies unless single-pass
+    copies = [(sw1, target_height), (sw2, target_height)] if resampling != 'single' else []
+    needed = check_budget(inputs, [(target_width, target_height)] + copies)
+    return [header for header, _, _ in inputs], needed
+
+def guard_batch(uploads, filename, specs):
+    """Check the budgets of a /process-batch request"""
+    header = upload_header(uploads, filename)
+    _, sizes, union, draft_scale = plan_batch(specs)
+    canvases = [(spec['width'], spec['height']) for spec in specs if spec.get('letterbox', False)]
+    return [header], check_budget([(header, union, draft_scale if header[0] == 'JPEG' else 1)], sizes + canvases)
+
+def run_guard(guard, *args):
+    """
+    Run a budget guard
+
+    Returns (headers, needed, refused): the input headers and estimated
+    decoded-bitmap bytes, and the error response if the request is refused.
+    headers and needed are None when the crops are malformed; those are
+    reported by the processing step.
+    """
+    try:
+        headers, needed = guard(*args)
+    except (ImageTooLarge, OverBudget, Image.DecompressionBombError) as e:
+        return None, None, (jsonify({'error': str(e)}), 422)
+    except (UnidentifiedImageError, OSError):
+        # OSError: Pillow recognised the format but cannot read the header
+        return None, None, (jsonify({'error': 'Invalid image file'}), 400)
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return None, None, None
+    return headers, needed, None
+
+def wants_async(data):
+    """Check whether a processing request should run as a background job"""
+    if 'async' in data:
+        return bool(data['async'])
+    return request.args.get('async', str(app.config['ASYNC_PROCESSING'])).lower() in ('1', 'true')
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def crop_and_upscale(input_path, output_path, crop_coords, target_width, target_height, letterbox=False):
+# JPEG DCT scaling factors supported by libjpeg, largest first
+JPEG_DRAFT_SCALES = (8, 4, 2)
+
+def plan_jpeg_draft(crop_size, output_size):
+    """
+    Pick the largest JPEG DCT scale that keeps the crop at or above output size
+
+    Returns 1 when the crop cannot be reduced without dropping below the
+    target resolution.
+    """
+    crop_w, crop_h = crop_size
+    out_w, out_h = output_size
+    for scale in JPEG_DRAFT_SCALES:
+        if crop_w / scale >= out_w and crop_h / scale >= out_h:
+            return scale
+    return 1
+
+def crop_box(crop_coords):
+    """Convert crop coordinates dict to an integer (left, top, right, bottom) box"""
+    left = int(crop_coords['x'])
+    top = int(crop_coords['y'])
+    right = int(crop_coords['x'] + crop_coords['width'])
+    bottom = int(crop_coords['y'] + crop_coords['height'])
+    return left, top, right, bottom
+
+def load_crop(img, box, output_size, draft_scale=None, timings=None):
+    """
+    Crop an opened image, decoding as little of it as possible
+
+    Only the rows or tiles covering the box are decoded where the format
+    allows it (see decoding.open_region), and large JPEG crops are decoded
+    at a reduced DCT scale.
+
+    Args:
+        img: Lazily opened PIL image (nothing decoded yet)
+        box: (left, top, right, bottom) crop box in source pixels
+        output_size: (width, height) the crop will be resized to
+        draft_scale: JPEG DCT scale to use instead of planning one from
+                     output_size
+        timings: Optional dict the decode and crop times are added to
+
+    Returns:
+        (region, resample_box) - the cropped region and the sub-box of it to
+        pass to resize(). The box is fractional when the JPEG was decoded at
+        a reduced DCT scale and the crop edges fall between scaled pixels.
+        Palette crops are converted to RGB (RGBA with transparency), since
+        Pillow resizes P images with NEAREST and JPEG can't store them.
+    """
+    with stage(timings, 'decode'):
+        img, (dx, dy) = open_region(img, box)
+        box = (box[0] - dx, box[1] - dy, box[2] - dx, box[3] - dy)
+
+        scale = 1
+        if img.format == 'JPEG':
+            if draft_scale is None:
+                draft_scale = plan_jpeg_draft((box[2] - box[0], box[3] - box[1]), output_size)
+            scale = draft_scale
+            if scale > 1:
+                original_width = img.width
+                result = img.draft(img.mode, (img.width // scale, img.height // scale))
+                # draft() reports the source extent in reduced coordinates
+                scale = original_width / result[1][2] if result else 1
+        img.load()
+
+    left, top, right, bottom = (c / scale for c in box)
+    outer = (math.floor(left), math.floor(top), math.ceil(right), math.ceil(bottom))
+    with stage(timings, 'crop'):
+        region = img.crop(outer)
+        if region.mode in ('P', 'PA'):
+            has_alpha = region.mode == 'PA' or 'transparency' in region.info
+            region = region.convert('RGBA' if has_alpha else 'RGB')
+
+    return region, (left - outer[0], top - outer[1], right - outer[0], bottom - outer[1])
+
+def fit_size(box, target_width, target_height, letterbox=False):
+    """Return the size a crop box is resized to for a target resolution"""
+    crop_w = box[2] - box[0]
+    crop_h = box[3] - box[1]
+
+    if letterbox:
+        # Scale to fit within target while maintaining aspect ratio
+        scale = min(target_width / crop_w, target_height / crop_h)
+        return int(crop_w * scale), int(crop_h * scale)
+    return target_width, target_height
+
+def center_on_canvas(image, target_width, target_height):
+    """Center an image on a black canvas of the target size (letterboxing)"""
+    canvas = Image.new('RGB', (target_width, target_height), (0, 0, 0))
+    paste_x = (target_width - image.width) // 2
+    paste_y = (target_height - image.height) // 2
+    canvas.paste(image, (paste_x, paste_y))
+    return canvas
+
+def save_output(image, output_path, encode_options=None, timings=None):
+    """
+    Save a processed image to output_path, or encode it into a BytesIO if that is None
+
+    encode_options are Pillow save() options including the format, as
+    returned by encode_settings() (default: balanced JPEG). The encode time
+    is added to the optional timings dict.
+    """
+    if encode_options is None:
+        encode_options = encode_settings('balanced', 'jpeg')
+    with stage(timings, 'encode'):
+        if output_path is None:
+            buffer = io.BytesIO()
+            image.save(buffer, **encode_options)
+            buffer.seek(0)
+            return buffer
+        image.save(output_path, **encode_options)
+        return output_path
+
+def preview_size(width, height, max_edge):
+    """Size of the preview of a width x height image: longest edge at most max_edge"""
+    factor = min(1.0, max_edge / max(width, height))
+    return max(1, round(width * factor)), max(1, round(height * factor))
+
+def preview_details(filename, width, height):
+    """Preview URL and size for an upload, plus the full-resolution pixels per preview pixel"""
+    preview_width, preview_height = preview_size(width, height, app.config['PREVIEW_MAX_EDGE'])
+    return {
+        # Previews are cached as immutable; the size keeps a changed
+        # PREVIEW_MAX_EDGE from reusing a preview the scale doesn't match
+        'preview_url': f'/preview/{filename}?size={preview_width}x{preview_height}',
+        'preview_width': preview_width,
+        'preview_height': preview_height,
+        'preview_scale': round(width / preview_width, 6),
+    }
+
+def render_preview(input_path, size, encode_options=None, timings=None):
+    """
+    Downscale an image to a cropper preview of size
+
+    JPEGs are decoded at a reduced DCT scale and the rest is shrunk with a
+    box filter before the final Lanczos pass, so large uploads stay cheap.
+    Returns the encoded preview in a BytesIO.
+    """
+    with Image.open(input_path) as img:
+        with stage(timings, 'decode'):
+            if img.format == 'JPEG':
+                img.draft(img.mode, size)
+            img.load()
+        with stage(timings, 'resize'):
+            source = img if img.mode == 'RGB' else img.convert('RGB')
+            preview = source.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+        return save_output(preview, None, encode_options, timings)
+
+def crop_and_upscale(input_path, output_path, crop_coords, target_width, target_height, letterbox=False,
+                     resampling='single', resample_filter='lanczos', encode_options=None, progress=None,
+                     timings=None):
     """
     Crop and upscale image to target resolution
 
     Args:
-        input_path: Path to input image
-        output_path: Path to save processed image
+        input_path: Path (or file object) of the input image
+        output_path: Path to save processed image; with None the encoded
+                     image is returned in a BytesIO (rewound to the start)
         crop_coords: Dict with x, y, width, height (in pixels)
         target_width: Target output width
         target_height: Target output height
         letterbox: If True, fit image within target maintaining aspect ratio
                    and fill remaining space with black bars
+        resampling: Resampling method (see resampling.py)
+        resample_filter: Resampling filter name (see resampling.FILTERS)
+        encode_options: Encoder options (see save_output)
+        progress: Optional callback receiving the completed fraction (0-1)
+        timings: Optional dict the decode, crop, resize, paste and encode
+                 times are added to (in seconds)
+
+    Single-pass resizes are written band by band straight into the output
+    frame (the black canvas when letterboxing). The decoded source is
+    released once cropped and the crop once resized, so at most the crop
+    and one output frame are held at a time.
     """
+    box = crop_box(crop_coords)
+    new_w, new_h = fit_size(box, target_width, target_height, letterbox)
+
     with Image.open(input_path) as img:
-        # Crop the image
-        left = int(crop_coords['x'])
-        top = int(crop_coords['y'])
-        right = int(crop_coords['x'] + crop_coords['width'])
-        bottom = int(crop_coords['y'] + crop_coords['height'])
-
-        cropped = img.crop((left, top, right, bottom))
-
-        if letterbox:
-            # Scale to fit within target while maintaining aspect ratio
-            crop_w, crop_h = cropped.size
-            scale = min(target_width / crop_w, target_height / crop_h)
-            new_w = int(crop_w * scale)
-            new_h = int(crop_h * scale)
-            resized = cropped.resize((new_w, new_h), Image.Resampling.LANCZOS)
-
-            # Center on a black canvas
-            canvas = Image.new('RGB', (target_width, target_height), (0, 0, 0))
-            paste_x = (target_width - new_w) // 2
-            paste_y = (target_height - new_h) // 2
-            canvas.paste(resized, (paste_x, paste_y))
-
-            canvas.save(output_path, quality=95, optimize=True)
-        else:
-            # Resize to target resolution using high-quality Lanczos resampling
-            resized = cropped.resize((target_width, target_height), Image.Resampling.LANCZOS)
+        # Crop the image (large JPEGs are decoded at reduced size)
+        cropped, resample_box = load_crop(img, box, (new_w, new_h), timings=timings)
+        # Only the crop is needed from here on
+        img.close()
+    if progress:
+        progress(0.3)
+
+    if letterbox:
+        with stage(timings, 'paste'):
+            frame = Image.new('RGB', (target_width, target_height), (0, 0, 0))
+        offset = ((target_width - new_w) // 2, (target_height - new_h) // 2)
+    else:
+        frame = Image.new(cropped.mode, (new_w, new_h))
+        offset = (0, 0)
+
+    # Resize to target resolution using high-quality Lanczos resampling
+    with stage(timings, 'resize'):
+        resize_into(frame, offset, cropped, (new_w, new_h), box=resample_box, method=resampling,
+                    resample_filter=resample_filter)
+    cropped.close()
+    if progress:
+        progress(0.7)
 
-            # Save with high quality
-            resized.save(output_path, quality=95, optimize=True)
+    return save_output(frame, output_path, encode_options, timings)
 
-    return output_path
+def diptych_layout(box1, target_width, target_height):
+    """Return (gap, width1, width2) of the diptych panels for image 1's crop box"""
+    gap = round(target_width * 0.01)
+
+    # Scale image 1 to target height, preserving aspect ratio
+    sw1 = round((box1[2] - box1[0]) * target_height / (box1[3] - box1[1]))
+    sw2 = target_width - gap - sw1
+    return gap, sw1, sw2
 
-def crop_and_combine_diptych(input_path1, input_path2, output_path, crop1, crop2, target_width, target_height):
+def crop_and_combine_diptych(input_path1, input_path2, output_path, crop1, crop2, target_width, target_height,
+                             parallel=True, resampling='single', resample_filter='lanczos', encode_options=None,
+                             progress=None, timings=None):
     """
     Crop two images and combine them side-by-side on a single canvas.
 
     The layout uses zero-waste math: image 1 is scaled to target height,
     image 2 fills the remaining width, with only a thin gap between them.
+    Both panel sizes follow from the crop boxes alone, so with parallel=True
+    the panels are decoded and resized at the same time on two threads.
+    Each panel is resized band by band straight into its place on the
+    canvas. Inputs, output, progress and timings are handled as in
+    crop_and_upscale(); panel stage times are summed over both panels.
     """
-    gap = round(target_width * 0.01)
+    box1 = crop_box(crop1)
+    box2 = crop_box(crop2)
+    gap, sw1, sw2 = diptych_layout(box1, target_width, target_height)
+    # Each panel records into its own dict, merged once both are done
+    panel_timings = [{}, {}]
 
-    with Image.open(input_path1) as img1:
-        left1 = int(crop1['x'])
-        top1 = int(crop1['y'])
-        right1 = int(crop1['x'] + crop1['width'])
-        bottom1 = int(crop1['y'] + crop1['height'])
-        cropped1 = img1.crop((left1, top1, right1, bottom1))
+    # Black canvas the panels are resized into (the gap stays black)
+    with stage(timings, 'paste'):
+        canvas = Image.new('RGB', (target_width, target_height), (0, 0, 0))
 
-        # Scale image 1 to target height, preserving aspect ratio
-        sw1 = round(cropped1.width * target_height / cropped1.height)
-        resized1 = cropped1.resize((sw1, target_height), Image.Resampling.LANCZOS)
+    def render_panel(input_path, box, width, left, panel_timings):
+        with Image.open(input_path) as img:
+            cropped, resample_box = load_crop(img, box, (width, target_height), timings=panel_timings)
+            img.close()
+        # The panels cover separate columns, so both threads can write to the canvas
+        with stage(panel_timings, 'resize'):
+            resize_into(canvas, (left, 0), cropped, (width, target_height), box=resample_box, method=resampling,
+                        resample_filter=resample_filter)
+        cropped.close()
 
-    sw2 = target_width - gap - sw1
+    panels = [(input_path1, box1, sw1, 0, panel_timings[0]), (input_path2, box2, sw2, sw1 + gap, panel_timings[1])]
 
-    with Image.open(input_path2) as img2:
-        left2 = int(crop2['x'])
-        top2 = int(crop2['y'])
-        right2 = int(crop2['x'] + crop2['width'])
-        bottom2 = int(crop2['y'] + crop2['height'])
-        cropped2 = img2.crop((left2, top2, right2, bottom2))
+    if parallel:
+        # Pillow releases the GIL while decoding and resampling
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(render_panel, *panel) for panel in panels]
+            for done, _ in enumerate(as_completed(futures), 1):
+                if progress:
+                    progress(0.4 * done)
+            for future in futures:
+                future.result()
+    else:
+        for done, panel in enumerate(panels, 1):
+            render_panel(*panel)
+            if progress:
+                progress(0.4 * done)
+    merge_timings(timings, panel_timings)
 
-        resized2 = cropped2.resize((sw2, target_height), Image.Resampling.LANCZOS)
+    return save_output(canvas, output_path, encode_options, timings)
 
-    # Create black canvas and paste both images
-    canvas = Image.new('RGB', (target_width, target_height), (0, 0, 0))
-    canvas.paste(resized1, (0, 0))
-    canvas.paste(resized2, (sw1 + gap, 0))
+def plan_batch(specs):
+    """
+    Work out the crop boxes, resize sizes, decoded union box and JPEG
+    draft scale of a batch (see crop_and_upscale_batch)
+    """
+    boxes = [crop_box(spec['crop']) for spec in specs]
+    sizes = [fit_size(box, spec['width'], spec['height'], spec.get('letterbox', False))
+             for box, spec in zip(boxes, specs)]
+    union = (min(box[0] for box in boxes), min(box[1] for box in boxes),
+             max(box[2] for box in boxes), max(box[3] for box in boxes))
+    draft_scale = min(plan_jpeg_draft((box[2] - box[0], box[3] - box[1]), size)
+                      for box, size in zip(boxes, sizes))
+    return boxes, sizes, union, draft_scale
+
+def crop_and_upscale_batch(input_path, output_paths, specs, resampling='single', resample_filter='lanczos',
+                           encode_options=None, progress=None, timings=None):
+    """
+    Produce several crops and resolutions of one image, decoding it once
 
-    canvas.save(output_path, quality=95, optimize=True)
+    The union of all crop boxes is decoded a single time, at the largest
+    JPEG DCT scale every spec allows. Specs sharing a crop box are resized
+    largest first, and a smaller output is derived from a larger one of the
+    same aspect ratio when that is less work than resampling the source
+    region again (e.g. FHD from the 4K pass). Encodes run in parallel.
 
-    return output_path
+    Args:
+        input_path: Path (or file object) of the input image
+        output_paths: One output per spec, as for crop_and_upscale()
+        specs: List of dicts with crop, width, height and letterbox, and
+               optionally resampling, filter and encode_options overriding
+               the arguments below for that spec
+        resampling: Resampling method (see resampling.py)
+        resample_filter: Resampling filter name (see resampling.FILTERS)
+        encode_options: Encoder options (see save_output)
+        progress: Optional callback receiving the completed fraction (0-1)
+        timings: Optional dict of stage times, as for crop_and_upscale();
+                 encode is the wall time of the parallel encodes
+
+    Returns:
+        List with one saved output per spec
+    """
+    boxes, sizes, union, draft_scale = plan_batch(specs)
+
+    images = [None] * len(specs)
+    with Image.open(input_path) as img:
+        region, union_box = load_crop(img, union, None, draft_scale=draft_scale, timings=timings)
+        # Only the crop is needed from here on
+        img.close()
+        scale = (union[2] - union[0]) / (union_box[2] - union_box[0])
+        if progress:
+            progress(0.3)
+
+        resized_by_box = {}
+        order = sorted(range(len(specs)), key=lambda i: sizes[i][0] * sizes[i][1], reverse=True)
+        for i in order:
+            box = boxes[i]
+            new_w, new_h = sizes[i]
+            resample_box = tuple((box[j] - union[j % 2]) / scale + union_box[j % 2] for j in range(4))
+            source_pixels = (resample_box[2] - resample_box[0]) * (resample_box[3] - resample_box[1])
+            method = specs[i].get('resampling', resampling)
+            spec_filter = specs[i].get('filter', resample_filter)
+
+            # Earlier (larger) outputs of this crop with the same aspect ratio
+            candidates = [
+                done for done in resized_by_box.get(box, [])
+                if done.width >= new_w and done.height >= new_h
+                and abs(done.width * new_h - done.height * new_w) <= 0.01 * done.width * new_h
+                and done.width * done.height < source_pixels
+            ]
+            with stage(timings, 'resize'):
+                if candidates:
+                    base = min(candidates, key=lambda done: done.width * done.height)
+                    resized = resize(base, (new_w, new_h), method=method, resample_filter=spec_filter)
+                else:
+                    resized = resize(region, (new_w, new_h), box=resample_box, method=method,
+                                     resample_filter=spec_filter)
+            resized_by_box.setdefault(box, []).append(resized)
+
+            if specs[i].get('letterbox', False):
+                with stage(timings, 'paste'):
+                    resized = center_on_canvas(resized, specs[i]['width'], specs[i]['height'])
+            images[i] = resized
+
+    if progress:
+        progress(0.7)
+
+    # Pillow releases the GIL while encoding, so encodes overlap on threads
+    with stage(timings, 'encode'), ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as pool:
+        options = [spec.get('encode_options', encode_options) for spec in specs]
+        return list(pool.map(save_output, images, output_paths, options))
 
 @app.route('/')
 def mode_selector():
@@ -120,7 +1187,7 @@ def mode_selector():
 @app.route('/app')
 def server_app():
     """Original Flask version with server processing"""
-    return render_template('index.html', presets=PRESETS)
+    return render_template('index.html', presets=get_presets())
 
 @app.route('/client')
 def client_app():
@@ -130,10 +1197,16 @@ def client_app():
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handle file upload"""
-    if 'file' not in request.files:
+    try:
+        # Parsing the form streams the file through UploadStream
+        files = request.files
+    except (ImageTooLarge, Image.DecompressionBombError) as e:
+        return jsonify({'error': str(e)}), 413
+
+    if 'file' not in files:
         return jsonify({'error': 'No file provided'}), 400
 
-    file = request.files['file']
+    file = files['file']
 
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
@@ -144,29 +1217,133 @@ def upload_file():
     # Generate unique filename
     filename = secure_filename(file.filename)
     unique_filename = f"{uuid.uuid4()}_{filename}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
 
-    file.save(filepath)
+    # The file is already on disk under a temporary name, hashed and with
+    # its header probed; make sure it is an image within the pixel limit
+    upload = file.stream
+    try:
+        upload.finish()
+    except (ImageTooLarge, Image.DecompressionBombError) as e:
+        return jsonify({'error': str(e)}), 413
+    except UnidentifiedImageError:
+        return jsonify({'error': 'Invalid image file'}), 400
+
+    # Reuse an earlier upload with identical content; the temporary file is
+    # removed when the request closes
+    existing = find_upload(upload.digest)
+    if existing:
+        unique_filename, width, height = existing
+        touch_file('uploads', unique_filename)
+        return record_upload(upload, jsonify({
+            'success': True,
+            'duplicate': True,
+            'filename': unique_filename,
+            'original_filename': filename,
+            'width': width,
+            'height': height,
+            'url': f'/uploads/{unique_filename}',
+            **preview_details(unique_filename, width, height)
+        }))
 
-    # Get image dimensions
-    with Image.open(filepath) as img:
-        width, height = img.size
+    upload.commit(get_storage('uploads'), unique_filename)
+    width, height = upload.width, upload.height
 
-    return jsonify({
+    register_upload(upload.digest, unique_filename, width, height)
+    record_file('uploads', unique_filename)
+
+    return record_upload(upload, jsonify({
         'success': True,
         'filename': unique_filename,
         'original_filename': filename,
         'width': width,
         'height': height,
-        'url': f'/uploads/{unique_filename}'
-    })
+        'url': f'/uploads/{unique_filename}',
+        **preview_details(unique_filename, width, height)
+    }))
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded files"""
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    storage = get_storage('uploads')
+
+    if not storage.exists(filename):
+        return jsonify({'error': 'File not found'}), 404
+
+    response = send_immutable('uploads', filename)
+    return pin_while_sending('uploads', filename, response)
+
+@app.route('/preview/<filename>')
+def preview_file(filename):
+    """Serve a downscaled preview of an upload for the cropper"""
+    uploads = get_storage('uploads')
+
+    if not uploads.exists(filename):
+        return jsonify({'error': 'File not found'}), 404
+
+    touch_file('uploads', filename)
+
+    output_format = app.config['PREVIEW_FORMAT']
+    if output_format not in output_formats():
+        output_format = 'jpeg'
+    mimetype = OUTPUT_FORMATS[output_format]['mimetype']
+
+    headers, needed, refused = run_guard(guard_preview, uploads, filename)
+    if refused:
+        return refused
+    if headers is None:
+        return jsonify({'error': 'Invalid image file'}), 400
+
+    width, height = headers[0][1]
+    size = preview_size(width, height, app.config['PREVIEW_MAX_EDGE'])
+
+    source = source_digest(uploads, filename)
+    # The same upload, size and format always give the same preview, so it
+    # is cached like the upload itself
+    etag = hashlib.sha256(f'{source}:{size[0]}x{size[1]}:{output_format}'.encode()).hexdigest()
+    max_age = app.config['FILE_CACHE_MAX_AGE']
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.cache_control.max_age = max_age
+        response.cache_control.public = True
+        response.cache_control.immutable = bool(max_age)
+        return response
+
+    cache_key = result_cache_key(
+        mode='preview',
+        source=source,
+        size=list(size),
+        output_format=output_format
+    )
+    preview_filename = get_result_cache().get(cache_key) if cache_key else None
+
+    if preview_filename:
+        response = send_stored(get_storage('processed'), preview_filename, mimetype=mimetype,
+                               etag=etag, max_age=max_age)
+        response = pin_while_sending('processed', preview_filename, response)
+    else:
+        labels = metric_labels('preview', headers, '', False, 'fast', output_format)
+        decoded_bytes.observe(needed, **labels)
+        with reserve_memory(needed):
+            try:
+                output, timings = run_timed(render_preview, stored_input(uploads, filename), size,
+                                            encode_settings('fast', output_format))
+            except Exception as e:
+                return jsonify({'error': f'Preview failed: {str(e)}'}), 500
+        record_timings(labels, timings)
+
+        if cache_key:
+            extension = OUTPUT_FORMATS[output_format]['extension']
+            store_result(f"preview_{uuid.uuid4()}.{extension}", output, cache_key)
+        response = server_timing(send_file(output, mimetype=mimetype, etag=etag, max_age=max_age), timings)
+
+    if max_age:
+        response.cache_control.immutable = True
+    response.headers['X-Preview-Scale'] = str(round(width / size[0], 6))
+    return response
 
 @app.route('/process', methods=['POST'])
+@profiled('process')
 def process_image():
     """Process image with crop and upscale"""
     data = request.json
@@ -176,50 +1353,144 @@ def process_image():
 
     filename = data['filename']
     original_filename = data.get('original_filename', 'image.jpg')
-    preset = data.get('preset', '4k')
+    preset = data.get('preset', default_preset())
     crop_coords = data.get('crop', {})
     letterbox = data.get('letterbox', False)
 
-    if preset not in PRESETS:
+    if preset not in get_presets():
         return jsonify({'error': 'Invalid preset'}), 400
 
-    input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    target_res = get_presets()[preset]
+    resampling = data.get('resampling', target_res['resampling'] or app.config['RESAMPLING'])
+    resample_filter = data.get('filter', target_res['filter'] or app.config['RESAMPLING_FILTER'])
+    encode_profile = data.get('encode_profile', target_res['encode_profile'] or app.config['ENCODE_PROFILE'])
+
+    if resampling not in RESAMPLING_METHODS:
+        return jsonify({'error': 'Invalid resampling method'}), 400
+
+    if resample_filter not in FILTERS:
+        return jsonify({'error': 'Invalid resampling filter'}), 400
+
+    if encode_profile not in ENCODE_PROFILES:
+        return jsonify({'error': 'Invalid encode profile'}), 400
+
+    inline = wants_inline(data)
+    output_format = negotiate_output_format(data, inline=inline)
+    if output_format not in output_formats():
+        return jsonify({'error': f"Unsupported output format; choose from {', '.join(output_formats())}"}), 400
 
-    if not os.path.exists(input_path):
+    uploads = get_storage('uploads')
+
+    if not uploads.exists(filename):
         return jsonify({'error': 'File not found'}), 404
 
+    input_path = stored_input(uploads, filename)
+
+    touch_file('uploads', filename)
+
     # Generate output filename based on original name and preset
     name_without_ext = os.path.splitext(original_filename)[0]
-    preset_suffix = '_4k' if preset == '4k' else '_fhd'
-    suggested_filename = f"{name_without_ext}{preset_suffix}.jpg"
+    extension = OUTPUT_FORMATS[output_format]['extension']
+    suggested_filename = f"{name_without_ext}{target_res['suffix']}.{extension}"
 
     # Use UUID for internal storage to avoid conflicts
-    output_filename = f"processed_{uuid.uuid4()}.jpg"
-    output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename)
+    output_filename = f"processed_{uuid.uuid4()}.{extension}"
+    output_path = get_storage('processed').local_path(output_filename, create=True)
 
-    try:
-        # Process the image
-        target_res = PRESETS[preset]
-        crop_and_upscale(
+    cache_key = result_cache_key(
+        mode='single',
+        source=source_digest(uploads, filename),
+        crop=crop_coords,
+        preset=preset,
+        letterbox=bool(letterbox),
+        resampling=resampling,
+        resample_filter=resample_filter,
+        encode_profile=encode_profile,
+        output_format=output_format
+    )
+    cached = cached_response(cache_key, suggested_filename, inline=inline)
+    if cached:
+        return cached
+
+    headers, needed, refused = run_guard(guard_single, uploads, filename, crop_coords,
+                                         target_res['width'], target_res['height'], letterbox, resampling)
+    if refused:
+        return refused
+
+    labels = metric_labels('process', headers, preset, letterbox, encode_profile, output_format)
+    if needed is not None:
+        decoded_bytes.observe(needed, **labels)
+
+    if inline:
+        # Encode into memory and stream it back; nothing is stored
+        with reserve_memory(needed):
+            try:
+                output, timings = run_timed(
+                    crop_and_upscale,
+                    input_path,
+                    None,
+                    crop_coords,
+                    target_res['width'],
+                    target_res['height'],
+                    letterbox=letterbox,
+                    resampling=resampling,
+                    resample_filter=resample_filter,
+                    encode_options=encode_settings(encode_profile, output_format)
+                )
+            except Exception as e:
+                return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+        record_timings(labels, timings)
+        return server_timing(send_inline(output, suggested_filename), timings)
+
+    result = {
+        'filename': output_filename,
+        'suggested_filename': suggested_filename,
+        'download_url': f'/download/{output_filename}'
+    }
+
+    if wants_async(data):
+        return enqueue_job(
+            crop_and_upscale,
             input_path,
             output_path,
             crop_coords,
             target_res['width'],
             target_res['height'],
-            letterbox=letterbox
+            letterbox=letterbox,
+            resampling=resampling,
+            resample_filter=resample_filter,
+            encode_options=encode_settings(encode_profile, output_format),
+            result=result,
+            outputs=[(output_filename, cache_key)],
+            labels=labels,
+            needed=needed
         )
 
-        return jsonify({
-            'success': True,
-            'filename': output_filename,
-            'suggested_filename': suggested_filename,
-            'download_url': f'/download/{output_filename}'
-        })
+    with reserve_memory(needed):
+        try:
+            # Process the image
+            output, timings = run_timed(
+                crop_and_upscale,
+                input_path,
+                output_path,
+                crop_coords,
+                target_res['width'],
+                target_res['height'],
+                letterbox=letterbox,
+                resampling=resampling,
+                resample_filter=resample_filter,
+                encode_options=encode_settings(encode_profile, output_format)
+            )
+            store_result(output_filename, output, cache_key)
+            record_timings(labels, timings)
+
+            return server_timing(jsonify({'success': True, **result}), timings)
 
-    except Exception as e:
-        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+        except Exception as e:
+            return jsonify({'error': f'Processing failed: {str(e)}'}), 500
 
 @app.route('/process-diptych', methods=['POST'])
+@profiled('diptych')
 def process_diptych():
     """Process two images into a side-by-side diptych"""
     data = request.json
@@ -231,59 +1502,407 @@ def process_diptych():
     filename2 = data['filename2']
     original_filename1 = data.get('original_filename1', 'image1.jpg')
     original_filename2 = data.get('original_filename2', 'image2.jpg')
-    preset = data.get('preset', '4k')
+    preset = data.get('preset', default_preset())
     crop1 = data.get('crop1', {})
     crop2 = data.get('crop2', {})
 
-    if preset not in PRESETS:
+    if preset not in get_presets():
         return jsonify({'error': 'Invalid preset'}), 400
 
-    input_path1 = os.path.join(app.config['UPLOAD_FOLDER'], filename1)
-    input_path2 = os.path.join(app.config['UPLOAD_FOLDER'], filename2)
+    target_res = get_presets()[preset]
+    resampling = data.get('resampling', target_res['resampling'] or app.config['RESAMPLING'])
+    resample_filter = data.get('filter', target_res['filter'] or app.config['RESAMPLING_FILTER'])
+    encode_profile = data.get('encode_profile', target_res['encode_profile'] or app.config['ENCODE_PROFILE'])
 
-    if not os.path.exists(input_path1):
+    if resampling not in RESAMPLING_METHODS:
+        return jsonify({'error': 'Invalid resampling method'}), 400
+
+    if resample_filter not in FILTERS:
+        return jsonify({'error': 'Invalid resampling filter'}), 400
+
+    if encode_profile not in ENCODE_PROFILES:
+        return jsonify({'error': 'Invalid encode profile'}), 400
+
+    inline = wants_inline(data)
+    output_format = negotiate_output_format(data, inline=inline)
+    if output_format not in output_formats():
+        return jsonify({'error': f"Unsupported output format; choose from {', '.join(output_formats())}"}), 400
+
+    uploads = get_storage('uploads')
+
+    if not uploads.exists(filename1):
         return jsonify({'error': 'File 1 not found'}), 404
 
-    if not os.path.exists(input_path2):
+    if not uploads.exists(filename2):
         return jsonify({'error': 'File 2 not found'}), 404
 
+    input_path1 = stored_input(uploads, filename1)
+    input_path2 = stored_input(uploads, filename2)
+
+    touch_file('uploads', filename1)
+    touch_file('uploads', filename2)
+
     # Generate output filename
     name1 = os.path.splitext(original_filename1)[0]
     name2 = os.path.splitext(original_filename2)[0]
-    preset_suffix = '_4k' if preset == '4k' else '_fhd'
-    suggested_filename = f"{name1}_{name2}_pair{preset_suffix}.jpg"
+    extension = OUTPUT_FORMATS[output_format]['extension']
+    suggested_filename = f"{name1}_{name2}_pair{target_res['suffix']}.{extension}"
 
-    output_filename = f"processed_{uuid.uuid4()}.jpg"
-    output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename)
+    output_filename = f"processed_{uuid.uuid4()}.{extension}"
+    output_path = get_storage('processed').local_path(output_filename, create=True)
 
-    try:
-        target_res = PRESETS[preset]
-        crop_and_combine_diptych(
+    cache_key = result_cache_key(
+        mode='diptych',
+        source1=source_digest(uploads, filename1),
+        source2=source_digest(uploads, filename2),
+        crop1=crop1,
+        crop2=crop2,
+        preset=preset,
+        resampling=resampling,
+        resample_filter=resample_filter,
+        encode_profile=encode_profile,
+        output_format=output_format
+    )
+    cached = cached_response(cache_key, suggested_filename, inline=inline)
+    if cached:
+        return cached
+
+    headers, needed, refused = run_guard(guard_diptych, uploads, filename1, filename2, crop1, crop2,
+                                         target_res['width'], target_res['height'], resampling)
+    if refused:
+        return refused
+
+    labels = metric_labels('diptych', headers, preset, False, encode_profile, output_format)
+    if needed is not None:
+        decoded_bytes.observe(needed, **labels)
+
+    if inline:
+        with reserve_memory(needed):
+            try:
+                output, timings = run_timed(
+                    crop_and_combine_diptych,
+                    input_path1,
+                    input_path2,
+                    None,
+                    crop1,
+                    crop2,
+                    target_res['width'],
+                    target_res['height'],
+                    parallel=app.config['DIPTYCH_PARALLEL'],
+                    resampling=resampling,
+                    resample_filter=resample_filter,
+                    encode_options=encode_settings(encode_profile, output_format)
+                )
+            except Exception as e:
+                return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+        record_timings(labels, timings)
+        return server_timing(send_inline(output, suggested_filename), timings)
+
+    result = {
+        'filename': output_filename,
+        'suggested_filename': suggested_filename,
+        'download_url': f'/download/{output_filename}'
+    }
+
+    if wants_async(data):
+        return enqueue_job(
+            crop_and_combine_diptych,
             input_path1,
             input_path2,
             output_path,
             crop1,
             crop2,
             target_res['width'],
-            target_res['height']
+            target_res['height'],
+            parallel=app.config['DIPTYCH_PARALLEL'],
+            resampling=resampling,
+            resample_filter=resample_filter,
+            encode_options=encode_settings(encode_profile, output_format),
+            result=result,
+            outputs=[(output_filename, cache_key)],
+            labels=labels,
+            needed=needed
         )
 
-        return jsonify({
-            'success': True,
+    with reserve_memory(needed):
+        try:
+            output, timings = run_timed(
+                crop_and_combine_diptych,
+                input_path1,
+                input_path2,
+                output_path,
+                crop1,
+                crop2,
+                target_res['width'],
+                target_res['height'],
+                parallel=app.config['DIPTYCH_PARALLEL'],
+                resampling=resampling,
+                resample_filter=resample_filter,
+                encode_options=encode_settings(encode_profile, output_format)
+            )
+            store_result(output_filename, output, cache_key)
+            record_timings(labels, timings)
+
+            return server_timing(jsonify({'success': True, **result}), timings)
+
+        except Exception as e:
+            return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+@app.route('/process-batch', methods=['POST'])
+def process_batch():
+    """Process several crops and presets of one upload in a single request"""
+    data = request.json
+
+    if not data or 'filename' not in data:
+        return jsonify({'error': 'No filename provided'}), 400
+
+    specs = data.get('specs')
+    if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+        return jsonify({'error': 'specs must be a non-empty list'}), 400
+
+    if len(specs) > app.config['BATCH_MAX_SPECS']:
+        return jsonify({'error': f"At most {app.config['BATCH_MAX_SPECS']} specs per batch"}), 400
+
+    if any(spec.get('preset', default_preset()) not in get_presets() for spec in specs):
+        return jsonify({'error': 'Invalid preset'}), 400
+
+    # None leaves the choice to each spec's preset
+    resampling = data.get('resampling')
+    if resampling is not None and resampling not in RESAMPLING_METHODS:
+        return jsonify({'error': 'Invalid resampling method'}), 400
+
+    resample_filter = data.get('filter')
+    if resample_filter is not None and resample_filter not in FILTERS:
+        return jsonify({'error': 'Invalid resampling filter'}), 400
+
+    encode_profile = data.get('encode_profile')
+    if encode_profile is not None and encode_profile not in ENCODE_PROFILES:
+        return jsonify({'error': 'Invalid encode profile'}), 400
+
+    output_format = negotiate_output_format(data)
+    if output_format not in output_formats():
+        return jsonify({'error': f"Unsupported output format; choose from {', '.join(output_formats())}"}), 400
+
+    filename = data['filename']
+    original_filename = data.get('original_filename', 'image.jpg')
+    uploads = get_storage('uploads')
+
+    if not uploads.exists(filename):
+        return jsonify({'error': 'File not found'}), 404
+
+    input_path = stored_input(uploads, filename)
+    source = source_digest(uploads, filename)
+
+    touch_file('uploads', filename)
+
+    name_without_ext = os.path.splitext(original_filename)[0]
+    extension = OUTPUT_FORMATS[output_format]['extension']
+    name_counts = Counter()
+    results = []
+    # Specs that still need processing, and where their outputs go
+    todo = []
+    output_paths = []
+    outputs = []
+
+    for spec in specs:
+        preset = spec.get('preset', default_preset())
+        crop_coords = spec.get('crop', {})
+        letterbox = spec.get('letterbox', False)
+        target_res = get_presets()[preset]
+        spec_resampling = resampling or target_res['resampling'] or app.config['RESAMPLING']
+        spec_filter = resample_filter or target_res['filter'] or app.config['RESAMPLING_FILTER']
+        spec_profile = encode_profile or target_res['encode_profile'] or app.config['ENCODE_PROFILE']
+
+        suggested_filename = f"{name_without_ext}{target_res['suffix']}"
+        name_counts[suggested_filename] += 1
+        if name_counts[suggested_filename] > 1:
+            suggested_filename += f"_{name_counts[suggested_filename]}"
+        suggested_filename += f'.{extension}'
+
+        # Shares entries with /process, so either endpoint reuses the other's outputs
+        cache_key = result_cache_key(
+            mode='single',
+            source=source,
+            crop=crop_coords,
+            preset=preset,
+            letterbox=bool(letterbox),
+            resampling=spec_resampling,
+            resample_filter=spec_filter,
+            encode_profile=spec_profile,
+            output_format=output_format
+        )
+        output_filename = get_result_cache().get(cache_key) if cache_key else None
+        cached = output_filename is not None
+
+        if cached:
+            touch_file('processed', output_filename)
+        else:
+            output_filename = f"processed_{uuid.uuid4()}.{extension}"
+            todo.append({
+                'crop': crop_coords,
+                'width': target_res['width'],
+                'height': target_res['height'],
+                'letterbox': letterbox,
+                'resampling': spec_resampling,
+                'filter': spec_filter,
+                'encode_profile': spec_profile,
+                'encode_options': encode_settings(spec_profile, output_format)
+            })
+            output_paths.append(get_storage('processed').local_path(output_filename, create=True))
+            outputs.append((output_filename, cache_key))
+
+        entry = {
+            'preset': preset,
             'filename': output_filename,
             'suggested_filename': suggested_filename,
             'download_url': f'/download/{output_filename}'
-        })
+        }
+        if cached:
+            entry['cached'] = True
+        results.append(entry)
+
+    if not todo:
+        return jsonify({'success': True, 'results': results})
+
+    headers, needed, refused = run_guard(guard_batch, uploads, filename, todo)
+    if refused:
+        return refused
+
+    # Presets, letterboxing and encode profiles vary per spec; label by the combination
+    preset_names = ','.join(sorted({spec.get('preset', default_preset()) for spec in specs}))
+    letterbox = any(spec['letterbox'] for spec in todo)
+    encode_profiles = ','.join(sorted({spec['encode_profile'] for spec in todo}))
+    labels = metric_labels('batch', headers, preset_names, letterbox, encode_profiles, output_format)
+    if needed is not None:
+        decoded_bytes.observe(needed, **labels)
+
+    if wants_async(data):
+        return enqueue_job(
+            crop_and_upscale_batch,
+            input_path,
+            output_paths,
+            todo,
+            result={'results': results},
+            outputs=outputs,
+            labels=labels,
+            needed=needed
+        )
+
+    with reserve_memory(needed):
+        try:
+            returned, timings = run_timed(crop_and_upscale_batch, input_path, output_paths, todo)
+            for (output_filename, cache_key), output in zip(outputs, returned):
+                store_result(output_filename, output, cache_key)
+            record_timings(labels, timings)
+
+            return server_timing(jsonify({'success': True, 'results': results}), timings)
+
+        except Exception as e:
+            return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+def cached_response(cache_key, suggested_filename, inline=False):
+    """Return the response for a result cache hit, or None on a miss"""
+    if not cache_key:
+        return None
+
+    output_filename = get_result_cache().get(cache_key)
+    if output_filename is None:
+        return None
+
+    if inline:
+        response = send_stored(get_storage('processed'), output_filename,
+                               as_attachment=True, download_name=suggested_filename)
+        return pin_while_sending('processed', output_filename, response)
+
+    touch_file('processed', output_filename)
+
+    return jsonify({
+        'success': True,
+        'cached': True,
+        'filename': output_filename,
+        'suggested_filename': suggested_filename,
+        'download_url': f'/download/{output_filename}'
+    })
+
+def send_inline(buffer, suggested_filename):
+    """Stream an output encoded in memory straight to the client"""
+    return send_file(buffer, mimetype=mimetype_for(suggested_filename), as_attachment=True,
+                     download_name=suggested_filename)
+
+def enqueue_job(func, *args, result=None, outputs=(), labels=None, needed=None, **kwargs):
+    """
+    Queue a processing function and return the 202 job response
+
+    outputs lists (filename, cache_key) for what the job produces; func
+    returns a single output, or a list of them for several. The job's stage
+    timings are recorded under the metric labels once it finishes. needed
+    bytes of the memory budget are held from now until the job finishes.
+    """
+    def on_success(returned, timings):
+        if not isinstance(returned, list):
+            returned = [returned]
+        for (filename, cache_key), output in zip(outputs, returned):
+            store_result(filename, output, cache_key)
+        if labels is not None:
+            record_timings(labels, timings)
+
+    # Don't keep the request waiting for room; the client retries instead
+    needed = needed or 0
+    reservations = get_memory_reservations()
+    reservations.acquire(needed, timeout=0)
+    try:
+        job_id = get_job_queue().submit(func, *args, result=result, on_success=on_success,
+                                        on_done=lambda: reservations.release(needed), timed=True, **kwargs)
+    except QueueFull:
+        reservations.release(needed)
+        response = jsonify({'error': 'Server busy, try again shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    except BrokenExecutor:
+        reservations.release(needed)
+        # The queue already replaced the broken pool once; give up on this job
+        response = jsonify({'error': 'Worker pool unavailable, try again shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/jobs/{job_id}'
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report status and progress of a background processing job"""
+    status = get_job_queue().status(job_id)
+
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(status)
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Report result cache hit/miss counters and usage"""
+    return jsonify(get_result_cache().stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose processing and upload histograms in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-    except Exception as e:
-        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+@app.route('/retention/stats')
+def retention_stats():
+    """Report per-folder retention usage"""
+    return jsonify({key: index.stats() for key, index in get_retention().indexes.items()})
 
 @app.route('/download/<filename>')
 def download_file(filename):
     """Download processed file"""
-    filepath = os.path.join(app.config['PROCESSED_FOLDER'], filename)
+    storage = get_storage('processed')
 
-    if not os.path.exists(filepath):
+    if not storage.exists(filename):
         return jsonify({'error': 'File not found'}), 404
 
     # Get custom download name from query parameter, or use default
@@ -292,14 +1911,16 @@ def download_file(filename):
     if custom_name:
         # Sanitize the custom filename
         custom_name = secure_filename(custom_name)
-        # Ensure it ends with .jpg
-        if not custom_name.lower().endswith('.jpg'):
-            custom_name = f"{custom_name}.jpg"
+        # Ensure it ends with the output's extension
+        extension = os.path.splitext(filename)[1]
+        if not custom_name.lower().endswith(extension.lower()):
+            custom_name = f"{custom_name}{extension}"
         download_name = custom_name
     else:
         download_name = f'frame_tv_{filename}'
 
-    return send_file(filepath, as_attachment=True, download_name=download_name)
+    response = send_immutable('processed', filename, as_attachment=True, download_name=download_name)
+    return pin_while_sending('processed', filename, response)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,220 @@
+"""
+Benchmark the processing pipeline end to end
+
+Synthetic images from 1 to 100 MP are written as JPEG, PNG, WebP and BMP
+and run through crop_and_upscale (4K and FHD, letterbox on and off) and
+crop_and_combine_diptych. The images in test_images/ are included as
+real-world cases. Each case reports p50/p95 latency, throughput (input
+megapixels per second) and peak RSS. Saved JSON runs can be compared
+to catch regressions between releases.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--repeat N] [--sizes 1,12,24,50,100]
+        [--formats jpeg,png,webp,bmp] [--json] [--output FILE]
+        [--compare BASELINE.json] [--tolerance 0.15]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import PIL
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import PRESETS, crop_and_combine_diptych, crop_and_upscale  # noqa: E402
+from benchutil import percentile, synthetic_image  # noqa: E402
+
+TEST_IMAGES = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'test_images'))
+
+# Synthetic image sizes in megapixels (3:2 frames)
+SIZES = (1, 12, 24, 50, 100)
+
+# Format name -> (Pillow format, file extension, save options). The options
+# favour quick writing; decode cost is what is measured.
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 90}),
+    'png': ('PNG', 'png', {'compress_level': 1}),
+    'webp': ('WEBP', 'webp', {'quality': 90, 'method': 0}),
+    'bmp': ('BMP', 'bmp', {}),
+}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+
+def frame_crop(size, aspect):
+    """Largest centered crop of an image size with the given width/height aspect"""
+    width, height = size
+    crop_w, crop_h = (round(height * aspect), height) if width / height > aspect else (width, round(width / aspect))
+    return {'x': (width - crop_w) // 2, 'y': (height - crop_h) // 2, 'width': crop_w, 'height': crop_h}
+
+
+def cases(path, size):
+    """(name, function, args, kwargs) for every pipeline case of one input"""
+    full = {'x': 0, 'y': 0, 'width': size[0], 'height': size[1]}
+    portrait = frame_crop(size, 9 / 16)
+    for preset in ('4k', 'fhd'):
+        width, height = PRESETS[preset]['width'], PRESETS[preset]['height']
+        yield (preset, crop_and_upscale,
+               (path, None, frame_crop(size, width / height), width, height), {'letterbox': False})
+        yield (f'{preset} letterbox', crop_and_upscale,
+               (path, None, full, width, height), {'letterbox': True})
+        yield (f'{preset} diptych', crop_and_combine_diptych,
+               (path, path, None, portrait, portrait, width, height), {})
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter for this process; False where unsupported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident set size in MB (since the last reset on Linux)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def measure(func, args, kwargs, repeat):
+    """Run a case repeat times; returns (latencies, peak RSS in MB)"""
+    gc.collect()
+    reset_peak_rss()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        latencies.append(time.perf_counter() - start)
+    return latencies, peak_rss_mb()
+
+
+def inputs(sizes, formats, workdir):
+    """Yield (source, image name, format, path, size) for synthetic and real-world inputs"""
+    for megapixels in sizes:
+        image = synthetic_image(megapixels)
+        for name in formats:
+            pillow_format, extension, options = FORMATS[name]
+            path = os.path.join(workdir, f'synthetic_{megapixels}mp.{extension}')
+            image.save(path, pillow_format, **options)
+            yield 'synthetic', f'{megapixels}MP', name, path, image.size
+            os.unlink(path)
+        del image
+
+    if os.path.isdir(TEST_IMAGES):
+        for filename in sorted(os.listdir(TEST_IMAGES)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(TEST_IMAGES, filename)
+                with Image.open(path) as img:
+                    yield 'test_images', filename, img.format.lower(), path, img.size
+
+
+def run(repeat, sizes=SIZES, formats=tuple(FORMATS)):
+    """Benchmark every case; returns a list of result dicts"""
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for source, image_name, format_name, path, size in inputs(sizes, formats, workdir):
+            megapixels = size[0] * size[1] / 1_000_000
+            for case_name, func, args, kwargs in cases(path, size):
+                latencies, peak = measure(func, args, kwargs, repeat)
+                mean = sum(latencies) / len(latencies)
+                input_megapixels = megapixels * (2 if func is crop_and_combine_diptych else 1)
+                results.append({
+                    'case': f'{source}/{image_name}/{format_name}/{case_name}',
+                    'source': source,
+                    'image': image_name,
+                    'format': format_name,
+                    'megapixels': round(megapixels, 2),
+                    'operation': case_name,
+                    'repeat': repeat,
+                    'p50_seconds': round(percentile(latencies, 0.5), 4),
+                    'p95_seconds': round(percentile(latencies, 0.95), 4),
+                    'mean_seconds': round(mean, 4),
+                    'throughput_mp_per_s': round(input_megapixels / mean, 2),
+                    'peak_rss_mb': round(peak, 1),
+                })
+    return results
+
+
+def environment():
+    """Details of the machine and libraries a run was made with"""
+    return {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'peak_rss_per_case': os.path.exists('/proc/self/clear_refs'),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """Cases whose p50 latency grew by more than tolerance over a baseline run"""
+    previous = {result['case']: result for result in baseline['results']}
+    slower = []
+    for result in results:
+        before = previous.get(result['case'])
+        if before and result['p50_seconds'] > before['p50_seconds'] * (1 + tolerance):
+            slower.append((result['case'], before['p50_seconds'], result['p50_seconds']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help='synthetic sizes in megapixels')
+    parser.add_argument('--formats', default=','.join(FORMATS), help='synthetic input formats')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare p50 latency with')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='p50 slowdown over the baseline reported as a regression (default: 0.15)')
+    args = parser.parse_args()
+
+    sizes = [float(size) if '.' in size else int(size) for size in args.sizes.split(',') if size]
+    formats = [name for name in args.formats.split(',') if name]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error(f"unknown formats: {', '.join(sorted(unknown))}")
+
+    document = {'environment': environment(), 'results': run(args.repeat, sizes, formats)}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+
+    if args.json:
+        print(json.dumps(document, indent=2))
+    else:
+        print(f"{'case':<52} {'p50 s':>8} {'p95 s':>8} {'MP/s':>8} {'peak MB':>8}")
+        for result in document['results']:
+            print(f"{result['case']:<52} {result['p50_seconds']:>8.3f} {result['p95_seconds']:>8.3f} "
+                  f"{result['throughput_mp_per_s']:>8.1f} {result['peak_rss_mb']:>8.0f}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = regressions(document['results'], json.load(f), args.tolerance)
+        for case, before, after in slower:
+            print(f'REGRESSION {case}: p50 {before:.3f}s -> {after:.3f}s', file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+Helpers shared by the benchmark scripts
+
+The scripts run as `python benchmarks/<script>.py`, which puts this
+directory on sys.path, so they import it as `benchutil`.
+"""
+import math
+
+from PIL import Image
+
+
+def synthetic_image(megapixels, seed=0):
+    """3:2 RGB image of about megapixels MP with gradients and noise
+
+    Different seeds rotate the gradient so the images differ in content.
+    """
+    width = round(math.sqrt(megapixels * 1_000_000 * 1.5))
+    size = (width, round(width / 1.5))
+    gradient = Image.linear_gradient('L').resize(size)
+    if seed:
+        gradient = gradient.rotate(seed * 37 % 360, expand=False)
+    noise = Image.effect_noise(size, 40)
+    return Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+
+def percentile(values, fraction):
+    """Linearly interpolated percentile of values (fraction in 0-1), or None if empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = fraction * (len(ordered) - 1)
+    lower, upper = math.floor(index), math.ceil(index)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
@@ -0,0 +1,309 @@
+"""
+Load-test the HTTP routes with a concurrency sweep
+
+Virtual users drive a weighted mix of /upload, /process, /process-diptych
+and /download requests against a running instance (--url) or against the
+app served in-process on Werkzeug's threaded server (--serve). The sweep
+runs each concurrency level for a fixed time and reports requests per
+second, p50/p95/p99 latency and error rate per level. It also reports the
+saturation knee: the last level before throughput stopped growing or
+errors appeared.
+
+Usage:
+    python benchmarks/load_test.py --serve [--concurrency 1,2,4,8] [--duration 10]
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 [--mix process=5,diptych=2,upload=2,download=1]
+        [--megapixels 4] [--images DIR] [--json] [--output FILE]
+"""
+import argparse
+import atexit
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import deque
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchutil import percentile, synthetic_image  # noqa: E402
+
+DEFAULT_MIX = {'process': 5, 'diptych': 2, 'upload': 2, 'download': 1}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+
+def synthetic_jpeg(megapixels, seed):
+    """JPEG bytes of a 3:2 image of about megapixels MP"""
+    buffer = io.BytesIO()
+    synthetic_image(megapixels, seed).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def load_images(folder, megapixels, count=3):
+    """(filename, bytes) of the images in folder, or of synthetic JPEGs"""
+    if folder:
+        return [(name, open(os.path.join(folder, name), 'rb').read())
+                for name in sorted(os.listdir(folder)) if name.lower().endswith(IMAGE_EXTENSIONS)]
+    return [(f'synthetic_{i}.jpg', synthetic_jpeg(megapixels, i)) for i in range(count)]
+
+
+def multipart(field, filename, content):
+    """Encode one file as a multipart/form-data body; returns (body, content type)"""
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    return head + content + f'\r\n--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+
+def summarize(samples, seconds):
+    """Throughput, latency percentiles and error rate of (latency, ok) samples"""
+    latencies = [latency for latency, _ in samples]
+    errors = sum(1 for _, ok in samples if not ok)
+    return {
+        'requests': len(samples),
+        'rps': round(len(samples) / seconds, 2),
+        'p50_seconds': round(percentile(latencies, 0.5), 4) if samples else None,
+        'p95_seconds': round(percentile(latencies, 0.95), 4) if samples else None,
+        'p99_seconds': round(percentile(latencies, 0.99), 4) if samples else None,
+        'error_rate': round(errors / len(samples), 4) if samples else 0.0,
+    }
+
+
+def find_knee(levels, min_gain=0.1, max_error_rate=0.01):
+    """
+    Concurrency at which the server saturates
+
+    That is the last level before throughput grew by less than min_gain or
+    the error rate exceeded max_error_rate. None if neither happened
+    within the sweep.
+    """
+    for previous, current in zip(levels, levels[1:]):
+        if current['rps'] < previous['rps'] * (1 + min_gain) or current['error_rate'] > max_error_rate:
+            return previous['concurrency']
+    return None
+
+
+class LoadTest:
+    """
+    Weighted request mix against one server
+
+    Args:
+        base_url: Server root, e.g. http://127.0.0.1:5000
+        images: (filename, bytes) uploaded during setup and by 'upload'
+        mix: Operation name -> relative weight
+        timeout: Per-request timeout in seconds
+    """
+
+    def __init__(self, base_url, images, mix, timeout=120):
+        self.base_url = base_url.rstrip('/')
+        self.images = images
+        self.mix = mix
+        self.timeout = timeout
+        self.uploads = []  # (filename, width, height)
+        self.outputs = deque(maxlen=200)  # processed filenames for 'download'
+        self._lock = threading.Lock()
+
+    def request(self, method, path, body=None, content_type=None):
+        """Send a request; returns (status, response body), status 0 on connection errors"""
+        headers = {'Content-Type': content_type} if content_type else {}
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+        except OSError:
+            return 0, b''
+
+    def post_json(self, path, payload):
+        status, body = self.request('POST', path, json.dumps(payload).encode(), 'application/json')
+        return status, json.loads(body) if status == 200 else None
+
+    def upload(self, rng):
+        """Upload one of the images; trailing random bytes defeat upload dedup"""
+        name, content = rng.choice(self.images)
+        body, content_type = multipart('file', name, content + os.urandom(16))
+        status, response = self.request('POST', '/upload', body, content_type)
+        if status != 200:
+            return False
+        data = json.loads(response)
+        self.uploads.append((data['filename'], data['width'], data['height']))
+        return True
+
+    def random_crop(self, rng, width, height, aspect):
+        """Random crop of the given aspect, so requests rarely hit the result cache"""
+        crop_w = min(width, height * aspect) * rng.uniform(0.5, 1.0)
+        crop_h = crop_w / aspect
+        return {'x': rng.uniform(0, width - crop_w), 'y': rng.uniform(0, height - crop_h),
+                'width': crop_w, 'height': crop_h}
+
+    def process(self, rng):
+        filename, width, height = rng.choice(self.uploads)
+        letterbox = rng.random() < 0.3
+        payload = {
+            'filename': filename,
+            'preset': rng.choice(['4k', 'fhd']),
+            'crop': self.random_crop(rng, width, height, rng.uniform(0.7, 2.0) if letterbox else 16 / 9),
+            'letterbox': letterbox,
+        }
+        return self.record_output(*self.post_json('/process', payload))
+
+    def diptych(self, rng):
+        (filename1, width1, height1), (filename2, width2, height2) = rng.sample(self.uploads, 2)
+        payload = {
+            'filename1': filename1,
+            'filename2': filename2,
+            'preset': rng.choice(['4k', 'fhd']),
+            'crop1': self.random_crop(rng, width1, height1, 9 / 16),
+            'crop2': self.random_crop(rng, width2, height2, 9 / 16),
+        }
+        return self.record_output(*self.post_json('/process-diptych', payload))
+
+    def record_output(self, status, data):
+        """Remember a processed output for later downloads; returns whether processing succeeded"""
+        if data:
+            with self._lock:
+                self.outputs.append(data['filename'])
+        return status == 200
+
+    def download(self, rng):
+        with self._lock:
+            filename = rng.choice(self.outputs)
+        status, _ = self.request('GET', f'/download/{filename}')
+        return status == 200
+
+    def setup(self):
+        """Upload every image and make one output, so all operations have targets"""
+        rng = random.Random(0)
+        for _ in range(max(2, len(self.images))):
+            if not self.upload(rng):
+                raise RuntimeError(f'Setup upload to {self.base_url} failed')
+        if not self.process(rng):
+            raise RuntimeError(f'Setup /process on {self.base_url} failed')
+
+    def run_level(self, concurrency, duration):
+        """Run the mix with concurrency virtual users for duration seconds"""
+        operations = list(self.mix)
+        weights = [self.mix[name] for name in operations]
+        samples = {name: [] for name in operations}
+        deadline = time.perf_counter() + duration
+
+        def user(seed):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                name = rng.choices(operations, weights)[0]
+                start = time.perf_counter()
+                try:
+                    ok = getattr(self, name)(rng)
+                except Exception:
+                    # Malformed responses count as errors
+                    ok = False
+                samples[name].append((time.perf_counter() - start, ok))
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=user, args=(concurrency * 1000 + i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Requests in flight at the deadline finish late; count the real span
+        elapsed = time.perf_counter() - start
+
+        level = {'concurrency': concurrency, **summarize([s for v in samples.values() for s in v], elapsed)}
+        level['operations'] = {name: summarize(values, elapsed) for name, values in samples.items()}
+        return level
+
+
+def serve_app():
+    """Serve the app on Werkzeug's threaded server on a free port; returns its URL"""
+    from werkzeug.serving import make_server
+    from app import app
+
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    app.config.update({
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'PROCESSED_FOLDER': os.path.join(workdir, 'processed'),
+    })
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
+
+    # One access log line per request would drown the report
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def parse_mix(text):
+    """Parse 'process=5,download=1' into a weight dict"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise ValueError(f'unknown operation: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='root URL of a running instance')
+    target.add_argument('--serve', action='store_true', help="serve the app in-process on Werkzeug's server")
+    parser.add_argument('--concurrency', default='1,2,4,8,16', help='virtual user counts to sweep')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per concurrency level')
+    parser.add_argument('--mix', default=','.join(f'{name}={weight}' for name, weight in DEFAULT_MIX.items()),
+                        help='operation weights')
+    parser.add_argument('--megapixels', type=float, default=4, help='size of the synthetic test images')
+    parser.add_argument('--images', help='upload the images in this folder instead of synthetic ones')
+    parser.add_argument('--knee-gain', type=float, default=0.1,
+                        help='throughput growth per level below which the server counts as saturated')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    concurrency_levels = [int(level) for level in args.concurrency.split(',') if level]
+
+    base_url = serve_app() if args.serve else args.url
+    test = LoadTest(base_url, load_images(args.images, args.megapixels), mix)
+    test.setup()
+
+    levels = []
+    for concurrency in concurrency_levels:
+        levels.append(test.run_level(concurrency, args.duration))
+        if not args.json:
+            level = levels[-1]
+            print(f"c={concurrency:<4} {level['requests']:>6} req {level['rps']:>8.2f} rps  "
+                  f"p50 {level['p50_seconds'] or 0:.3f}s  p95 {level['p95_seconds'] or 0:.3f}s  "
+                  f"p99 {level['p99_seconds'] or 0:.3f}s  errors {level['error_rate']:.1%}", flush=True)
+
+    knee = find_knee(levels, min_gain=args.knee_gain)
+    document = {'url': base_url, 'mix': mix, 'duration': args.duration, 'levels': levels, 'knee': knee}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+
+    if args.json:
+        print(json.dumps(document, indent=2))
+    elif knee is None:
+        print('No saturation knee within the sweep; try higher concurrency')
+    else:
+        print(f'Saturation knee at concurrency {knee}')
+
+
+if __name__ == '__main__':
+    main()
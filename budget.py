@@ -0,0 +1,119 @@
+"""
+Pixel and memory budgets for processing
+
+Uploads are checked against the pixel limit while they stream in (see
+uploads.py). Before a stored image is processed its header is read again,
+without decoding anything, and the memory the decoded bitmaps will take is
+estimated from the declared dimensions, so oversized work is refused up
+front instead of exhausting a worker.
+
+The budget covers all processing in one web process, not each request:
+requests reserve their estimate before decoding and return it when done,
+waiting while other work holds the rest (see MemoryReservations).
+"""
+import math
+import threading
+from contextlib import contextmanager
+
+from PIL import Image
+
+
+class OverBudget(Exception):
+    """Raised when processing would need more bitmap memory than allowed"""
+
+    def __init__(self, needed, budget):
+        self.needed = needed
+        self.budget = budget
+        super().__init__(
+            f'Processing needs about {needed / 2 ** 20:,.0f} MB of image memory; '
+            f'the limit is {budget / 2 ** 20:,.0f} MB'
+        )
+
+
+class MemoryBusy(Exception):
+    """Raised when other processing holds too much of the memory budget"""
+
+    def __init__(self, needed, available):
+        self.needed = needed
+        self.available = available
+        super().__init__(
+            f'Processing needs about {needed / 2 ** 20:,.0f} MB of image memory; '
+            f'only {available / 2 ** 20:,.0f} MB is free right now'
+        )
+
+
+class MemoryReservations:
+    """
+    Bitmap memory reserved by the processing running in this process
+
+    budget is the total in bytes (0 disables reservations). A reservation
+    larger than the whole budget raises OverBudget straight away; others
+    wait for room until the timeout and then raise MemoryBusy.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.reserved = 0
+        self._changed = threading.Condition()
+
+    def acquire(self, needed, timeout=None):
+        """Reserve needed bytes, waiting up to timeout seconds (None waits indefinitely)"""
+        if not self.budget or not needed:
+            return
+        if needed > self.budget:
+            raise OverBudget(needed, self.budget)
+        with self._changed:
+            if not self._changed.wait_for(lambda: self.reserved + needed <= self.budget, timeout):
+                raise MemoryBusy(needed, self.budget - self.reserved)
+            self.reserved += needed
+
+    def release(self, needed):
+        """Return bytes taken by acquire()"""
+        if not self.budget or not needed:
+            return
+        with self._changed:
+            self.reserved -= needed
+            self._changed.notify_all()
+
+    @contextmanager
+    def reserve(self, needed, timeout=None):
+        """Hold needed bytes for the duration of a with block"""
+        self.acquire(needed, timeout)
+        try:
+            yield
+        finally:
+            self.release(needed)
+
+
+def bytes_per_pixel(mode):
+    """Bytes Pillow uses per pixel of a decoded image in mode"""
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    # Multi-band modes are stored as 32-bit pixels
+    return 4
+
+
+def bitmap_bytes(size, mode='RGB'):
+    """Memory of a decoded bitmap of size (width, height) in mode"""
+    return size[0] * size[1] * bytes_per_pixel(mode)
+
+
+def read_header(source):
+    """Return (format, (width, height), mode) of an image without decoding it"""
+    with Image.open(source) as img:
+        return img.format, img.size, img.mode
+
+
+def estimate_decode(header, box, draft_scale=1):
+    """
+    Upper bound of the memory for decoding one input and cropping box from it
+
+    Counts a full decode of the frame at the JPEG draft scale plus the
+    cropped copy; region decoding (see decoding.py) often needs less.
+    """
+    _, (width, height), mode = header
+    decoded = (math.ceil(width / draft_scale), math.ceil(height / draft_scale))
+    cropped = (math.ceil((box[2] - box[0]) / draft_scale), math.ceil((box[3] - box[1]) / draft_scale))
+    return bitmap_bytes(decoded, mode) + bitmap_bytes(cropped, mode)
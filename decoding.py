@@ -0,0 +1,258 @@
+"""
+Region-aware image loading
+
+Pillow decodes the whole frame on load() even when only a small crop of it
+is needed. The helpers here restrict a lazily opened image so that load()
+only decodes the rows (or tiles) covering a crop box:
+
+- Multi-tile images (tiled or striped TIFF) keep only the intersecting tiles
+- Uncompressed single-tile images (BMP, raw TIFF) seek straight to the first
+  needed row
+- Sequential single-tile images (non-interlaced PNG) stop after the last
+  needed row
+- Baseline JPEGs with restart markers on MCU-row boundaries are rewritten to
+  a smaller JPEG holding only the needed MCU rows
+
+Anything else falls back to a full decode.
+"""
+import io
+import math
+import re
+
+from PIL import Image
+
+# Bytes per pixel for plain interleaved raw modes
+RAW_MODE_BYTES = {
+    'L': 1, 'P': 1,
+    'RGB': 3, 'BGR': 3,
+    'RGBA': 4, 'RGBX': 4, 'BGRA': 4, 'BGRX': 4, 'CMYK': 4,
+}
+
+# Baseline and extended sequential Huffman frames
+JPEG_SOF_SEQUENTIAL = (0xC0, 0xC1)
+
+RESTART_MARKER = re.compile(rb'\xff[\xd0-\xd7]')
+
+
+def open_region(img, box):
+    """
+    Restrict a lazily opened image so load() decodes only what box needs
+
+    Args:
+        img: Lazily opened PIL image (nothing decoded yet)
+        box: (left, top, right, bottom) crop box in source pixels
+
+    Returns:
+        (image, (dx, dy)) - the image to crop from, which may be a new,
+        smaller image, and the position of its top-left pixel in the source.
+        Subtract (dx, dy) from source coordinates before cropping.
+    """
+    if not img.tile or getattr(img, 'n_frames', 1) > 1:
+        return img, (0, 0)
+
+    width, height = img.size
+    top = max(0, min(height, int(box[1])))
+    bottom = max(top, min(height, math.ceil(box[3])))
+    if bottom <= top or (top == 0 and bottom == height):
+        return img, (0, 0)
+
+    if img.format == 'JPEG':
+        region = _jpeg_restart_region(img, top, bottom)
+        if region is not None:
+            return region
+        return img, (0, 0)
+
+    if len(img.tile) > 1:
+        return _filter_tiles(img, box)
+
+    tile = img.tile[0]
+    if tile.extents != (0, 0, width, height):
+        return img, (0, 0)
+
+    if tile.codec_name == 'raw':
+        return _raw_rows(img, tile, top, bottom)
+
+    if tile.codec_name == 'zip' and img.format == 'PNG' and not img.info.get('interlace'):
+        # Rows are decoded top to bottom, so stop after the last needed row
+        img.tile = [tile._replace(extents=(0, 0, width, bottom))]
+        img._size = (width, bottom)
+        return img, (0, 0)
+
+    return img, (0, 0)
+
+
+def _filter_tiles(img, box):
+    """Keep only the tiles of a multi-tile image that intersect box"""
+    left, top, right, bottom = box
+    kept = [t for t in img.tile
+            if t.extents[0] < right and t.extents[2] > left
+            and t.extents[1] < bottom and t.extents[3] > top]
+    if not kept or len(kept) == len(img.tile):
+        return img, (0, 0)
+
+    dx = min(t.extents[0] for t in kept)
+    dy = min(t.extents[1] for t in kept)
+    union_w = max(t.extents[2] for t in kept) - dx
+    union_h = max(t.extents[3] for t in kept) - dy
+
+    # Kept tiles must cover their bounding rectangle exactly
+    covered = sum((t.extents[2] - t.extents[0]) * (t.extents[3] - t.extents[1]) for t in kept)
+    if covered != union_w * union_h:
+        return img, (0, 0)
+
+    img.tile = [t._replace(extents=(t.extents[0] - dx, t.extents[1] - dy,
+                                    t.extents[2] - dx, t.extents[3] - dy))
+                for t in kept]
+    img._size = (union_w, union_h)
+    return img, (dx, dy)
+
+
+def _raw_rows(img, tile, top, bottom):
+    """Seek an uncompressed single-tile image straight to the needed rows"""
+    args = tile.args if isinstance(tile.args, tuple) else (tile.args,)
+    rawmode = args[0]
+    stride = args[1] if len(args) > 1 else 0
+    orientation = args[2] if len(args) > 2 else 1
+
+    width, height = img.size
+    if not stride:
+        if rawmode not in RAW_MODE_BYTES:
+            return img, (0, 0)
+        stride = width * RAW_MODE_BYTES[rawmode]
+
+    if orientation == 1:
+        offset = tile.offset + top * stride
+    elif orientation == -1:
+        # Bottom-up storage (BMP): the last needed row is stored first
+        offset = tile.offset + (height - bottom) * stride
+    else:
+        return img, (0, 0)
+
+    img.tile = [tile._replace(extents=(0, 0, width, bottom - top), offset=offset)]
+    img._size = (width, bottom - top)
+    return img, (0, top)
+
+
+def _jpeg_restart_region(img, top, bottom):
+    """
+    Rewrite a baseline JPEG to hold only the MCU rows covering [top, bottom),
+    plus one row of context either side
+
+    Each restart interval resets the DC predictors, so entropy-coded segments
+    that start on an MCU row boundary can be dropped or kept independently.
+    Returns None when the stream has no usable restart markers. The marker
+    segments are read first; the entropy-coded data only when they declare
+    a restart interval.
+    """
+    img.fp.seek(0)
+    parsed = _read_jpeg_header(img.fp)
+    if parsed is None:
+        return None
+    header, prefix = parsed
+
+    mcu_w, mcu_h = header['mcu_size']
+    width, height = header['width'], header['height']
+    interval = header['restart_interval']
+    mcus_per_row = math.ceil(width / mcu_w)
+    mcu_rows = math.ceil(height / mcu_h)
+
+    scan = img.fp.read()
+    scan_end = scan.find(b'\xff\xd9')
+    if scan_end < 0:
+        return None
+    scan = scan[:scan_end]
+
+    segments = []
+    pos = 0
+    for marker in RESTART_MARKER.finditer(scan):
+        segments.append(scan[pos:marker.start()])
+        pos = marker.end()
+    segments.append(scan[pos:])
+    if len(segments) != math.ceil(mcus_per_row * mcu_rows / interval):
+        return None
+
+    # Keep one MCU row either side of the crop (libjpeg's fancy chroma
+    # upsampling reads the neighbouring row, so edge rows would differ from
+    # a full decode), then widen outwards to the nearest restart boundaries
+    row0 = max(top // mcu_h - 1, 0)
+    while row0 > 0 and (row0 * mcus_per_row) % interval:
+        row0 -= 1
+    row1 = min(math.ceil(bottom / mcu_h) + 1, mcu_rows)
+    while row1 < mcu_rows and (row1 * mcus_per_row) % interval:
+        row1 += 1
+    if row0 == 0 and row1 == mcu_rows:
+        return None
+
+    first = row0 * mcus_per_row // interval
+    last = math.ceil(row1 * mcus_per_row / interval)
+    kept = segments[first:last]
+
+    entropy = bytearray(kept[0])
+    for index, segment in enumerate(kept[1:]):
+        entropy += bytes((0xFF, 0xD0 + index % 8))
+        entropy += segment
+
+    new_height = min(row1 * mcu_h, height) - row0 * mcu_h
+    height_at = header['height_offset']
+    prefix[height_at:height_at + 2] = new_height.to_bytes(2, 'big')
+
+    region = Image.open(io.BytesIO(bytes(prefix) + bytes(entropy) + b'\xff\xd9'))
+    return region, (0, row0 * mcu_h)
+
+
+def _read_jpeg_header(fp):
+    """
+    Read the frame geometry and restart interval of a baseline JPEG
+
+    Reads fp segment by segment up to the start of the scan, leaving fp at
+    the entropy-coded data. Returns (header, prefix), prefix being the bytes
+    read, or None for progressive or multi-scan files, or files without a
+    restart interval.
+    """
+    prefix = bytearray(fp.read(2))
+    if prefix != b'\xff\xd8':
+        return None
+
+    header = {'restart_interval': 0}
+    while True:
+        marker_bytes = fp.read(2)
+        while marker_bytes == b'\xff\xff':
+            # Fill byte before a marker
+            prefix += b'\xff'
+            marker_bytes = b'\xff' + fp.read(1)
+        if len(marker_bytes) < 2 or marker_bytes[0] != 0xFF:
+            return None
+        marker = marker_bytes[1]
+        length_bytes = fp.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = int.from_bytes(length_bytes, 'big')
+        body = fp.read(length - 2)
+        if len(body) < length - 2:
+            return None
+        pos = len(prefix)
+        prefix += marker_bytes + length_bytes + body
+
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if marker not in JPEG_SOF_SEQUENTIAL:
+                return None
+            header['height_offset'] = pos + 5
+            header['height'] = int.from_bytes(body[1:3], 'big')
+            header['width'] = int.from_bytes(body[3:5], 'big')
+            components = body[5]
+            if components == 1:
+                # Single-component scans are not interleaved: one block per MCU
+                header['mcu_size'] = (8, 8)
+            else:
+                sampling = [body[7 + 3 * i] for i in range(components)]
+                header['mcu_size'] = (8 * max(s >> 4 for s in sampling),
+                                      8 * max(s & 0x0F for s in sampling))
+            header['components'] = components
+        elif marker == 0xDD:
+            header['restart_interval'] = int.from_bytes(body[0:2], 'big')
+        elif marker == 0xDA:
+            if 'height' not in header or not header['height']:
+                return None
+            if not header['restart_interval'] or body[0] != header['components']:
+                return None
+            return header, prefix
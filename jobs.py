@@ -0,0 +1,287 @@
+"""
+Background job queue for image processing
+
+Jobs run on a bounded local worker pool (processes by default, since Pillow
+work is CPU-bound) with no external broker. Job state lives in the web
+process that accepted the job; workers report progress back over a queue
+that a listener thread drains. With a state folder, every status change
+is also written to <folder>/<job_id>.json, so any web process sharing the
+folder (e.g. each gunicorn worker) can answer status lookups. The
+max_pending limit applies per web process.
+
+A pool whose worker process dies (e.g. killed for running out of memory)
+is replaced; the jobs it held are reported as failed.
+"""
+import json
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+# Progress queue inside pool workers, set by _init_worker
+_progress_events = None
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class QueueFull(Exception):
+    """Raised when the job queue has no room for another job"""
+
+
+def _init_worker(events):
+    """Pool initializer: remember the queue progress is reported on"""
+    global _progress_events
+    _progress_events = events
+
+
+def _run_job(job_id, func, args, kwargs, timed=False):
+    """
+    Run a job in a pool worker, reporting progress to the parent
+
+    Timed jobs also get a timings dict to fill with stage durations; they
+    return (result, timings), with the job's wall time under 'total'.
+    """
+    def progress(fraction):
+        _progress_events.put((job_id, fraction))
+
+    progress(0.0)
+    if not timed:
+        return func(*args, progress=progress, **kwargs)
+
+    timings = {}
+    start = time.perf_counter()
+    returned = func(*args, progress=progress, timings=timings, **kwargs)
+    timings['total'] = time.perf_counter() - start
+    return returned, timings
+
+
+class JobQueue:
+    """
+    Bounded queue of processing jobs
+
+    Args:
+        max_workers: Number of pool workers
+        max_pending: Maximum number of queued plus running jobs; submit()
+                     raises QueueFull beyond this
+        executor: 'process' or 'thread'
+        history: Number of finished jobs to keep for status lookups
+        state_folder: Optional folder status files are shared through
+        state_ttl: Seconds after which status files left behind by other
+                   (e.g. restarted) processes are deleted
+    """
+
+    def __init__(self, max_workers=2, max_pending=16, executor='process', history=1000,
+                 state_folder=None, state_ttl=24 * 60 * 60):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor_type = executor
+        self.history = history
+        self.state_folder = state_folder
+        self.state_ttl = state_ttl
+        if state_folder:
+            os.makedirs(state_folder, exist_ok=True)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._events = None
+
+    def _ensure_started(self):
+        """Create the worker pool, and the progress listener on first use (caller holds the lock)"""
+        if self._executor is not None:
+            return
+
+        if self._events is None:
+            self._events = queue.Queue() if self.executor_type == 'thread' else multiprocessing.Queue()
+            listener = threading.Thread(target=self._listen, args=(self._events,), daemon=True)
+            listener.start()
+
+        pool_class = ThreadPoolExecutor if self.executor_type == 'thread' else ProcessPoolExecutor
+        self._executor = pool_class(
+            max_workers=self.max_workers,
+            initializer=_init_worker,
+            initargs=(self._events,)
+        )
+
+    def _discard_pool(self, executor):
+        """Drop a broken worker pool so the next submit starts a new one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _listen(self, events):
+        """Apply progress reports from workers to job records"""
+        while True:
+            job_id, fraction = events.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job and job['status'] in ('queued', 'running'):
+                    job['status'] = 'running'
+                    job['progress'] = max(job['progress'], fraction)
+                    self._save(job)
+
+    def pending(self):
+        """Number of jobs queued or running"""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+
+    def submit(self, func, *args, result=None, on_success=None, on_done=None, timed=False, **kwargs):
+        """
+        Queue func(*args, **kwargs) and return the new job id
+
+        func must be picklable (a module-level function) and accept a
+        progress callback keyword argument. result is a dict merged into the
+        job status once the job succeeds; on_success is called (in the web
+        process) with func's return value. With timed=True func also gets a
+        timings keyword argument (a dict of stage durations, see metrics.py)
+        and on_success receives (return value, timings). on_done is called
+        with no arguments once the job has finished, whatever the outcome;
+        it is not called if submit raises.
+        """
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+            if active >= self.max_pending:
+                raise QueueFull('Job queue is full')
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'job_id': job_id,
+                'status': 'queued',
+                'progress': 0.0,
+                'result': result or {},
+            }
+            self._save(self._jobs[job_id])
+            self._prune()
+
+        # A pool whose worker died refuses new work; replace it once
+        for attempt in range(2):
+            with self._lock:
+                self._ensure_started()
+                executor = self._executor
+            try:
+                future = executor.submit(_run_job, job_id, func, args, kwargs, timed)
+                break
+            except BrokenExecutor:
+                self._discard_pool(executor)
+                if attempt:
+                    with self._lock:
+                        del self._jobs[job_id]
+                        self._delete_state(job_id)
+                    raise
+        future.add_done_callback(lambda f: self._finish(job_id, f, on_success, on_done, timed, executor))
+        return job_id
+
+    def _finish(self, job_id, future, on_success=None, on_done=None, timed=False, executor=None):
+        """Record the outcome of a finished job"""
+        # Jobs still queued on a discarded pool are cancelled with it
+        error = BrokenExecutor() if future.cancelled() else future.exception()
+        if executor is not None and isinstance(error, BrokenExecutor):
+            self._discard_pool(executor)
+
+        if on_success is not None and error is None:
+            # A failing callback (e.g. storing the output) fails the job
+            # rather than leaving it running and holding a queue slot
+            try:
+                if timed:
+                    on_success(*future.result())
+                else:
+                    on_success(future.result())
+            except Exception as e:
+                error = e
+        if on_done is not None:
+            on_done()
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if error is None:
+                job['status'] = 'done'
+                job['progress'] = 1.0
+            elif isinstance(error, BrokenExecutor):
+                job['status'] = 'failed'
+                job['error'] = 'Processing failed: the worker process stopped unexpectedly'
+            else:
+                job['status'] = 'failed'
+                job['error'] = f'Processing failed: {error}'
+            self._save(job)
+
+    def _prune(self):
+        """Drop the oldest finished jobs beyond the history limit, and stale status files"""
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+            self._delete_state(job_id)
+
+        if self.state_folder:
+            cutoff = time.time() - self.state_ttl
+            with os.scandir(self.state_folder) as entries:
+                stale = [entry.path for entry in entries
+                         if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff]
+            for path in stale:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def _state_path(self, job_id):
+        return os.path.join(self.state_folder, f'{job_id}.json')
+
+    def _save(self, job):
+        """Write a job's status file, if sharing state (caller holds the lock)"""
+        if not self.state_folder:
+            return
+        path = self._state_path(job['job_id'])
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._public(job), f)
+        # Readers in other processes never see a partly written file
+        os.replace(temp_path, path)
+
+    def _delete_state(self, job_id):
+        if self.state_folder:
+            try:
+                os.unlink(self._state_path(job_id))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _public(job):
+        """JSON-ready status dict of a job record"""
+        status = {
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'progress': round(job['progress'], 2),
+        }
+        if job['status'] == 'done':
+            status.update(job['result'])
+        elif job['status'] == 'failed':
+            status['error'] = job['error']
+        return status
+
+    def status(self, job_id):
+        """Return a JSON-ready status dict for a job, or None if unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return self._public(job)
+
+        # Accepted by another web process sharing the state folder?
+        if not self.state_folder or not JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(self._state_path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def shutdown(self, wait=True):
+        """Stop the worker pool"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -0,0 +1,125 @@
+"""
+Prometheus-style metrics without external dependencies
+
+Processing functions fill a plain dict of stage timings (see stage()),
+which works the same in the web process, on threads and in pool workers
+that send the dict back. The app turns those timings into labelled
+histograms, rendered in the Prometheus text format on /metrics.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Bytes, 1MB to 4GB
+BYTES_BUCKETS = tuple(2 ** power for power in range(20, 33, 2))
+
+# Upper bounds of the input megapixel label buckets
+MEGAPIXEL_BUCKETS = (2, 8, 16, 24, 50, 100)
+
+
+@contextmanager
+def stage(timings, name):
+    """Add the time spent in the block to timings[name]; a no-op if timings is None"""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def merge_timings(timings, parts):
+    """Add per-thread stage timings into timings (if not None)"""
+    if timings is None:
+        return
+    for part in parts:
+        for name, seconds in part.items():
+            timings[name] = timings.get(name, 0.0) + seconds
+
+
+def megapixel_bucket(pixels):
+    """Coarse megapixel label for a pixel count, e.g. '8-16'"""
+    lower = 0
+    for upper in MEGAPIXEL_BUCKETS:
+        if pixels < upper * 1_000_000:
+            return f'{lower}-{upper}'
+        lower = upper
+    return f'{lower}+'
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Histogram:
+    """
+    Cumulative histogram with a fixed set of label names
+
+    Args:
+        name: Metric name
+        help: One-line description
+        label_names: Names of the labels every observation provides
+        buckets: Upper bounds of the buckets
+    """
+
+    def __init__(self, name, help, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """Return the metric in the Prometheus text format"""
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.label_names, key, [('le', repr(float(bound)))])
+                    lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+                labels = _format_labels(self.label_names, key, [('le', '+Inf')])
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = _format_labels(self.label_names, key)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return '\n'.join(lines)
+
+
+class Registry:
+    """A set of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, label_names, buckets=DEFAULT_BUCKETS):
+        """Create and register a histogram"""
+        histogram = Histogram(name, help, label_names, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def render(self):
+        """Return every metric in the Prometheus text format"""
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
@@ -0,0 +1,126 @@
+"""
+Output presets: the display resolutions outputs are produced for
+
+The built-in 4K and Full HD presets can be replaced with a JSON file that
+maps each preset key to its definition:
+
+    {
+        "8k": {"width": 7680, "height": 4320, "name": "8K"},
+        "fhd": {"width": 1920, "height": 1080, "name": "Full HD",
+                "encode_profile": "fast"},
+        "panel": {"width": 1080, "height": 1920, "name": "Portrait panel",
+                  "suffix": "_portrait", "resampling": "progressive"},
+        "thumb": {"width": 640, "height": 360, "filter": "bilinear"}
+    }
+
+width and height are required. name defaults to the key, suffix (added to
+suggested download names) to "_<key>". encode_profile, resampling (the
+method) and filter (the resampling filter, see resampling.FILTERS) set the
+defaults for that preset; requests can still override them. The first
+preset is used when a request names none.
+
+Presets are validated when loaded, and each one carries derived values
+(aspect ratio, suffix) so request handlers don't recompute them.
+"""
+import json
+import re
+
+from resampling import FILTERS, RESAMPLING_METHODS
+
+DEFAULT_PRESETS = {
+    '4k': {'width': 3840, 'height': 2160, 'name': '4K Ultra HD'},
+    'fhd': {'width': 1920, 'height': 1080, 'name': 'Full HD'},
+}
+
+# Longest output edge a preset may ask for (16K)
+MAX_EDGE = 15360
+
+# Keys appear in requests and data attributes, suffixes in filenames
+KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+SUFFIX_PATTERN = re.compile(r'^[A-Za-z0-9_.-]*$')
+
+FIELDS = {'width', 'height', 'name', 'suffix', 'encode_profile', 'resampling', 'filter'}
+
+
+class PresetError(ValueError):
+    """A preset definition is invalid"""
+
+
+def build_preset(key, spec, encode_profiles=None):
+    """
+    Validate one preset definition and add its derived values
+
+    Args:
+        key: Preset key
+        spec: Dict with width, height and the optional fields described in
+              the module docstring
+        encode_profiles: Known encode profile names (None skips the check)
+
+    Returns:
+        Dict with key, name, width, height, aspect, suffix, encode_profile,
+        resampling and filter (the last three None when not set)
+    """
+    if not isinstance(key, str) or not KEY_PATTERN.match(key):
+        raise PresetError(f'Invalid preset key {key!r}: use letters, digits, "-" and "_"')
+    if not isinstance(spec, dict):
+        raise PresetError(f'Preset {key!r} must be an object')
+    unknown = set(spec) - FIELDS
+    if unknown:
+        raise PresetError(f"Preset {key!r} has unknown fields: {', '.join(sorted(unknown))}")
+
+    for field in ('width', 'height'):
+        value = spec.get(field)
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 < value <= MAX_EDGE:
+            raise PresetError(f'Preset {key!r} needs an integer {field} between 1 and {MAX_EDGE}')
+
+    name = spec.get('name', key)
+    if not isinstance(name, str) or not name:
+        raise PresetError(f'Preset {key!r} has an invalid name')
+
+    suffix = spec.get('suffix', f'_{key}')
+    if not isinstance(suffix, str) or not SUFFIX_PATTERN.match(suffix):
+        raise PresetError(f'Preset {key!r} has an invalid suffix {suffix!r}')
+
+    encode_profile = spec.get('encode_profile')
+    if encode_profile is not None and encode_profiles is not None and encode_profile not in encode_profiles:
+        raise PresetError(f'Preset {key!r} has an unknown encode_profile {encode_profile!r}')
+
+    resampling = spec.get('resampling')
+    if resampling is not None and resampling not in RESAMPLING_METHODS:
+        raise PresetError(f'Preset {key!r} has an unknown resampling method {resampling!r}')
+
+    resample_filter = spec.get('filter')
+    if resample_filter is not None and resample_filter not in FILTERS:
+        raise PresetError(f'Preset {key!r} has an unknown filter {resample_filter!r}')
+
+    return {
+        'key': key,
+        'name': name,
+        'width': spec['width'],
+        'height': spec['height'],
+        'aspect': spec['width'] / spec['height'],
+        'suffix': suffix,
+        'encode_profile': encode_profile,
+        'resampling': resampling,
+        'filter': resample_filter,
+    }
+
+
+def build_presets(specs, encode_profiles=None):
+    """Validate a mapping of preset key -> definition; returns key -> preset, in order"""
+    if not isinstance(specs, dict) or not specs:
+        raise PresetError('Presets must be a non-empty object of preset key -> definition')
+    return {key: build_preset(key, spec, encode_profiles) for key, spec in specs.items()}
+
+
+def load_presets(path, encode_profiles=None):
+    """Read and validate a presets JSON file"""
+    try:
+        with open(path) as f:
+            specs = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise PresetError(f'Cannot load presets from {path}: {e}') from e
+    try:
+        return build_presets(specs, encode_profiles)
+    except PresetError as e:
+        raise PresetError(f'{path}: {e}') from e
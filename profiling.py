@@ -0,0 +1,67 @@
+"""
+Profile capture for slow requests
+
+Sampled requests run under cProfile. Captures worth keeping are written to
+a ring directory as <id>.pstats (load with pstats or snakeviz) plus
+<id>.json holding the request parameters and input image metadata, so a
+slow request can be reproduced later. The oldest captures are deleted once
+the directory holds more than the configured number.
+"""
+import cProfile
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+
+def start_profile():
+    """Enable a new profiler for this thread, or return None if one is already active"""
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiler (e.g. a debugger's) already owns this thread
+        return None
+    return profile
+
+
+class ProfileRing:
+    """
+    Bounded directory of profile captures
+
+    Args:
+        folder: Directory captures are written to (created on first save)
+        max_captures: Captures to keep; older ones are deleted
+    """
+
+    def __init__(self, folder, max_captures=50):
+        self.folder = folder
+        self.max_captures = max_captures
+        self._lock = threading.Lock()
+
+    def save(self, profile, metadata, label='request'):
+        """Write a capture and its metadata; returns the capture id"""
+        capture_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{label}_{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            profile.dump_stats(os.path.join(self.folder, f'{capture_id}.pstats'))
+            with open(os.path.join(self.folder, f'{capture_id}.json'), 'w') as f:
+                json.dump(metadata, f, indent=2, default=str)
+            self._prune()
+        return capture_id
+
+    def captures(self):
+        """Ids of the stored captures, oldest first"""
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(name[:-len('.pstats')] for name in os.listdir(self.folder) if name.endswith('.pstats'))
+
+    def _prune(self):
+        """Delete the oldest captures beyond max_captures (caller holds the lock)"""
+        captures = self.captures()
+        for capture_id in captures[:max(0, len(captures) - self.max_captures)]:
+            for extension in ('.pstats', '.json'):
+                path = os.path.join(self.folder, capture_id + extension)
+                if os.path.exists(path):
+                    os.unlink(path)
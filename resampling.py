@@ -0,0 +1,121 @@
+"""
+Resampling planner for large scale factors
+
+A single Lanczos pass costs time (and, for big reductions, a wide filter
+window over every source pixel) in proportion to the scale factor. The
+'progressive' method plans the resize in steps instead:
+
+- Reductions first shrink the image by an integer factor with a cheap box
+  filter (Image.reduce, via resize's reducing_gap) to about twice the
+  target size, then finish with one Lanczos pass
+- Enlargements are done in Lanczos stages of at most MAX_UPSCALE_STEP each
+
+'single' keeps the original one-pass Lanczos resize. resize_into() runs
+it in horizontal bands written straight into the output frame, so no
+full-frame intermediate is allocated next to the frame.
+
+Either method can use a cheaper filter than Lanczos (see FILTERS), e.g.
+for small outputs where its extra sharpness is hard to see.
+"""
+from PIL import Image
+
+RESAMPLING_METHODS = ('single', 'progressive')
+
+# Resampling filters by name, slowest and sharpest first
+FILTERS = {
+    'lanczos': Image.Resampling.LANCZOS,
+    'bicubic': Image.Resampling.BICUBIC,
+    'hamming': Image.Resampling.HAMMING,
+    'bilinear': Image.Resampling.BILINEAR,
+}
+
+# Leave this much headroom over the target when pre-shrinking
+REDUCING_GAP = 2.0
+
+# Largest enlargement done in one stage
+MAX_UPSCALE_STEP = 2.0
+
+# Output rows resampled at a time by resize_into()
+BAND_ROWS = 256
+
+
+def plan_stages(source_size, target_size):
+    """
+    Return the sizes of the intermediate enlargement stages
+
+    The list ends with target_size; it has a single entry when the resize
+    is a reduction or an enlargement of at most MAX_UPSCALE_STEP.
+    """
+    source_w, source_h = source_size
+    target_w, target_h = target_size
+    stages = []
+    while target_w > source_w * MAX_UPSCALE_STEP or target_h > source_h * MAX_UPSCALE_STEP:
+        source_w = min(target_w, round(source_w * MAX_UPSCALE_STEP))
+        source_h = min(target_h, round(source_h * MAX_UPSCALE_STEP))
+        stages.append((source_w, source_h))
+    stages.append(tuple(target_size))
+    return stages
+
+
+def resize(image, size, box=None, method='single', resample_filter='lanczos'):
+    """
+    Resize image (or the box region of it) to size
+
+    Args:
+        image: PIL image
+        size: (width, height) to produce
+        box: Optional (left, top, right, bottom) source region, may be fractional
+        method: 'single' for one pass, 'progressive' to plan the resize as
+                described in the module docstring
+        resample_filter: Name of the filter in FILTERS used for every pass
+    """
+    resample = FILTERS[resample_filter]
+    if method == 'single':
+        return image.resize(size, resample, box=box)
+    if method != 'progressive':
+        raise ValueError(f'Unknown resampling method: {method!r}')
+
+    if box is None:
+        box = (0, 0) + image.size
+    source_size = (box[2] - box[0], box[3] - box[1])
+
+    stages = plan_stages(source_size, size)
+    # reducing_gap only takes effect when the first stage is a reduction
+    resized = image.resize(stages[0], resample, box=box, reducing_gap=REDUCING_GAP)
+    for stage in stages[1:]:
+        resized = resized.resize(stage, resample)
+    return resized
+
+
+def resize_into(dest, offset, image, size, box=None, method='single', band_rows=BAND_ROWS,
+                resample_filter='lanczos'):
+    """
+    Resize image (or the box region of it) to size and paste it into dest at offset
+
+    'single' resizes run in horizontal bands of band_rows output rows. Each
+    band is resampled from a box covering just its rows; Pillow widens the
+    filter window past the box edges into the neighbouring source rows, so
+    the bands join up as one full resize would (to within one level of
+    rounding). Only a band-sized intermediate exists at a time instead of
+    a full-frame resized copy.
+    'progressive' resizes and band_rows=0 resize the whole region at once.
+    resample_filter names the filter, as for resize().
+
+    Returns dest.
+    """
+    if method != 'single' or not band_rows:
+        dest.paste(resize(image, size, box=box, method=method, resample_filter=resample_filter), offset)
+        return dest
+
+    if box is None:
+        box = (0, 0) + image.size
+    left, top, right, bottom = box
+    width, height = size
+    x, y = offset
+    resample = FILTERS[resample_filter]
+    rows_per_output_row = (bottom - top) / height
+    for row in range(0, height, band_rows):
+        rows = min(band_rows, height - row)
+        band_box = (left, top + row * rows_per_output_row, right, top + (row + rows) * rows_per_output_row)
+        dest.paste(image.resize((width, rows), resample, box=band_box), (x, y + row))
+    return dest
@@ -0,0 +1,114 @@
+"""
+Content-addressed cache of processed outputs
+
+Processed files are keyed on a hash of the source content plus the
+normalized processing parameters, so repeating a request (or switching
+presets back and forth) reuses the earlier output instead of redoing the
+resize and encode. Entries are evicted least-recently-used once the total
+size of cached outputs exceeds a byte budget; evicted files are deleted.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+def make_key(**params):
+    """Build a cache key from JSON-serializable processing parameters"""
+    encoded = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU cache mapping processing keys to stored output files
+
+    Args:
+        storage: Storage the cached output files live in (see storage.py)
+        max_bytes: Total size budget of cached outputs; 0 disables caching
+        on_evict: Optional callback receiving each filename the cache deletes
+    """
+
+    def __init__(self, storage, max_bytes, on_evict=None):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (filename, size)
+        self._keys_by_file = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        """Return the cached output filename for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self.storage.exists(entry[0]):
+                # Removed behind our back (e.g. by retention); forget it
+                self._drop(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, filename):
+        """Record filename (already written to storage) as the output for key"""
+        try:
+            size = self.storage.size(filename)
+        except (OSError, KeyError, ValueError):
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (filename, size)
+            self._keys_by_file[filename] = key
+            self._bytes += size
+
+            # Evict least recently used entries, never the one just added
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_key = next(iter(self._entries))
+                old_filename, _ = self._drop(old_key)
+                self.evictions += 1
+                self.storage.delete(old_filename)
+                if self.on_evict:
+                    self.on_evict(old_filename)
+
+    def discard(self, filename):
+        """Forget the entry for an output file deleted elsewhere"""
+        with self._lock:
+            key = self._keys_by_file.get(filename)
+            if key is not None:
+                self._drop(key)
+
+    def _drop(self, key):
+        """Remove an entry from the index (caller holds the lock)"""
+        filename, size = self._entries.pop(key)
+        self._keys_by_file.pop(filename, None)
+        self._bytes -= size
+        return filename, size
+
+    def stats(self):
+        """Return hit/miss counters and current usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
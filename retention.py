@@ -0,0 +1,185 @@
+"""
+Retention and garbage collection for the upload and output folders
+
+Each folder gets a FolderIndex: an in-memory LRU index of file sizes and
+last-access times, built with one directory scan and then kept current as
+the app writes and serves files. Sweeps use the index only, deleting files
+not accessed within a TTL and then the least recently used files until the
+folder fits its size budget. Files pinned by an in-flight download are
+never deleted.
+"""
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# Temporary upload files older than this are leftovers from a crash
+STALE_TEMP_SECONDS = 3600
+
+
+class FolderIndex:
+    """
+    Index of the files in one store, ordered by last access
+
+    Args:
+        storage: Storage holding the files (see storage.py)
+        ttl: Delete files not accessed for this many seconds (0 disables)
+        max_bytes: Keep the folder's total size below this (0 disables)
+        on_delete: Optional callback receiving each deleted filename
+    """
+
+    def __init__(self, storage, ttl, max_bytes, on_delete=None):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.on_delete = on_delete
+        self.deleted = 0
+        self._files = OrderedDict()  # name -> (size, last_access), oldest first
+        self._bytes = 0
+        self._pins = Counter()
+        self._lock = threading.Lock()
+        self.scan()
+
+    @property
+    def total_bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._files)
+
+    def scan(self):
+        """Rebuild the index from the store (done once at startup)"""
+        self.storage.remove_stale_temp_files(STALE_TEMP_SECONDS)
+        entries = sorted((last_access, name, size)
+                         for name, size, last_access in self.storage.iter_files())
+
+        with self._lock:
+            self._files.clear()
+            self._bytes = 0
+            for last_access, name, size in entries:
+                self._files[name] = (size, last_access)
+                self._bytes += size
+
+    def record(self, name):
+        """Add or refresh a file after it has been written"""
+        try:
+            size = self.storage.size(name)
+        except (OSError, KeyError, ValueError):
+            return
+        with self._lock:
+            self._remove(name)
+            self._files[name] = (size, time.time())
+            self._bytes += size
+
+    def touch(self, name):
+        """Mark a file as just accessed"""
+        with self._lock:
+            entry = self._files.get(name)
+            if entry is not None:
+                self._files[name] = (entry[0], time.time())
+                self._files.move_to_end(name)
+                return
+        self.record(name)
+
+    def forget(self, name):
+        """Drop a file deleted by someone else from the index"""
+        with self._lock:
+            self._remove(name)
+
+    def pin(self, name):
+        """Protect a file from deletion until unpin() (e.g. while it is sent)"""
+        with self._lock:
+            self._pins[name] += 1
+
+    def unpin(self, name):
+        with self._lock:
+            self._pins[name] -= 1
+            if self._pins[name] <= 0:
+                del self._pins[name]
+
+    def over_budget(self):
+        return bool(self.max_bytes) and self._bytes > self.max_bytes
+
+    def sweep(self, now=None):
+        """Delete expired files, then LRU files while over budget; returns deleted names"""
+        now = time.time() if now is None else now
+        deleted = []
+        with self._lock:
+            newest = next(reversed(self._files), None)
+            for name, (size, last_access) in list(self._files.items()):
+                expired = self.ttl and now - last_access > self.ttl
+                over_budget = self.max_bytes and self._bytes > self.max_bytes
+                if not expired and not over_budget:
+                    # Oldest first: everything after this is newer
+                    break
+                if self._pins.get(name) or (not expired and name == newest):
+                    # The budget never evicts the file that was just written
+                    continue
+                self._remove(name)
+                self.storage.delete(name)
+                deleted.append(name)
+
+        self.deleted += len(deleted)
+        if self.on_delete:
+            for name in deleted:
+                self.on_delete(name)
+        return deleted
+
+    def _remove(self, name):
+        """Remove an entry from the index (caller holds the lock)"""
+        entry = self._files.pop(name, None)
+        if entry is not None:
+            self._bytes -= entry[0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._files),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'pinned': len(self._pins),
+                'deleted': self.deleted,
+            }
+
+
+class Retention:
+    """
+    Sweeps a set of folder indexes in the background and on demand
+
+    Args:
+        interval: Seconds between sweeps
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.indexes = {}
+        self.last_sweep = time.time()
+        self._thread = None
+        self._sweep_lock = threading.Lock()
+
+    def add(self, key, index):
+        self.indexes[key] = index
+
+    def sweep(self):
+        """Sweep every folder now"""
+        with self._sweep_lock:
+            self.last_sweep = time.time()
+            return {key: index.sweep() for key, index in self.indexes.items()}
+
+    def maybe_sweep(self):
+        """Sweep if a sweep is overdue or a folder is over its size budget"""
+        overdue = time.time() - self.last_sweep > self.interval
+        if overdue or any(index.over_budget() for index in self.indexes.values()):
+            self.sweep()
+
+    def start(self):
+        """Start the background sweeper thread (once)"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sweep()
@@ -7,6 +7,8 @@ let state = {
     uploadedFilename: null,
     originalFilename: null,
     uploadedImageUrl: null,
+    imageWidth: null,
+    imageHeight: null,
     selectedPreset: null,
     selectedPresetData: null,
     cropper: null,
@@ -18,6 +20,8 @@ let state = {
     image2UploadedFilename: null,
     image2OriginalFilename: null,
     image2ImageUrl: null,
+    image2Width: null,
+    image2Height: null,
     cropper2: null
 };
 
@@ -154,7 +158,10 @@ async function handleFile(file) {
             // Update state with new image
             state.uploadedFilename = data.filename;
             state.originalFilename = data.original_filename;
-            state.uploadedImageUrl = data.url;
+            // Crop on the downscaled preview; crops are mapped back to full size
+            state.uploadedImageUrl = data.preview_url || data.url;
+            state.imageWidth = data.width;
+            state.imageHeight = data.height;
 
             showUploadStatus(`Uploaded successfully! (${data.width} × ${data.height})`, 'success');
 
@@ -223,6 +230,20 @@ function initializeLetterbox() {
     });
 }
 
+// Map a crop box on a displayed preview image to full-resolution pixels
+function fullResolutionCrop(data, image, width, height) {
+    const scaleX = (width || image.naturalWidth) / image.naturalWidth;
+    const scaleY = (height || image.naturalHeight) / image.naturalHeight;
+    const x = Math.round(data.x * scaleX);
+    const y = Math.round(data.y * scaleY);
+    return {
+        x: x,
+        y: y,
+        width: Math.min(Math.round(data.width * scaleX), (width || image.naturalWidth) - x),
+        height: Math.min(Math.round(data.height * scaleY), (height || image.naturalHeight) - y)
+    };
+}
+
 function initializeCropper() {
     // Destroy existing cropper if any
     if (state.cropper) {
@@ -254,7 +275,7 @@ function initializeCropper() {
             cropBoxResizable: true,
             toggleDragModeOnDblclick: false,
             crop: function(event) {
-                updateCropInfo(event.detail);
+                updateCropInfo(fullResolutionCrop(event.detail, cropImage, state.imageWidth, state.imageHeight));
             }
         });
     }
@@ -345,19 +366,14 @@ async function processImage() {
         return;
     }
 
-    // Get crop data
-    const cropData = state.cropper.getData();
+    // Get crop data in full-resolution pixels
+    const cropData = fullResolutionCrop(state.cropper.getData(), cropImage, state.imageWidth, state.imageHeight);
 
     const requestData = {
         filename: state.uploadedFilename,
         original_filename: state.originalFilename,
         preset: state.selectedPreset,
-        crop: {
-            x: Math.round(cropData.x),
-            y: Math.round(cropData.y),
-            width: Math.round(cropData.width),
-            height: Math.round(cropData.height)
-        },
+        crop: cropData,
         letterbox: state.letterboxEnabled
     };
 
@@ -380,8 +396,8 @@ async function processImage() {
             state.suggestedFilename = data.suggested_filename;
             state.downloadUrl = data.download_url;
 
-            // Populate filename input (remove .jpg extension)
-            const nameWithoutExt = data.suggested_filename.replace(/\.jpg$/i, '');
+            // Populate filename input (remove the image extension)
+            const nameWithoutExt = data.suggested_filename.replace(/\.(jpg|webp|avif)$/i, '');
             downloadFilenameInput.value = nameWithoutExt;
 
             showProcessStatus('Processing complete!', 'success');
@@ -436,6 +452,8 @@ function initializeDownload() {
             uploadedFilename: null,
             originalFilename: null,
             uploadedImageUrl: null,
+            imageWidth: null,
+            imageHeight: null,
             selectedPreset: null,
             selectedPresetData: null,
             cropper: null,
@@ -446,6 +464,8 @@ function initializeDownload() {
             image2UploadedFilename: null,
             image2OriginalFilename: null,
             image2ImageUrl: null,
+            image2Width: null,
+            image2Height: null,
             cropper2: null
         };
 
@@ -549,7 +569,9 @@ async function handleFile2(file) {
         if (data.success) {
             state.image2UploadedFilename = data.filename;
             state.image2OriginalFilename = data.original_filename;
-            state.image2ImageUrl = data.url;
+            state.image2ImageUrl = data.preview_url || data.url;
+            state.image2Width = data.width;
+            state.image2Height = data.height;
 
             uploadStatus2.className = 'success';
             uploadStatus2.textContent = `Uploaded successfully! (${data.width} × ${data.height})`;
@@ -568,9 +590,9 @@ async function handleFile2(file) {
 function computeImage2Ratio() {
     if (!state.cropper || !state.selectedPresetData) return null;
 
-    const cropData = state.cropper.getData();
-    const cropW = Math.round(cropData.width);
-    const cropH = Math.round(cropData.height);
+    const cropData = fullResolutionCrop(state.cropper.getData(), cropImage, state.imageWidth, state.imageHeight);
+    const cropW = cropData.width;
+    const cropH = cropData.height;
 
     if (cropW <= 0 || cropH <= 0) return null;
 
@@ -612,7 +634,7 @@ function initializeCropper2() {
             cropBoxResizable: true,
             toggleDragModeOnDblclick: false,
             crop: function(event) {
-                updateCropInfo2(event.detail);
+                updateCropInfo2(fullResolutionCrop(event.detail, cropImage2, state.image2Width, state.image2Height));
             }
         });
     }
@@ -648,6 +670,8 @@ function resetDiptychState() {
     state.image2UploadedFilename = null;
     state.image2OriginalFilename = null;
     state.image2ImageUrl = null;
+    state.image2Width = null;
+    state.image2Height = null;
 
     diptychControls.style.display = 'none';
     diptychUploadSection.style.display = 'none';
@@ -664,8 +688,8 @@ async function processDiptychImage() {
         return;
     }
 
-    const cropData1 = state.cropper.getData();
-    const cropData2 = state.cropper2.getData();
+    const cropData1 = fullResolutionCrop(state.cropper.getData(), cropImage, state.imageWidth, state.imageHeight);
+    const cropData2 = fullResolutionCrop(state.cropper2.getData(), cropImage2, state.image2Width, state.image2Height);
 
     const requestData = {
         filename1: state.uploadedFilename,
@@ -673,18 +697,8 @@ async function processDiptychImage() {
         original_filename1: state.originalFilename,
         original_filename2: state.image2OriginalFilename,
         preset: state.selectedPreset,
-        crop1: {
-            x: Math.round(cropData1.x),
-            y: Math.round(cropData1.y),
-            width: Math.round(cropData1.width),
-            height: Math.round(cropData1.height)
-        },
-        crop2: {
-            x: Math.round(cropData2.x),
-            y: Math.round(cropData2.y),
-            width: Math.round(cropData2.width),
-            height: Math.round(cropData2.height)
-        }
+        crop1: cropData1,
+        crop2: cropData2
     };
 
     processBtn.disabled = true;
@@ -706,7 +720,7 @@ async function processDiptychImage() {
             state.suggestedFilename = data.suggested_filename;
             state.downloadUrl = data.download_url;
 
-            const nameWithoutExt = data.suggested_filename.replace(/\.jpg$/i, '');
+            const nameWithoutExt = data.suggested_filename.replace(/\.(jpg|webp|avif)$/i, '');
             downloadFilenameInput.value = nameWithoutExt;
 
             showProcessStatus('Processing complete!', 'success');
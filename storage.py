@@ -0,0 +1,273 @@
+"""
+Storage backends for uploads and processed outputs
+
+Routes, retention and the result cache only deal in flat names and go
+through a Storage object to read, write, list and delete files:
+
+- LocalStorage keeps files on disk, spread over hash-prefix subdirectories
+  (ab/cd/<name>) so no single directory grows to hundreds of thousands of
+  entries
+- MemoryStorage keeps files in an LRU-bounded dict, for ephemeral
+  deployments and tests; files are served straight from RAM
+
+Backends without local files (MemoryStorage, or an S3-compatible object
+store) return None from local_path(); callers then read through open() and
+write with put_bytes().
+"""
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Temporary files (uploads in progress) live at the top level of the root
+# and start with a dot; the sharded layout never uses such names
+TEMP_PREFIX = '.'
+
+
+def shard_dirs(name, depth):
+    """Return the shard subdirectories for a name, e.g. ['ab', 'cd']"""
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return [digest[2 * i:2 * i + 2] for i in range(depth)]
+
+
+class Storage:
+    """
+    Interface shared by the storage backends
+
+    Subclasses implement exists, size, open, put_bytes, delete and
+    iter_files. Backends that keep files on local disk also return paths
+    from local_path() and temp_path(), which lets files be sent with
+    sendfile and handed to worker processes by path.
+    """
+
+    @staticmethod
+    def valid_name(name):
+        """Names are single path components that are not temporary files"""
+        return bool(name) and not name.startswith(TEMP_PREFIX) \
+            and os.sep not in name and (os.altsep is None or os.altsep not in name)
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def size(self, name):
+        raise NotImplementedError
+
+    def open(self, name):
+        """Open a stored file for reading"""
+        raise NotImplementedError
+
+    def put_bytes(self, name, data):
+        """Store data under name, replacing any existing file"""
+        raise NotImplementedError
+
+    def put_file(self, name, source_path):
+        """Move a finished local file (e.g. a temporary upload) into storage"""
+        with open(source_path, 'rb') as f:
+            self.put_bytes(name, f.read())
+        os.unlink(source_path)
+
+    def delete(self, name):
+        """Delete a stored file; returns False if it did not exist"""
+        raise NotImplementedError
+
+    def iter_files(self):
+        """Yield (name, size, last_access) for every stored file"""
+        raise NotImplementedError
+
+    def local_path(self, name, create=False):
+        """Filesystem path of a stored file, or None if the backend has none"""
+        return None
+
+    def temp_path(self, token):
+        """Local path to stage a file on before put_file(), or None to stage in memory"""
+        return None
+
+    def remove_stale_temp_files(self, max_age):
+        """Delete temporary files older than max_age seconds (crash leftovers)"""
+
+    def migrate(self):
+        """Bring files written by an older layout up to date; returns the count moved"""
+        return 0
+
+
+class LocalStorage(Storage):
+    """
+    Files stored on local disk under a root directory
+
+    Args:
+        root: Directory holding the files
+        shard_depth: Number of two-character hash-prefix directory levels
+                     (0 for a flat layout)
+    """
+
+    def __init__(self, root, shard_depth=2):
+        self.root = root
+        self.shard_depth = shard_depth
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name, create=False):
+        """
+        Return the filesystem path for a name
+
+        With create=True the shard directories are created so the path can
+        be written to.
+        """
+        if not self.valid_name(name):
+            raise ValueError(f'Invalid storage name: {name!r}')
+        directory = os.path.join(self.root, *shard_dirs(name, self.shard_depth))
+        if create:
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    local_path = path
+
+    def exists(self, name):
+        return self.valid_name(name) and os.path.isfile(self.path(name))
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def open(self, name):
+        """Open a stored file for reading"""
+        return open(self.path(name), 'rb')
+
+    def put_bytes(self, name, data):
+        # Write next to the final path and rename so readers never see a
+        # partial file
+        temp_path = self.temp_path(uuid.uuid4().hex)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        self.put_file(name, temp_path)
+
+    def put_file(self, name, source_path):
+        os.replace(source_path, self.path(name, create=True))
+
+    def delete(self, name):
+        try:
+            os.unlink(self.path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def temp_path(self, token):
+        return os.path.join(self.root, f'{TEMP_PREFIX}{token}.part')
+
+    def iter_files(self):
+        for directory, subdirs, files in os.walk(self.root):
+            depth = 0 if directory == self.root else \
+                os.path.relpath(directory, self.root).count(os.sep) + 1
+            if depth >= self.shard_depth:
+                # Files only live at the bottom level
+                subdirs[:] = []
+            if depth != self.shard_depth:
+                continue
+            for name in files:
+                if name.startswith(TEMP_PREFIX):
+                    continue
+                stat = os.stat(os.path.join(directory, name))
+                yield name, stat.st_size, max(stat.st_atime, stat.st_mtime)
+
+    def remove_stale_temp_files(self, max_age):
+        now = time.time()
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.startswith(TEMP_PREFIX) and entry.is_file() \
+                        and now - entry.stat().st_mtime > max_age:
+                    os.unlink(entry.path)
+
+    def migrate(self):
+        """
+        Move files left at the top level (a flat layout) into shard directories
+
+        Returns the number of files moved. Running it again is cheap: only
+        the top-level directory entries are examined when nothing is left
+        to move.
+        """
+        if self.shard_depth == 0:
+            return 0
+
+        moved = 0
+        with os.scandir(self.root) as it:
+            flat = [entry.name for entry in it
+                    if entry.is_file() and self.valid_name(entry.name)]
+        for name in flat:
+            os.replace(os.path.join(self.root, name), self.path(name, create=True))
+            moved += 1
+        return moved
+
+
+class MemoryStorage(Storage):
+    """
+    Files held in memory, evicting the least recently used over a byte budget
+
+    Args:
+        max_bytes: Total size budget (0 for no limit)
+        on_evict: Optional callback receiving each name evicted for space
+    """
+
+    def __init__(self, max_bytes=0, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._files = OrderedDict()  # name -> (data, last_access), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def exists(self, name):
+        with self._lock:
+            return name in self._files
+
+    def size(self, name):
+        with self._lock:
+            return len(self._files[name][0])
+
+    def open(self, name):
+        """Return a file object over the stored bytes, marking them as used"""
+        with self._lock:
+            data, _ = self._files[name]
+            self._files[name] = (data, time.time())
+            self._files.move_to_end(name)
+        return io.BytesIO(data)
+
+    def put_bytes(self, name, data):
+        if not self.valid_name(name):
+            raise ValueError(f'Invalid storage name: {name!r}')
+        evicted = []
+        with self._lock:
+            self._remove(name)
+            self._files[name] = (data, time.time())
+            self._bytes += len(data)
+
+            # Evict least recently used files, never the one just added
+            while self.max_bytes and self._bytes > self.max_bytes and len(self._files) > 1:
+                old_name = next(iter(self._files))
+                self._remove(old_name)
+                evicted.append(old_name)
+
+        if self.on_evict:
+            for old_name in evicted:
+                self.on_evict(old_name)
+
+    def delete(self, name):
+        with self._lock:
+            return self._remove(name)
+
+    def _remove(self, name):
+        """Remove a file (caller holds the lock); returns whether it existed"""
+        entry = self._files.pop(name, None)
+        if entry is None:
+            return False
+        self._bytes -= len(entry[0])
+        return True
+
+    def iter_files(self):
+        with self._lock:
+            entries = [(name, len(data), last_access)
+                       for name, (data, last_access) in self._files.items()]
+        yield from entries
+
+    @property
+    def total_bytes(self):
+        return self._bytes
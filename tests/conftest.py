@@ -1,5 +1,6 @@
 import pytest
 import os
+import shutil
 import sys
 from PIL import Image
 import io
@@ -15,7 +16,8 @@ def app():
     flask_app.config.update({
         'TESTING': True,
         'UPLOAD_FOLDER': 'tests/test_uploads',
-        'PROCESSED_FOLDER': 'tests/test_processed'
+        'PROCESSED_FOLDER': 'tests/test_processed',
+        'JOB_STATE_FOLDER': 'tests/test_jobs'
     })
 
     # Create test directories
@@ -27,12 +29,22 @@ def app():
     # Cleanup test directories
     cleanup_directory(flask_app.config['UPLOAD_FOLDER'])
     cleanup_directory(flask_app.config['PROCESSED_FOLDER'])
+    cleanup_directory(flask_app.config['JOB_STATE_FOLDER'])
 
 @pytest.fixture
 def client(app):
     """Create a test client for the Flask app"""
     return app.test_client()
 
+@pytest.fixture
+def upload_file():
+    """Return a helper that uploads an image and returns its stored filename"""
+    def upload(client, image):
+        data = {'file': (image, 'test.jpg', 'image/jpeg')}
+        response = client.post('/upload', data=data, content_type='multipart/form-data')
+        return response.get_json()['filename']
+    return upload
+
 @pytest.fixture
 def runner(app):
     """Create a test CLI runner"""
@@ -84,9 +96,11 @@ def sample_image_portrait_2():
     return img_bytes
 
 def cleanup_directory(directory):
-    """Remove all files in a directory"""
+    """Remove all files and shard subdirectories in a directory"""
     if os.path.exists(directory):
         for filename in os.listdir(directory):
             file_path = os.path.join(directory, filename)
             if os.path.isfile(file_path):
                 os.unlink(file_path)
+            elif os.path.isdir(file_path):
+                shutil.rmtree(file_path)
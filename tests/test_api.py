@@ -1,8 +1,18 @@
 import pytest
+import hashlib
 import json
 import io
 import os
-from PIL import Image
+import struct
+import threading
+import time
+import zlib
+from PIL import Image, ImageChops
+from werkzeug.test import Client
+import app as app_module
+from budget import MemoryReservations
+from jobs import JobQueue
+from presets import PresetError
 
 class TestIndexRoute:
     """Test the main index page"""
@@ -98,6 +108,112 @@ class TestUploadEndpoint:
         assert json_data['width'] == 2000
         assert json_data['height'] == 1500
 
+    def test_upload_fake_webp(self, client):
+        """A WebP header followed by garbage is rejected, not stored"""
+        header = b'RIFF' + (4000).to_bytes(4, 'little') + b'WEBPVP8X' + (10).to_bytes(4, 'little') \
+            + bytes(4) + (99).to_bytes(3, 'little') + (99).to_bytes(3, 'little')
+        data = {
+            'file': (io.BytesIO(header + os.urandom(4000)), 'fake.webp', 'image/webp')
+        }
+        response = client.post('/upload', data=data, content_type='multipart/form-data')
+
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Invalid image file'
+
+    def test_upload_webp(self, client):
+        """Real WebP uploads still pass the check"""
+        img_bytes = io.BytesIO()
+        Image.new('RGB', (640, 480), color='green').save(img_bytes, format='WEBP')
+        img_bytes.seek(0)
+
+        data = {'file': (img_bytes, 'test.webp', 'image/webp')}
+        response = client.post('/upload', data=data, content_type='multipart/form-data')
+
+        assert response.status_code == 200
+        assert response.get_json()['width'] == 640
+
+
+class TestUploadDeduplication:
+    """Test reuse of identical uploads"""
+
+    def _image_bytes(self, color):
+        """Helper to encode a small JPEG"""
+        img_bytes = io.BytesIO()
+        Image.new('RGB', (320, 240), color=color).save(img_bytes, format='JPEG')
+        return img_bytes.getvalue()
+
+    def _upload(self, client, content, name='test.jpg'):
+        """Helper to upload raw bytes"""
+        data = {'file': (io.BytesIO(content), name, 'image/jpeg')}
+        return client.post('/upload', data=data, content_type='multipart/form-data').get_json()
+
+    def test_same_content_reuses_file(self, client, app):
+        """Uploading identical bytes twice stores a single copy"""
+        content = self._image_bytes((10, 20, 30))
+
+        first = self._upload(client, content, 'first.jpg')
+        second = self._upload(client, content, 'second.jpg')
+
+        assert second['duplicate'] == True
+        assert second['filename'] == first['filename']
+        assert (second['width'], second['height']) == (320, 240)
+        assert second['original_filename'] == 'second.jpg'
+        stored = [name for name, _, _ in app_module.get_storage('uploads').iter_files()]
+        assert stored == [first['filename']]
+
+    def test_different_content_stored_separately(self, client):
+        """Different bytes produce separate uploads"""
+        first = self._upload(client, self._image_bytes((10, 20, 30)))
+        second = self._upload(client, self._image_bytes((200, 20, 30)))
+
+        assert 'duplicate' not in second
+        assert second['filename'] != first['filename']
+
+    def test_reupload_after_removal(self, client, app):
+        """A removed upload is stored again instead of being reused"""
+        content = self._image_bytes((40, 50, 60))
+        first = self._upload(client, content)
+        app_module.get_storage('uploads').delete(first['filename'])
+
+        second = self._upload(client, content)
+        assert 'duplicate' not in second
+        assert client.get(second['url']).status_code == 200
+
+class TestStreamingUpload:
+    """Test single-pass upload validation"""
+
+    def test_rejects_too_many_pixels(self, client, app, monkeypatch):
+        """Images over MAX_IMAGE_PIXELS are rejected from the header"""
+        monkeypatch.setitem(app.config, 'MAX_IMAGE_PIXELS', 1_000_000)
+        img_bytes = io.BytesIO()
+        Image.new('RGB', (2000, 1000)).save(img_bytes, format='PNG')
+        img_bytes.seek(0)
+
+        data = {'file': (img_bytes, 'big.png', 'image/png')}
+        response = client.post('/upload', data=data, content_type='multipart/form-data')
+
+        assert response.status_code == 413
+        assert 'limit' in response.get_json()['error']
+        assert [f for _, _, files in os.walk(app.config['UPLOAD_FOLDER']) for f in files] == []
+
+    def test_rejects_non_image(self, client, app):
+        """Files that are not images are rejected and not kept"""
+        data = {'file': (io.BytesIO(b'not really a jpeg'), 'fake.jpg', 'image/jpeg')}
+        response = client.post('/upload', data=data, content_type='multipart/form-data')
+
+        assert response.status_code == 400
+        assert [f for _, _, files in os.walk(app.config['UPLOAD_FOLDER']) for f in files] == []
+
+    def test_webp_dimensions_from_header(self, client):
+        """WebP dimensions are read from the RIFF header"""
+        img_bytes = io.BytesIO()
+        Image.new('RGB', (321, 123), color='blue').save(img_bytes, format='WEBP')
+        img_bytes.seek(0)
+
+        data = {'file': (img_bytes, 'test.webp', 'image/webp')}
+        json_data = client.post('/upload', data=data, content_type='multipart/form-data').get_json()
+
+        assert (json_data['width'], json_data['height']) == (321, 123)
 
 class TestProcessEndpoint:
     """Test the /process endpoint"""
@@ -134,7 +250,7 @@ class TestProcessEndpoint:
         assert 'download_url' in json_data
 
         # Verify the processed file exists and has correct dimensions
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], json_data['filename'])
+        processed_path = app_module.get_storage('processed').path(json_data['filename'])
         assert os.path.exists(processed_path)
 
         with Image.open(processed_path) as img:
@@ -170,7 +286,7 @@ class TestProcessEndpoint:
         assert json_data['success'] == True
 
         # Verify the processed file
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], json_data['filename'])
+        processed_path = app_module.get_storage('processed').path(json_data['filename'])
         assert os.path.exists(processed_path)
 
         with Image.open(processed_path) as img:
@@ -259,10 +375,56 @@ class TestProcessEndpoint:
         assert json_data['success'] == True
 
         # Verify upscaled correctly
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], json_data['filename'])
+        processed_path = app_module.get_storage('processed').path(json_data['filename'])
         with Image.open(processed_path) as img:
             assert img.size == (3840, 2160)
 
+    def test_process_progressive_resampling(self, client, sample_image):
+        """Requests can pick the progressive resampling method"""
+        data = {'file': (sample_image, 'test.jpg', 'image/jpeg')}
+        filename = client.post('/upload', data=data, content_type='multipart/form-data').get_json()['filename']
+
+        process_data = {
+            'filename': filename,
+            'preset': '4k',
+            'crop': {'x': 0, 'y': 0, 'width': 400, 'height': 225},
+            'resampling': 'progressive'
+        }
+        response = client.post('/process?inline=1',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.data)).size == (3840, 2160)
+
+        process_data['resampling'] = 'nearest'
+        response = client.post('/process',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+        assert response.status_code == 400
+
+    def test_process_encode_profile(self, client, sample_image):
+        """Requests can pick an encode profile; unknown ones are rejected"""
+        data = {'file': (sample_image, 'test.jpg', 'image/jpeg')}
+        filename = client.post('/upload', data=data, content_type='multipart/form-data').get_json()['filename']
+
+        process_data = {
+            'filename': filename,
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            'encode_profile': 'archival'
+        }
+        response = client.post('/process?inline=1',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.data)).info.get('progressive')
+
+        process_data['encode_profile'] = 'lossless'
+        response = client.post('/process',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+        assert response.status_code == 400
+
 
 class TestProcessLetterbox:
     """Test the /process endpoint with letterbox flag"""
@@ -298,7 +460,7 @@ class TestProcessLetterbox:
         assert json_data['success'] == True
 
         # Verify the processed file has correct dimensions
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], json_data['filename'])
+        processed_path = app_module.get_storage('processed').path(json_data['filename'])
         with Image.open(processed_path) as img:
             assert img.size == (3840, 2160)
             # Square crop letterboxed to 16:9 should have black bars on sides
@@ -331,7 +493,7 @@ class TestProcessLetterbox:
         json_data = response.get_json()
         assert json_data['success'] == True
 
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], json_data['filename'])
+        processed_path = app_module.get_storage('processed').path(json_data['filename'])
         with Image.open(processed_path) as img:
             assert img.size == (1920, 1080)
             # Without letterbox, corners should have image content (stretched)
@@ -412,7 +574,7 @@ class TestProcessDiptychEndpoint:
         assert 'suggested_filename' in json_data
 
         # Verify output dimensions
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], json_data['filename'])
+        processed_path = app_module.get_storage('processed').path(json_data['filename'])
         with Image.open(processed_path) as img:
             assert img.size == (3840, 2160)
 
@@ -438,7 +600,7 @@ class TestProcessDiptychEndpoint:
         json_data = response.get_json()
         assert json_data['success'] == True
 
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], json_data['filename'])
+        processed_path = app_module.get_storage('processed').path(json_data['filename'])
         with Image.open(processed_path) as img:
             assert img.size == (1920, 1080)
 
@@ -506,6 +668,30 @@ class TestProcessDiptychEndpoint:
         json_data = response.get_json()
         assert json_data['suggested_filename'] == 'portrait1_portrait2_pair_4k.jpg'
 
+    def test_diptych_palette_images(self, client, upload_file):
+        """Palette PNG panels are resized in true colour, like the same images in RGB"""
+        noise = Image.effect_noise((400, 900), 60).convert('RGB')
+        outputs = []
+        for img in (noise.quantize(16), noise.quantize(16).convert('RGB')):
+            filenames = []
+            for _ in range(2):
+                buffer = io.BytesIO()
+                img.save(buffer, 'PNG')
+                buffer.seek(0)
+                filenames.append(upload_file(client, buffer))
+            response = client.post('/process-diptych', data=json.dumps({
+                'filename1': filenames[0],
+                'filename2': filenames[1],
+                'preset': 'fhd',
+                'crop1': {'x': 0, 'y': 0, 'width': 400, 'height': 900},
+                'crop2': {'x': 0, 'y': 100, 'width': 400, 'height': 800}
+            }), content_type='application/json')
+            assert response.status_code == 200
+            outputs.append(Image.open(io.BytesIO(client.get(response.get_json()['download_url']).data)).convert('RGB'))
+
+        difference = ImageChops.difference(*outputs).convert('L')
+        assert sum(difference.getdata()) / (difference.width * difference.height) < 1
+
 
 class TestUploadedFileEndpoint:
     """Test the /uploads/<filename> endpoint"""
@@ -525,3 +711,1153 @@ class TestUploadedFileEndpoint:
 
         assert response.status_code == 200
         assert len(response.data) > 0
+
+
+class TestHttpCaching:
+    """Test ETags, Cache-Control, conditional and range requests on stored files"""
+
+    def _process(self, client, filename):
+        """Helper to process an upload and return the output filename"""
+        process_data = {
+            'filename': filename,
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+        }
+        response = client.post('/process', data=json.dumps(process_data), content_type='application/json')
+        return response.get_json()['filename']
+
+    def test_upload_etag_and_cache_control(self, client, sample_image, upload_file):
+        """Uploads carry a content-hash ETag and are cacheable for a year"""
+        content = sample_image.getvalue()
+        filename = upload_file(client, sample_image)
+
+        response = client.get(f'/uploads/{filename}')
+        assert response.status_code == 200
+        assert response.headers['ETag'] == f'"{hashlib.sha256(content).hexdigest()}"'
+        cache_control = response.headers['Cache-Control']
+        assert 'immutable' in cache_control
+        assert 'public' in cache_control
+        assert 'max-age=31536000' in cache_control
+
+    def test_if_none_match_returns_304(self, client, sample_image, upload_file):
+        """Revalidating with a matching ETag transfers no body"""
+        filename = upload_file(client, sample_image)
+        etag = client.get(f'/uploads/{filename}').headers['ETag']
+
+        response = client.get(f'/uploads/{filename}', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+        output = self._process(client, filename)
+        etag = client.get(f'/download/{output}').headers['ETag']
+        assert client.get(f'/download/{output}', headers={'If-None-Match': etag}).status_code == 304
+
+    def test_range_requests(self, client, sample_image, upload_file):
+        """Downloads can be resumed with Range, guarded by If-Range"""
+        output = self._process(client, upload_file(client, sample_image))
+        full = client.get(f'/download/{output}')
+        assert full.headers['Accept-Ranges'] == 'bytes'
+
+        response = client.get(f'/download/{output}', headers={'Range': 'bytes=100-'})
+        assert response.status_code == 206
+        assert response.data == full.data[100:]
+        assert response.headers['Content-Range'] == f'bytes 100-{len(full.data) - 1}/{len(full.data)}'
+
+        stale = client.get(f'/download/{output}', headers={'Range': 'bytes=100-', 'If-Range': '"other"'})
+        assert stale.status_code == 200
+        assert stale.data == full.data
+
+        resumed = client.get(f'/download/{output}',
+                             headers={'Range': 'bytes=100-', 'If-Range': full.headers['ETag']})
+        assert resumed.status_code == 206
+
+    def test_memory_backend_ranges(self, client, sample_image, app, monkeypatch, upload_file):
+        """Files served from memory support ETags and ranges too"""
+        monkeypatch.setitem(app.config, 'STORAGE_BACKEND', 'memory')
+        monkeypatch.setattr(app_module, 'storages', {})
+        monkeypatch.setattr(app_module, 'retention', None)
+        monkeypatch.setattr(app_module, 'result_cache', None)
+        content = sample_image.getvalue()
+        filename = upload_file(client, sample_image)
+
+        response = client.get(f'/uploads/{filename}', headers={'Range': 'bytes=0-99'})
+        assert response.status_code == 206
+        assert response.data == content[:100]
+        assert response.headers['ETag'] == f'"{hashlib.sha256(content).hexdigest()}"'
+
+    def test_max_age_zero_revalidates(self, client, sample_image, app, monkeypatch, upload_file):
+        """With FILE_CACHE_MAX_AGE 0 files are not marked immutable"""
+        monkeypatch.setitem(app.config, 'FILE_CACHE_MAX_AGE', 0)
+        filename = upload_file(client, sample_image)
+
+        response = client.get(f'/uploads/{filename}')
+        assert 'immutable' not in response.headers['Cache-Control']
+        assert 'ETag' in response.headers
+
+
+class StubProxy:
+    """
+    Stand-in for nginx / Apache in front of the app
+
+    Replaces the body of responses carrying X-Sendfile or X-Accel-Redirect
+    with the named file, mapping internal locations to folders the way an
+    nginx 'internal' location with an alias does.
+    """
+
+    def __init__(self, app, locations, sendfile_type=None):
+        self.app = app
+        self.locations = locations
+        self.sendfile_type = sendfile_type
+
+    def __call__(self, environ, start_response):
+        if self.sendfile_type:
+            environ = dict(environ, HTTP_X_SENDFILE_TYPE=self.sendfile_type)
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured.update(status=status, headers=headers)
+
+        upstream = self.app(environ, capture)
+        try:
+            body = b''.join(upstream)
+        finally:
+            getattr(upstream, 'close', lambda: None)()
+
+        headers = dict(captured['headers'])
+        path = headers.pop('X-Sendfile', None)
+        redirect = headers.pop('X-Accel-Redirect', None)
+        if redirect:
+            prefix = next(prefix for prefix in self.locations if redirect.startswith(prefix))
+            path = os.path.join(self.locations[prefix], redirect[len(prefix):])
+        if path:
+            with open(path, 'rb') as f:
+                body = f.read()
+            headers['Content-Length'] = str(len(body))
+        start_response(captured['status'], list(headers.items()))
+        return [body]
+
+
+class TestFileOffload:
+    """Test handing file sends to a front proxy with FILE_OFFLOAD"""
+
+    def _proxy(self, app, sendfile_type=None):
+        """Helper to build a client that talks to the app through StubProxy"""
+        locations = {
+            '/protected/uploads/': app.config['UPLOAD_FOLDER'],
+            '/protected/processed/': app.config['PROCESSED_FOLDER'],
+        }
+        return Client(StubProxy(app, locations, sendfile_type))
+
+    def test_accel_redirect(self, client, sample_image, app, monkeypatch, upload_file):
+        """With x-accel-redirect the app sends headers only and the proxy the bytes"""
+        monkeypatch.setitem(app.config, 'FILE_OFFLOAD', 'x-accel-redirect')
+        content = sample_image.getvalue()
+        filename = upload_file(client, sample_image)
+
+        response = client.get(f'/uploads/{filename}')
+        assert response.status_code == 200
+        assert response.data == b''
+        assert response.headers['X-Accel-Redirect'].startswith('/protected/uploads/')
+        assert response.headers['X-Accel-Redirect'].endswith(filename)
+        assert response.headers['ETag'] == f'"{hashlib.sha256(content).hexdigest()}"'
+        assert 'immutable' in response.headers['Cache-Control']
+
+        proxied = self._proxy(app).get(f'/uploads/{filename}')
+        assert proxied.status_code == 200
+        assert proxied.data == content
+        assert proxied.headers['Content-Type'] == 'image/jpeg'
+
+    def test_sendfile_download(self, client, sample_image, app, monkeypatch, upload_file):
+        """x-sendfile names the absolute path and keeps the attachment headers"""
+        filename = upload_file(client, sample_image)
+        process_data = {'filename': filename, 'preset': 'fhd', 'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}}
+        output = client.post('/process', data=json.dumps(process_data),
+                             content_type='application/json').get_json()['filename']
+        streamed = client.get(f'/download/{output}')
+
+        monkeypatch.setitem(app.config, 'FILE_OFFLOAD', 'x-sendfile')
+        response = client.get(f'/download/{output}')
+        assert response.data == b''
+        assert os.path.isabs(response.headers['X-Sendfile'])
+
+        proxied = self._proxy(app).get(f'/download/{output}')
+        assert proxied.data == streamed.data
+        assert proxied.headers['Content-Disposition'] == streamed.headers['Content-Disposition']
+
+    def test_not_modified_is_not_offloaded(self, client, sample_image, app, monkeypatch, upload_file):
+        """A 304 carries no offload header, so the proxy sends no body"""
+        monkeypatch.setitem(app.config, 'FILE_OFFLOAD', 'x-accel-redirect')
+        filename = upload_file(client, sample_image)
+        etag = client.get(f'/uploads/{filename}').headers['ETag']
+
+        response = client.get(f'/uploads/{filename}', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert 'X-Accel-Redirect' not in response.headers
+
+    def test_auto_follows_proxy_header(self, client, sample_image, app, monkeypatch, upload_file):
+        """In auto mode requests without X-Sendfile-Type are streamed directly"""
+        monkeypatch.setitem(app.config, 'FILE_OFFLOAD', 'auto')
+        content = sample_image.getvalue()
+        filename = upload_file(client, sample_image)
+
+        direct = client.get(f'/uploads/{filename}')
+        assert direct.data == content
+        assert 'X-Accel-Redirect' not in direct.headers
+
+        offloaded = client.get(f'/uploads/{filename}', headers={'X-Sendfile-Type': 'X-Accel-Redirect'})
+        assert offloaded.data == b''
+        assert 'X-Accel-Redirect' in offloaded.headers
+
+        proxied = self._proxy(app, sendfile_type='X-Accel-Redirect').get(f'/uploads/{filename}')
+        assert proxied.data == content
+
+    def test_auto_never_sends_absolute_paths(self, client, sample_image, app, monkeypatch, upload_file):
+        """A client asking for X-Sendfile in auto mode gets the file, not its path"""
+        monkeypatch.setitem(app.config, 'FILE_OFFLOAD', 'auto')
+        content = sample_image.getvalue()
+        filename = upload_file(client, sample_image)
+
+        response = client.get(f'/uploads/{filename}', headers={'X-Sendfile-Type': 'X-Sendfile'})
+        assert response.data == content
+        assert 'X-Sendfile' not in response.headers
+
+    def test_memory_backend_streams(self, client, sample_image, app, monkeypatch, upload_file):
+        """Backends without local files fall back to streaming"""
+        monkeypatch.setitem(app.config, 'FILE_OFFLOAD', 'x-sendfile')
+        monkeypatch.setitem(app.config, 'STORAGE_BACKEND', 'memory')
+        monkeypatch.setattr(app_module, 'storages', {})
+        monkeypatch.setattr(app_module, 'retention', None)
+        monkeypatch.setattr(app_module, 'result_cache', None)
+        content = sample_image.getvalue()
+        filename = upload_file(client, sample_image)
+
+        response = client.get(f'/uploads/{filename}')
+        assert response.data == content
+        assert 'X-Sendfile' not in response.headers
+
+
+class TestAsyncJobs:
+    """Test background processing through /jobs/<id>"""
+
+    def _wait_for_job(self, client, status_url, timeout=30):
+        """Poll a job until it finishes"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = client.get(status_url).get_json()
+            if status['status'] in ('done', 'failed'):
+                return status
+            time.sleep(0.05)
+        raise AssertionError('Job did not finish in time')
+
+    def test_async_process_returns_job(self, client, sample_image, app, upload_file):
+        """Async processing returns a job id right away and completes in a worker"""
+        filename = upload_file(client, sample_image)
+
+        process_data = {
+            'filename': filename,
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            'async': True
+        }
+        response = client.post('/process',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+
+        assert response.status_code == 202
+        json_data = response.get_json()
+        assert 'job_id' in json_data
+
+        status = self._wait_for_job(client, json_data['status_url'])
+        assert status['status'] == 'done'
+        assert status['progress'] == 1.0
+
+        download_response = client.get(status['download_url'])
+        assert download_response.status_code == 200
+
+        processed_path = app_module.get_storage('processed').path(status['filename'])
+        with Image.open(processed_path) as img:
+            assert img.size == (1920, 1080)
+
+    def test_async_diptych(self, client, sample_image_portrait, sample_image_portrait_2, app, upload_file):
+        """Diptych requests can run as background jobs"""
+        filename1 = upload_file(client, sample_image_portrait)
+        filename2 = upload_file(client, sample_image_portrait_2)
+
+        process_data = {
+            'filename1': filename1,
+            'filename2': filename2,
+            'preset': 'fhd',
+            'crop1': {'x': 0, 'y': 0, 'width': 400, 'height': 900},
+            'crop2': {'x': 0, 'y': 0, 'width': 500, 'height': 800}
+        }
+        response = client.post('/process-diptych?async=1',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+
+        assert response.status_code == 202
+        status = self._wait_for_job(client, response.get_json()['status_url'])
+        assert status['status'] == 'done'
+        assert status['suggested_filename'] == 'image1_image2_pair_fhd.jpg'
+
+    def test_queue_full_returns_429(self, client, sample_image, monkeypatch, upload_file):
+        """A full queue rejects new jobs with 429"""
+        filename = upload_file(client, sample_image)
+        monkeypatch.setattr(app_module, 'job_queue', JobQueue(max_pending=0, executor='thread'))
+
+        process_data = {
+            'filename': filename,
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            'async': True
+        }
+        response = client.post('/process',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+
+        assert response.status_code == 429
+        assert 'Retry-After' in response.headers
+
+    def test_unknown_job(self, client):
+        """Unknown job ids return 404"""
+        response = client.get('/jobs/does-not-exist')
+        assert response.status_code == 404
+
+
+class TestResultCache:
+    """Test reuse of processed outputs for repeated requests"""
+
+    def _process(self, client, filename, preset='fhd', letterbox=False, resampling='single',
+                 encode_profile='balanced'):
+        """Helper to post a /process request"""
+        process_data = {
+            'filename': filename,
+            'preset': preset,
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            'letterbox': letterbox,
+            'resampling': resampling,
+            'encode_profile': encode_profile
+        }
+        return client.post('/process',
+                           data=json.dumps(process_data),
+                           content_type='application/json').get_json()
+
+    def test_repeat_request_hits_cache(self, client, sample_image, app, upload_file):
+        """The same crop and preset returns the existing output"""
+        filename = upload_file(client, sample_image)
+
+        first = self._process(client, filename)
+        second = self._process(client, filename)
+
+        assert 'cached' not in first
+        assert second['cached'] == True
+        assert second['filename'] == first['filename']
+        assert os.path.exists(app_module.get_storage('processed').path(second['filename']))
+
+    def test_different_parameters_miss(self, client, sample_image, upload_file):
+        """Changing preset, letterbox, resampling or encode profile produces a new output"""
+        filename = upload_file(client, sample_image)
+
+        base = self._process(client, filename)
+        other_preset = self._process(client, filename, preset='4k')
+        letterboxed = self._process(client, filename, letterbox=True)
+        progressive = self._process(client, filename, resampling='progressive')
+        fast = self._process(client, filename, encode_profile='fast')
+
+        assert len({base['filename'], other_preset['filename'], letterboxed['filename'],
+                    progressive['filename'], fast['filename']}) == 5
+
+    def test_cache_stats_endpoint(self, client, sample_image, upload_file):
+        """Hit and miss counters are exposed"""
+        filename = upload_file(client, sample_image)
+        before = client.get('/cache/stats').get_json()
+
+        self._process(client, filename, preset='4k', letterbox=True)
+        self._process(client, filename, preset='4k', letterbox=True)
+
+        after = client.get('/cache/stats').get_json()
+        assert after['hits'] == before['hits'] + 1
+        assert after['misses'] == before['misses'] + 1
+
+
+class TestRetention:
+    """Test retention of processed outputs"""
+
+    def test_processed_folder_budget(self, client, app, monkeypatch):
+        """Older outputs are removed once the folder exceeds its budget"""
+        monkeypatch.setitem(app.config, 'PROCESSED_FOLDER_MAX_BYTES', 1)
+        monkeypatch.setitem(app.config, 'RESULT_CACHE_MAX_BYTES', 0)
+        monkeypatch.setattr(app_module, 'retention', None)
+
+        filenames = []
+        for color in ('red', 'green'):
+            img_bytes = io.BytesIO()
+            Image.new('RGB', (320, 180), color=color).save(img_bytes, format='JPEG')
+            img_bytes.seek(0)
+            data = {'file': (img_bytes, 'test.jpg', 'image/jpeg')}
+            upload = client.post('/upload', data=data, content_type='multipart/form-data').get_json()
+
+            process_data = {
+                'filename': upload['filename'],
+                'preset': 'fhd',
+                'crop': {'x': 0, 'y': 0, 'width': 320, 'height': 180}
+            }
+            response = client.post('/process',
+                                   data=json.dumps(process_data),
+                                   content_type='application/json')
+            filenames.append(response.get_json()['filename'])
+
+        processed = [name for name, _, _ in app_module.get_storage('processed').iter_files()]
+        assert filenames[0] not in processed
+        assert filenames[1] in processed
+
+        stats = client.get('/retention/stats').get_json()
+        assert stats['processed']['deleted'] >= 1
+
+
+class TestShardedStorage:
+    """Test the sharded layout behind the file routes"""
+
+    def test_flat_files_migrated_on_startup(self, client, app, monkeypatch):
+        """Files left in a flat upload folder are still served after migration"""
+        flat_path = os.path.join(app.config['UPLOAD_FOLDER'], 'legacy_test.jpg')
+        Image.new('RGB', (64, 64), color='red').save(flat_path)
+        monkeypatch.setattr(app_module, 'storages', {})
+        monkeypatch.setattr(app_module, 'retention', None)
+
+        response = client.get('/uploads/legacy_test.jpg')
+
+        assert response.status_code == 200
+        assert not os.path.exists(flat_path)
+        assert os.path.exists(app_module.get_storage('uploads').path('legacy_test.jpg'))
+
+    def test_unknown_upload_is_404(self, client):
+        """Missing uploads return 404 rather than an error page"""
+        response = client.get('/uploads/does_not_exist.jpg')
+        assert response.status_code == 404
+
+
+class TestMemoryStorage:
+    """Test the app running on the in-memory storage backend"""
+
+    @pytest.fixture(autouse=True)
+    def memory_backend(self, app, monkeypatch):
+        """Switch to fresh in-memory storage for each test"""
+        monkeypatch.setitem(app.config, 'STORAGE_BACKEND', 'memory')
+        monkeypatch.setattr(app_module, 'storages', {})
+        monkeypatch.setattr(app_module, 'retention', None)
+        monkeypatch.setattr(app_module, 'result_cache', None)
+
+    def test_upload_process_download(self, client, sample_image, app):
+        """The full workflow runs without writing to the upload or output folders"""
+        data = {'file': (sample_image, 'test.jpg', 'image/jpeg')}
+        upload = client.post('/upload', data=data, content_type='multipart/form-data').get_json()
+
+        assert client.get(upload['url']).status_code == 200
+
+        process_data = {
+            'filename': upload['filename'],
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+        }
+        result = client.post('/process',
+                             data=json.dumps(process_data),
+                             content_type='application/json').get_json()
+
+        response = client.get(result['download_url'])
+        assert response.status_code == 200
+        img = Image.open(io.BytesIO(response.data))
+        assert img.size == (1920, 1080)
+
+        assert os.listdir(app.config['UPLOAD_FOLDER']) == []
+        assert os.listdir(app.config['PROCESSED_FOLDER']) == []
+
+    def test_async_job_stores_output(self, client, sample_image, monkeypatch):
+        """Background jobs hand their output back to the in-memory store"""
+        monkeypatch.setattr(app_module, 'job_queue', JobQueue(executor='thread'))
+        data = {'file': (sample_image, 'test.jpg', 'image/jpeg')}
+        upload = client.post('/upload', data=data, content_type='multipart/form-data').get_json()
+
+        process_data = {
+            'filename': upload['filename'],
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            'async': True
+        }
+        job = client.post('/process',
+                          data=json.dumps(process_data),
+                          content_type='application/json').get_json()
+
+        for _ in range(100):
+            status = client.get(job['status_url']).get_json()
+            if status['status'] in ('done', 'failed'):
+                break
+            time.sleep(0.05)
+
+        assert status['status'] == 'done'
+        assert app_module.get_storage('processed').exists(status['filename'])
+        assert client.get(status['download_url']).status_code == 200
+
+
+class TestInlineProcessing:
+    """Test /process?inline=1, which returns the image in the response"""
+
+    def test_inline_process_returns_image(self, client, sample_image, app, upload_file):
+        """The encoded image is streamed back and nothing is stored"""
+        filename = upload_file(client, sample_image)
+        process_data = {
+            'filename': filename,
+            'original_filename': 'holiday.jpg',
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+        }
+        response = client.post('/process?inline=1',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+
+        assert response.status_code == 200
+        assert response.mimetype == 'image/jpeg'
+        assert 'holiday_fhd.jpg' in response.headers['Content-Disposition']
+        img = Image.open(io.BytesIO(response.data))
+        assert img.size == (1920, 1080)
+        assert list(app_module.get_storage('processed').iter_files()) == []
+
+    def test_inline_diptych(self, client, sample_image_portrait, sample_image_portrait_2, upload_file):
+        """Diptychs can be returned inline via the JSON body flag"""
+        filename1 = upload_file(client, sample_image_portrait)
+        filename2 = upload_file(client, sample_image_portrait_2)
+        process_data = {
+            'filename1': filename1,
+            'filename2': filename2,
+            'preset': 'fhd',
+            'crop1': {'x': 0, 'y': 0, 'width': 400, 'height': 900},
+            'crop2': {'x': 0, 'y': 0, 'width': 500, 'height': 800},
+            'inline': True
+        }
+        response = client.post('/process-diptych',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+
+        assert response.status_code == 200
+        img = Image.open(io.BytesIO(response.data))
+        assert img.size == (1920, 1080)
+
+    def test_inline_serves_cached_output(self, client, sample_image, upload_file):
+        """A cached output is sent inline without reprocessing"""
+        filename = upload_file(client, sample_image)
+        process_data = {
+            'filename': filename,
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+        }
+        stored = client.post('/process',
+                             data=json.dumps(process_data),
+                             content_type='application/json').get_json()
+        downloaded = client.get(stored['download_url']).data
+
+        response = client.post('/process?inline=1',
+                               data=json.dumps(process_data),
+                               content_type='application/json')
+
+        assert response.status_code == 200
+        assert response.data == downloaded
+
+
+class TestBatchProcessing:
+    """Test the /process-batch endpoint"""
+
+    def _batch(self, client, payload):
+        """Helper to post a /process-batch request"""
+        return client.post('/process-batch',
+                           data=json.dumps(payload),
+                           content_type='application/json')
+
+    def test_batch_returns_entry_per_spec(self, client, sample_image, upload_file):
+        """4K and FHD of the same crop plus a second crop in one request"""
+        filename = upload_file(client, sample_image)
+        crop = {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+        response = self._batch(client, {
+            'filename': filename,
+            'original_filename': 'photo.jpg',
+            'specs': [
+                {'crop': crop, 'preset': '4k'},
+                {'crop': crop, 'preset': 'fhd'},
+                {'crop': {'x': 0, 'y': 150, 'width': 800, 'height': 450}, 'preset': 'fhd', 'letterbox': True},
+            ]
+        })
+
+        assert response.status_code == 200
+        results = response.get_json()['results']
+        assert [r['suggested_filename'] for r in results] == ['photo_4k.jpg', 'photo_fhd.jpg', 'photo_fhd_2.jpg']
+
+        for result, size in zip(results, [(3840, 2160), (1920, 1080), (1920, 1080)]):
+            download = client.get(result['download_url'])
+            assert download.status_code == 200
+            assert Image.open(io.BytesIO(download.data)).size == size
+
+    def test_batch_shares_cache_with_process(self, client, sample_image, upload_file):
+        """Outputs already produced by /process are reused"""
+        filename = upload_file(client, sample_image)
+        crop = {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+        single = client.post('/process',
+                             data=json.dumps({'filename': filename, 'preset': 'fhd', 'crop': crop}),
+                             content_type='application/json').get_json()
+
+        results = self._batch(client, {
+            'filename': filename,
+            'specs': [{'crop': crop, 'preset': 'fhd'}, {'crop': crop, 'preset': '4k'}]
+        }).get_json()['results']
+
+        assert results[0]['cached'] == True
+        assert results[0]['filename'] == single['filename']
+        assert 'cached' not in results[1]
+
+    def test_batch_palette_image(self, client, upload_file):
+        """Palette PNGs are resized in true colour, like the same image in RGB"""
+        noise = Image.effect_noise((800, 600), 60).convert('RGB')
+        outputs = []
+        for img in (noise.quantize(16), noise.quantize(16).convert('RGB')):
+            buffer = io.BytesIO()
+            img.save(buffer, 'PNG')
+            buffer.seek(0)
+            response = self._batch(client, {
+                'filename': upload_file(client, buffer),
+                'specs': [
+                    {'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}, 'preset': 'fhd'},
+                    {'crop': {'x': 0, 'y': 0, 'width': 600, 'height': 600}, 'preset': 'fhd', 'letterbox': True}
+                ]
+            })
+            assert response.status_code == 200
+            outputs.append([Image.open(io.BytesIO(client.get(entry['download_url']).data)).convert('RGB')
+                            for entry in response.get_json()['results']])
+
+        for palette, rgb in zip(*outputs):
+            difference = ImageChops.difference(palette, rgb).convert('L')
+            assert sum(difference.getdata()) / (difference.width * difference.height) < 1
+
+    def test_batch_invalid_requests(self, client, sample_image, app, upload_file):
+        """Bad presets, empty or oversized spec lists and unknown files are rejected"""
+        filename = upload_file(client, sample_image)
+        crop = {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+
+        assert self._batch(client, {'filename': filename, 'specs': []}).status_code == 400
+        assert self._batch(client, {'filename': filename,
+                                    'specs': [{'crop': crop, 'preset': '8k'}]}).status_code == 400
+        too_many = [{'crop': crop, 'preset': 'fhd'}] * (app.config['BATCH_MAX_SPECS'] + 1)
+        assert self._batch(client, {'filename': filename, 'specs': too_many}).status_code == 400
+        assert self._batch(client, {'filename': 'missing.jpg',
+                                    'specs': [{'crop': crop, 'preset': 'fhd'}]}).status_code == 404
+
+    def test_async_batch(self, client, sample_image, monkeypatch, upload_file):
+        """Batches can run as a background job"""
+        monkeypatch.setattr(app_module, 'job_queue', JobQueue(executor='thread'))
+        filename = upload_file(client, sample_image)
+        response = self._batch(client, {
+            'filename': filename,
+            'async': True,
+            'specs': [{'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}, 'preset': 'fhd'}]
+        })
+        assert response.status_code == 202
+
+        status_url = response.get_json()['status_url']
+        for _ in range(100):
+            status = client.get(status_url).get_json()
+            if status['status'] in ('done', 'failed'):
+                break
+            time.sleep(0.05)
+
+        assert status['status'] == 'done'
+        assert client.get(status['results'][0]['download_url']).status_code == 200
+
+
+class TestOutputFormats:
+    """Test WebP/AVIF output format selection"""
+
+    def _process_data(self, filename, **extra):
+        """Helper to build a /process body"""
+        return {
+            'filename': filename,
+            'original_filename': 'photo.jpg',
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            **extra
+        }
+
+    def test_webp_output_filenames(self, client, sample_image, upload_file):
+        """Stored, suggested and download names follow the format"""
+        filename = upload_file(client, sample_image)
+        result = client.post('/process',
+                             data=json.dumps(self._process_data(filename, format='webp')),
+                             content_type='application/json').get_json()
+
+        assert result['filename'].endswith('.webp')
+        assert result['suggested_filename'] == 'photo_fhd.webp'
+
+        response = client.get(f"{result['download_url']}?name=living_room")
+        assert response.status_code == 200
+        assert response.mimetype == 'image/webp'
+        assert 'living_room.webp' in response.headers['Content-Disposition']
+        assert Image.open(io.BytesIO(response.data)).format == 'WEBP'
+
+    def test_inline_accept_negotiation(self, client, sample_image, upload_file):
+        """Inline requests without a format get the type the client prefers"""
+        filename = upload_file(client, sample_image)
+        response = client.post('/process?inline=1',
+                               data=json.dumps(self._process_data(filename)),
+                               content_type='application/json',
+                               headers={'Accept': 'image/webp,image/*;q=0.8'})
+
+        assert response.status_code == 200
+        assert response.mimetype == 'image/webp'
+        assert 'Accept' in response.headers['Vary']
+
+        # Served from the result cache the second time
+        again = client.post('/process?inline=1',
+                            data=json.dumps(self._process_data(filename)),
+                            content_type='application/json',
+                            headers={'Accept': 'image/webp,image/*;q=0.8'})
+        assert 'Accept' in again.headers['Vary']
+
+        explicit = client.post('/process?inline=1',
+                               data=json.dumps(self._process_data(filename, format='webp')),
+                               content_type='application/json',
+                               headers={'Accept': 'image/webp,image/*;q=0.8'})
+        assert 'Accept' not in explicit.headers.get('Vary', '')
+
+    def test_default_stays_jpeg(self, client, sample_image, upload_file):
+        """Clients accepting anything get the configured default"""
+        filename = upload_file(client, sample_image)
+        response = client.post('/process?inline=1',
+                               data=json.dumps(self._process_data(filename)),
+                               content_type='application/json',
+                               headers={'Accept': '*/*'})
+
+        assert response.mimetype == 'image/jpeg'
+
+    def test_unsupported_format(self, client, sample_image, upload_file):
+        """Formats Pillow cannot encode are rejected"""
+        filename = upload_file(client, sample_image)
+        response = client.post('/process',
+                               data=json.dumps(self._process_data(filename, format='gif')),
+                               content_type='application/json')
+
+        assert response.status_code == 400
+        assert 'jpeg' in response.get_json()['error']
+
+
+class TestMetricsEndpoint:
+    """Test the /metrics endpoint and Server-Timing header"""
+
+    def _process(self, client, filename, preset='fhd'):
+        """Helper to post a /process request"""
+        process_data = {
+            'filename': filename,
+            'preset': preset,
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            'letterbox': True
+        }
+        return client.post('/process',
+                           data=json.dumps(process_data),
+                           content_type='application/json')
+
+    def test_metrics_after_processing(self, client, sample_image, upload_file):
+        """Processing stages are exported with request labels"""
+        filename = upload_file(client, sample_image)
+        assert self._process(client, filename).status_code == 200
+
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        text = response.get_data(as_text=True)
+        labels = ('endpoint="process",preset="fhd",letterbox="true",input_format="jpeg",'
+                  'input_megapixels="0-2",encode_profile="balanced",output_format="jpeg"')
+        for name in ('decode', 'crop', 'resize', 'paste', 'encode'):
+            assert f'image_stage_seconds_count{{{labels},stage="{name}"}}' in text
+        assert f'image_processing_seconds_count{{{labels}}}' in text
+        assert f'image_decoded_bytes_count{{{labels}}}' in text
+        assert 'upload_stage_seconds_count{input_format="jpeg",input_megapixels="0-2",stage="probe"}' in text
+
+    def test_server_timing_header(self, client, sample_image, app, monkeypatch):
+        """Server-Timing is only sent when enabled"""
+        image_bytes = sample_image.getvalue()
+        data = {'file': (io.BytesIO(image_bytes), 'test.jpg', 'image/jpeg')}
+        response = client.post('/upload', data=data, content_type='multipart/form-data')
+        filename = response.get_json()['filename']
+        assert 'Server-Timing' not in response.headers
+        assert 'Server-Timing' not in self._process(client, filename, preset='fhd').headers
+
+        monkeypatch.setitem(app.config, 'SERVER_TIMING', True)
+        data = {'file': (io.BytesIO(image_bytes), 'test.jpg', 'image/jpeg')}
+        response = client.post('/upload', data=data, content_type='multipart/form-data')
+        assert 'probe;dur=' in response.headers['Server-Timing']
+        header = self._process(client, filename, preset='4k').headers['Server-Timing']
+        assert 'decode;dur=' in header
+        assert 'encode;dur=' in header
+        assert 'total;dur=' in header
+
+class TestProfiling:
+    """Test profile capture of slow or flagged processing requests"""
+
+    @pytest.fixture(autouse=True)
+    def profile_folder(self, app, monkeypatch, tmp_path):
+        monkeypatch.setitem(app.config, 'PROFILE_FOLDER', str(tmp_path))
+        monkeypatch.setattr(app_module, 'profile_ring', None)
+        return tmp_path
+
+    def _process(self, client, filename, preset='fhd', **headers):
+        """Helper to post a /process request"""
+        process_data = {
+            'filename': filename,
+            'preset': preset,
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+        }
+        return client.post('/process',
+                           data=json.dumps(process_data),
+                           content_type='application/json',
+                           headers=headers)
+
+    def test_off_by_default(self, client, sample_image, profile_folder, upload_file):
+        """The X-Profile header is ignored unless PROFILE_HEADER is on"""
+        filename = upload_file(client, sample_image)
+        response = self._process(client, filename, **{'X-Profile': '1'})
+
+        assert response.status_code == 200
+        assert 'X-Profile-Id' not in response.headers
+        assert list(profile_folder.iterdir()) == []
+
+    def test_requested_profile_saved(self, client, sample_image, app, monkeypatch, profile_folder,
+                                     upload_file):
+        """Flagged requests write a .pstats file and request metadata"""
+        monkeypatch.setitem(app.config, 'PROFILE_HEADER', True)
+        filename = upload_file(client, sample_image)
+        response = self._process(client, filename, **{'X-Profile': '1'})
+
+        assert response.status_code == 200
+        capture_id = response.headers['X-Profile-Id']
+        assert (profile_folder / f'{capture_id}.pstats').exists()
+        metadata = json.loads((profile_folder / f'{capture_id}.json').read_text())
+        assert metadata['endpoint'] == 'process'
+        assert metadata['status'] == 200
+        assert metadata['request']['preset'] == 'fhd'
+        assert metadata['images']['filename'] == {'format': 'JPEG', 'width': 800, 'height': 600, 'mode': 'RGB',
+                                                  'bytes': app_module.get_storage('uploads').size(filename)}
+
+    def test_sampled_requests_under_threshold_dropped(self, client, sample_image, app, monkeypatch,
+                                                      profile_folder, upload_file):
+        """Sampled requests are only kept when slower than the threshold"""
+        monkeypatch.setitem(app.config, 'PROFILE_SAMPLE_RATE', 1.0)
+        filename = upload_file(client, sample_image)
+
+        monkeypatch.setitem(app.config, 'PROFILE_THRESHOLD_SECONDS', 60)
+        assert 'X-Profile-Id' not in self._process(client, filename, preset='fhd').headers
+        assert list(profile_folder.iterdir()) == []
+
+        monkeypatch.setitem(app.config, 'PROFILE_THRESHOLD_SECONDS', 0)
+        assert 'X-Profile-Id' in self._process(client, filename, preset='4k').headers
+
+class TestPreview:
+    """Test the /preview endpoint"""
+
+    def test_upload_reports_preview(self, client, sample_image, app, monkeypatch):
+        """Uploads return the preview URL, size and scale factor"""
+        monkeypatch.setitem(app.config, 'PREVIEW_MAX_EDGE', 400)
+        data = {'file': (sample_image, 'test.jpg', 'image/jpeg')}
+        json_data = client.post('/upload', data=data, content_type='multipart/form-data').get_json()
+
+        assert json_data['preview_url'] == f"/preview/{json_data['filename']}?size=400x300"
+        assert (json_data['preview_width'], json_data['preview_height']) == (400, 300)
+        assert json_data['preview_scale'] == 2.0
+
+    def test_preview_generated_and_cached(self, client, sample_image, app, monkeypatch):
+        """Previews are downscaled, served with their scale and reused"""
+        monkeypatch.setitem(app.config, 'PREVIEW_MAX_EDGE', 400)
+        data = {'file': (sample_image, 'test.jpg', 'image/jpeg')}
+        filename = client.post('/upload', data=data, content_type='multipart/form-data').get_json()['filename']
+        expected_format = 'WEBP' if 'webp' in app_module.output_formats() else 'JPEG'
+
+        response = client.get(f'/preview/{filename}')
+        assert response.status_code == 200
+        assert response.headers['X-Preview-Scale'] == '2.0'
+        with Image.open(io.BytesIO(response.data)) as preview:
+            assert preview.format == expected_format
+            assert preview.size == (400, 300)
+
+        hits = client.get('/cache/stats').get_json()['hits']
+        again = client.get(f'/preview/{filename}')
+        assert again.data == response.data
+        assert client.get('/cache/stats').get_json()['hits'] == hits + 1
+
+    def test_preview_cached_by_browsers(self, client, sample_image, app, monkeypatch):
+        """Previews carry a content ETag and immutable max-age, and revalidate without rendering"""
+        monkeypatch.setitem(app.config, 'PREVIEW_MAX_EDGE', 400)
+        data = {'file': (sample_image, 'test.jpg', 'image/jpeg')}
+        preview_url = client.post('/upload', data=data, content_type='multipart/form-data').get_json()['preview_url']
+
+        response = client.get(preview_url)
+        etag = response.headers['ETag']
+        assert 'immutable' in response.headers['Cache-Control']
+        assert f"max-age={app.config['FILE_CACHE_MAX_AGE']}" in response.headers['Cache-Control']
+        # Served from the result cache, the preview keeps its ETag
+        assert client.get(preview_url).headers['ETag'] == etag
+
+        with monkeypatch.context() as patched:
+            patched.setattr(app_module, 'render_preview', None)
+            revalidated = client.get(preview_url, headers={'If-None-Match': etag})
+        assert revalidated.status_code == 304
+        assert revalidated.data == b''
+
+        # A different preview size is a different preview
+        monkeypatch.setitem(app.config, 'PREVIEW_MAX_EDGE', 200)
+        resized = client.get(preview_url, headers={'If-None-Match': etag})
+        assert resized.status_code == 200
+        assert resized.headers['ETag'] != etag
+
+    def test_preview_not_found(self, client):
+        """Unknown uploads have no preview"""
+        assert client.get('/preview/missing.jpg').status_code == 404
+
+class TestPresetRegistry:
+    """Test processing with presets loaded from PRESETS_FILE"""
+
+    def _use_presets(self, app, monkeypatch, tmp_path, specs):
+        """Helper to point PRESETS_FILE at a file with specs and reset the registry"""
+        path = tmp_path / 'presets.json'
+        path.write_text(json.dumps(specs))
+        monkeypatch.setitem(app.config, 'PRESETS_FILE', str(path))
+        monkeypatch.setattr(app_module, 'presets', None)
+        monkeypatch.setattr(app_module, 'presets_error', None)
+        monkeypatch.setattr(app_module, 'result_cache', None)
+
+    def test_custom_preset(self, client, sample_image, app, monkeypatch, tmp_path, upload_file):
+        """A preset from the file sets the output size and suggested name suffix"""
+        self._use_presets(app, monkeypatch, tmp_path, {
+            'panel': {'width': 540, 'height': 960, 'name': 'Portrait panel', 'suffix': '_portrait'}
+        })
+        filename = upload_file(client, sample_image)
+
+        process_data = {
+            'filename': filename,
+            'original_filename': 'photo.jpg',
+            'crop': {'x': 100, 'y': 0, 'width': 338, 'height': 600}
+        }
+        response = client.post('/process', data=json.dumps(process_data), content_type='application/json')
+        assert response.status_code == 200
+        result = response.get_json()
+        # The first preset is the default
+        assert result['suggested_filename'] == 'photo_portrait.jpg'
+
+        output = client.get(result['download_url'])
+        assert Image.open(io.BytesIO(output.data)).size == (540, 960)
+
+        process_data['preset'] = '4k'
+        response = client.post('/process', data=json.dumps(process_data), content_type='application/json')
+        assert response.status_code == 400
+
+        page = client.get('/app')
+        assert b'Portrait panel' in page.data
+        assert b'4K Ultra HD' not in page.data
+
+    def test_preset_encode_profile(self, client, sample_image, app, monkeypatch, tmp_path, upload_file):
+        """A preset's encode profile applies unless the request names one"""
+        self._use_presets(app, monkeypatch, tmp_path, {
+            'fhd': {'width': 1920, 'height': 1080, 'encode_profile': 'archival'}
+        })
+        filename = upload_file(client, sample_image)
+
+        process_data = {'filename': filename, 'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}}
+        response = client.post('/process', data=json.dumps(process_data), content_type='application/json')
+        output = Image.open(io.BytesIO(client.get(response.get_json()['download_url']).data))
+        assert output.info.get('progressive')
+
+        process_data['encode_profile'] = 'fast'
+        response = client.post('/process', data=json.dumps(process_data), content_type='application/json')
+        output = Image.open(io.BytesIO(client.get(response.get_json()['download_url']).data))
+        assert not output.info.get('progressive')
+
+    def test_batch_uses_each_presets_profile(self, client, sample_image, app, monkeypatch, tmp_path,
+                                             upload_file):
+        """Batch specs are encoded with their own preset's profile"""
+        self._use_presets(app, monkeypatch, tmp_path, {
+            'big': {'width': 1600, 'height': 900, 'encode_profile': 'archival'},
+            'small': {'width': 640, 'height': 360, 'encode_profile': 'fast'}
+        })
+        filename = upload_file(client, sample_image)
+        crop = {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+
+        response = client.post('/process-batch', data=json.dumps({
+            'filename': filename,
+            'original_filename': 'photo.jpg',
+            'specs': [{'preset': 'big', 'crop': crop}, {'preset': 'small', 'crop': crop}]
+        }), content_type='application/json')
+        assert response.status_code == 200
+        big, small = response.get_json()['results']
+        assert big['suggested_filename'] == 'photo_big.jpg'
+        assert small['suggested_filename'] == 'photo_small.jpg'
+        assert Image.open(io.BytesIO(client.get(big['download_url']).data)).info.get('progressive')
+        assert not Image.open(io.BytesIO(client.get(small['download_url']).data)).info.get('progressive')
+
+    def test_preset_filter(self, client, app, monkeypatch, tmp_path, upload_file):
+        """A preset's resampling filter applies unless the request names one"""
+        self._use_presets(app, monkeypatch, tmp_path, {
+            'small': {'width': 640, 'height': 360, 'filter': 'bilinear'}
+        })
+        noise = io.BytesIO()
+        Image.effect_noise((1600, 900), 60).convert('RGB').save(noise, format='PNG')
+        noise.seek(0)
+        filename = upload_file(client, noise)
+
+        def render(**params):
+            process_data = {'filename': filename, 'crop': {'x': 0, 'y': 0, 'width': 1600, 'height': 900},
+                            'encode_profile': 'archival', **params}
+            return client.post('/process?inline=1', data=json.dumps(process_data),
+                               content_type='application/json')
+
+        assert render().data == render(filter='bilinear').data
+        assert render().data != render(filter='lanczos').data
+        assert render(filter='nearest').status_code == 400
+
+    def test_invalid_presets_file(self, client, app, monkeypatch, tmp_path):
+        """An invalid presets file fails loudly instead of serving bad presets"""
+        self._use_presets(app, monkeypatch, tmp_path, {'8k': {'width': 7680}})
+        with pytest.raises(PresetError):
+            app_module.get_presets()
+
+        # The error is kept rather than re-reading the file on every request
+        (tmp_path / 'presets.json').write_text(json.dumps({'8k': {'width': 7680, 'height': 4320}}))
+        with pytest.raises(PresetError):
+            app_module.get_presets()
+        response = client.post('/process', data=json.dumps({'filename': 'x.jpg'}),
+                               content_type='application/json')
+        assert response.status_code == 500
+        assert response.get_json()['error'].startswith('Presets unavailable')
+
+
+class TestProcessingBudget:
+    """Test the pixel and memory budgets enforced before processing"""
+
+    def _process(self, client, filename):
+        """Helper to post a /process request"""
+        process_data = {
+            'filename': filename,
+            'preset': '4k',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            'letterbox': True
+        }
+        return client.post('/process',
+                           data=json.dumps(process_data),
+                           content_type='application/json')
+
+    def test_png_bomb_rejected_at_upload(self, client, app):
+        """A tiny PNG declaring billions of pixels never gets stored"""
+        def chunk(kind, payload):
+            return struct.pack('>I', len(payload)) + kind + payload + \
+                struct.pack('>I', zlib.crc32(kind + payload))
+
+        bomb = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 60000, 60000, 8, 0, 0, 0, 0)) + \
+            chunk(b'IDAT', zlib.compress(b'\x00' * 1024)) + chunk(b'IEND', b'')
+
+        data = {'file': (io.BytesIO(bomb), 'bomb.png', 'image/png')}
+        response = client.post('/upload', data=data, content_type='multipart/form-data')
+
+        assert response.status_code == 413
+        assert [f for _, _, files in os.walk(app.config['UPLOAD_FOLDER']) for f in files] == []
+
+    def test_memory_budget_returns_422(self, client, sample_image, app, monkeypatch, upload_file):
+        """Requests needing more bitmap memory than the budget are refused"""
+        filename = upload_file(client, sample_image)
+        monkeypatch.setitem(app.config, 'PROCESSING_MEMORY_BUDGET', 1024 * 1024)
+
+        response = self._process(client, filename)
+
+        assert response.status_code == 422
+        assert 'MB' in response.get_json()['error']
+        assert list(app_module.get_storage('processed').iter_files()) == []
+
+    def test_pixel_limit_rechecked_before_processing(self, client, sample_image, app, monkeypatch,
+                                                     upload_file):
+        """Stored images over a (since lowered) pixel limit are not processed"""
+        filename = upload_file(client, sample_image)
+        monkeypatch.setitem(app.config, 'MAX_IMAGE_PIXELS', 1000)
+
+        response = self._process(client, filename)
+
+        assert response.status_code == 422
+        assert 'pixels' in response.get_json()['error']
+
+    def test_diptych_and_batch_budgets(self, client, sample_image_portrait, sample_image_portrait_2,
+                                       app, monkeypatch, upload_file):
+        """The diptych and batch endpoints are guarded too"""
+        filename1 = upload_file(client, sample_image_portrait)
+        filename2 = upload_file(client, sample_image_portrait_2)
+        monkeypatch.setitem(app.config, 'PROCESSING_MEMORY_BUDGET', 1024 * 1024)
+
+        diptych = client.post('/process-diptych', data=json.dumps({
+            'filename1': filename1,
+            'filename2': filename2,
+            'crop1': {'x': 0, 'y': 0, 'width': 400, 'height': 900},
+            'crop2': {'x': 0, 'y': 0, 'width': 500, 'height': 800}
+        }), content_type='application/json')
+        batch = client.post('/process-batch', data=json.dumps({
+            'filename': filename1,
+            'specs': [{'crop': {'x': 0, 'y': 0, 'width': 400, 'height': 225}, 'preset': 'fhd'}]
+        }), content_type='application/json')
+
+        assert diptych.status_code == 422
+        assert batch.status_code == 422
+
+    def test_unreadable_stored_image_returns_400(self, client, app):
+        """A stored file whose header Pillow cannot read is a JSON 400, not a 500"""
+        header = b'RIFF' + (4000).to_bytes(4, 'little') + b'WEBPVP8X' + (10).to_bytes(4, 'little') \
+            + bytes(4) + (99).to_bytes(3, 'little') + (99).to_bytes(3, 'little')
+        app_module.get_storage('uploads').put_bytes('fake.webp', header + os.urandom(4000))
+
+        response = client.post('/process', data=json.dumps({
+            'filename': 'fake.webp',
+            'crop': {'x': 0, 'y': 0, 'width': 80, 'height': 45}
+        }), content_type='application/json')
+
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Invalid image file'
+
+    def test_busy_budget_returns_503(self, client, sample_image, app, monkeypatch, upload_file):
+        """Requests that cannot reserve their memory in time are asked to retry"""
+        filename = upload_file(client, sample_image)
+        reservations = MemoryReservations(64 * 1024 * 1024)
+        monkeypatch.setattr(app_module, 'memory_reservations', reservations)
+        monkeypatch.setitem(app.config, 'PROCESSING_MEMORY_WAIT', 0.1)
+        reservations.acquire(60 * 1024 * 1024)
+
+        response = self._process(client, filename)
+
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '5'
+        assert list(app_module.get_storage('processed').iter_files()) == []
+
+        reservations.release(60 * 1024 * 1024)
+        assert self._process(client, filename).status_code == 200
+        assert reservations.reserved == 0
+
+    def test_async_job_holds_reservation(self, client, sample_image, monkeypatch, upload_file):
+        """Background jobs keep their share of the budget until they finish"""
+        filename = upload_file(client, sample_image)
+        reservations = MemoryReservations(2 ** 30)
+        monkeypatch.setattr(app_module, 'memory_reservations', reservations)
+        monkeypatch.setattr(app_module, 'job_queue', JobQueue(executor='thread'))
+        release = threading.Event()
+        monkeypatch.setattr(app_module, 'crop_and_upscale', lambda *args, **kwargs: release.wait(5))
+
+        response = client.post('/process', data=json.dumps({
+            'filename': filename,
+            'preset': 'fhd',
+            'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450},
+            'async': True
+        }), content_type='application/json')
+
+        assert response.status_code == 202
+        assert reservations.reserved > 0
+        release.set()
+        for _ in range(100):
+            if reservations.reserved == 0:
+                break
+            time.sleep(0.05)
+        assert reservations.reserved == 0
+
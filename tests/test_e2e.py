@@ -3,6 +3,7 @@ import os
 import json
 from PIL import Image
 import glob
+from app import get_storage
 
 class TestEndToEndWorkflow:
     """End-to-end tests simulating complete user workflow"""
@@ -43,7 +44,7 @@ class TestEndToEndWorkflow:
         processed_filename = process_json['filename']
 
         # Step 3: Verify processed file
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], processed_filename)
+        processed_path = get_storage('processed').path(processed_filename)
         assert os.path.exists(processed_path)
 
         with Image.open(processed_path) as img:
@@ -87,7 +88,7 @@ class TestEndToEndWorkflow:
         assert process_json['success'] == True
 
         # Verify
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], process_json['filename'])
+        processed_path = get_storage('processed').path(process_json['filename'])
         with Image.open(processed_path) as img:
             assert img.size == (1920, 1080)
 
@@ -128,7 +129,7 @@ class TestEndToEndWorkflow:
 
         # Verify all processed files exist
         for processed_filename in results:
-            processed_path = os.path.join(app.config['PROCESSED_FOLDER'], processed_filename)
+            processed_path = get_storage('processed').path(processed_filename)
             assert os.path.exists(processed_path)
 
             with Image.open(processed_path) as img:
@@ -174,7 +175,7 @@ class TestDiptychEndToEnd:
         assert process_json['success'] == True
 
         # Step 4: Verify processed file
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], process_json['filename'])
+        processed_path = get_storage('processed').path(process_json['filename'])
         assert os.path.exists(processed_path)
         with Image.open(processed_path) as img:
             assert img.size == (3840, 2160)
@@ -266,8 +267,7 @@ class TestRealImageProcessing:
             assert process_json['success'] == True
 
             # Verify processed file
-            processed_path = os.path.join(app.config['PROCESSED_FOLDER'],
-                                         process_json['filename'])
+            processed_path = get_storage('processed').path(process_json['filename'])
             assert os.path.exists(processed_path)
 
             with Image.open(processed_path) as img:
@@ -332,8 +332,7 @@ class TestRealImageProcessing:
             assert process_json['success'] == True
 
             # Verify
-            processed_path = os.path.join(app.config['PROCESSED_FOLDER'],
-                                         process_json['filename'])
+            processed_path = get_storage('processed').path(process_json['filename'])
             with Image.open(processed_path) as img:
                 assert img.size == (1920, 1080)
 
@@ -405,7 +404,7 @@ class TestImageQuality:
                                       content_type='application/json')
 
         processed_filename = process_response.get_json()['filename']
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], processed_filename)
+        processed_path = get_storage('processed').path(processed_filename)
 
         # Verify JPEG format
         with Image.open(processed_path) as img:
@@ -430,7 +429,7 @@ class TestImageQuality:
                                       content_type='application/json')
 
         processed_filename = process_response.get_json()['filename']
-        processed_path = os.path.join(app.config['PROCESSED_FOLDER'], processed_filename)
+        processed_path = get_storage('processed').path(processed_filename)
 
         # Check file size (4K JPEG should be under 10MB for typical content)
         file_size = os.path.getsize(processed_path)
@@ -1,8 +1,25 @@
 import pytest
 import os
+import hashlib
+import io
 from PIL import Image
 import tempfile
-from app import allowed_file, crop_and_upscale, crop_and_combine_diptych, PRESETS
+import threading
+import time
+from PIL import ImageChops, JpegImagePlugin
+from app import allowed_file, crop_and_upscale, crop_and_combine_diptych, crop_and_upscale_batch, PRESETS, plan_jpeg_draft, load_crop
+from app import encode_settings, output_formats, save_output, preview_size, render_preview
+from decoding import open_region
+from jobs import JobQueue, QueueFull
+from result_cache import ResultCache, make_key
+from uploads import UploadStream, ImageTooLarge, probe_header
+from retention import FolderIndex
+from storage import LocalStorage, MemoryStorage
+from resampling import plan_stages, resize, resize_into
+from budget import MemoryBusy, MemoryReservations, OverBudget, bytes_per_pixel, estimate_decode
+from metrics import Histogram, megapixel_bucket, stage
+from presets import PresetError, build_preset, build_presets, load_presets
+from profiling import ProfileRing, start_profile
 
 class TestAllowedFile:
     """Test file validation"""
@@ -109,6 +126,20 @@ class TestCropAndUpscale:
             if os.path.exists(output_path):
                 os.unlink(output_path)
 
+    def test_palette_image_keeps_colours(self):
+        """Palette PNGs come out in their real colours, with and without letterboxing"""
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 600), (198, 30, 30)).quantize(16).save(buffer, 'PNG')
+        crop = {'x': 0, 'y': 0, 'width': 800, 'height': 450}
+
+        for letterbox in (False, True):
+            for output_format in ('jpeg', 'webp'):
+                output = crop_and_upscale(io.BytesIO(buffer.getvalue()), None, crop, 1920, 1080,
+                                          letterbox=letterbox, encode_options=encode_settings('fast', output_format))
+                with Image.open(output) as result:
+                    red, green, blue = result.convert('RGB').getpixel((960, 540))
+                assert red > 150 and green < 80 and blue < 80
+
     def test_crop_coordinates(self):
         """Test that crop coordinates are applied correctly"""
         # Create a test image with distinct quadrants
@@ -194,6 +225,190 @@ class TestCropAndUpscale:
                 os.unlink(output_path)
 
 
+class TestJpegDraftDecoding:
+    """Test reduced-size JPEG decoding for large crops"""
+
+    def test_plan_picks_largest_scale(self):
+        """Largest DCT scale that keeps the crop at or above target is chosen"""
+        assert plan_jpeg_draft((7680, 4320), (1920, 1080)) == 4
+        assert plan_jpeg_draft((16000, 9000), (1920, 1080)) == 8
+        assert plan_jpeg_draft((3840, 2160), (1920, 1080)) == 2
+
+    def test_plan_no_reduction_when_upscaling(self):
+        """Crops smaller than twice the target are decoded at full size"""
+        assert plan_jpeg_draft((3000, 2000), (1920, 1080)) == 1
+        assert plan_jpeg_draft((800, 450), (3840, 2160)) == 1
+
+    def test_plan_limited_by_either_axis(self):
+        """A narrow crop must not be reduced below target width"""
+        assert plan_jpeg_draft((4000, 9000), (1920, 1080)) == 2
+
+    def test_load_crop_decodes_jpeg_at_reduced_size(self):
+        """Large JPEG crops are decoded at reduced DCT scale"""
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as input_file:
+            input_path = input_file.name
+            Image.new('RGB', (4000, 3000), color='red').save(input_path)
+
+        try:
+            with Image.open(input_path) as img:
+                region, box = load_crop(img, (0, 0, 4000, 2250), (1920, 1080))
+                assert region.size == (2000, 1125)
+                assert box == (0, 0, 2000, 1125)
+        finally:
+            os.unlink(input_path)
+
+    def test_load_crop_png_untouched(self):
+        """Non-JPEG sources are cropped at full resolution"""
+        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as input_file:
+            input_path = input_file.name
+            Image.new('RGB', (4000, 3000), color='red').save(input_path)
+
+        try:
+            with Image.open(input_path) as img:
+                region, box = load_crop(img, (0, 0, 4000, 2250), (1920, 1080))
+                assert region.size == (4000, 2250)
+        finally:
+            os.unlink(input_path)
+
+    def test_draft_crop_keeps_correct_region(self):
+        """Crop coordinates are mapped into the reduced image correctly"""
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as input_file:
+            input_path = input_file.name
+            img = Image.new('RGB', (8000, 4500), color=(255, 0, 0))
+            # Right half green
+            img.paste((0, 255, 0), (4000, 0, 8000, 4500))
+            img.save(input_path, quality=95)
+
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as output_file:
+            output_path = output_file.name
+
+        try:
+            # Crop the green half only; it is large enough for a 2x reduction
+            crop_coords = {'x': 4000, 'y': 0, 'width': 4000, 'height': 2250}
+            crop_and_upscale(input_path, output_path, crop_coords, 1920, 1080)
+
+            with Image.open(output_path) as result:
+                assert result.size == (1920, 1080)
+                r, g, b = result.getpixel((2, 540))
+                assert g > 200 and r < 50, "Left edge should be green, not red"
+        finally:
+            for p in [input_path, output_path]:
+                if os.path.exists(p):
+                    os.unlink(p)
+
+
+class TestRegionDecoding:
+    """Test region-only decoding of crop boxes"""
+
+    def _save_gradient(self, suffix, **save_kwargs):
+        """Helper to save a 1200x1700 gradient image to a temporary file"""
+        f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+        img = Image.radial_gradient('L').resize((1200, 1700)).convert('RGB')
+        img.save(f.name, **save_kwargs)
+        f.close()
+        return f.name
+
+    def _assert_region_matches(self, path, box):
+        """Cropping through load_crop must match cropping the full decode"""
+        with Image.open(path) as full:
+            expected = full.convert('RGB').crop(box)
+        with Image.open(path) as img:
+            region, resample_box = load_crop(img, box, (box[2] - box[0], box[3] - box[1]))
+            actual = region.crop(tuple(int(v) for v in resample_box)).convert('RGB')
+        assert ImageChops.difference(actual, expected).getbbox() is None
+
+    def test_jpeg_restart_markers_decode_band_only(self):
+        """JPEGs with restart markers are reduced to the needed MCU rows"""
+        path = self._save_gradient('.jpg', restart_marker_rows=1)
+        try:
+            with Image.open(path) as img:
+                region, (dx, dy) = open_region(img, (100, 850, 700, 1050))
+                assert dx == 0 and dy <= 850
+                assert region.height < 300
+            self._assert_region_matches(path, (100, 850, 700, 1050))
+        finally:
+            os.unlink(path)
+
+    def test_jpeg_restart_region_mcu_aligned_edges(self):
+        """Crops on MCU-row boundaries keep the chroma upsampling context of a full decode"""
+        f = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
+        noise = Image.merge('RGB', [Image.effect_noise((640, 640), 80) for _ in range(3)])
+        noise.save(f.name, restart_marker_rows=1)
+        f.close()
+        try:
+            with Image.open(f.name) as img:
+                region, _ = open_region(img, (0, 160, 640, 320))
+                assert region.height < 640
+            self._assert_region_matches(f.name, (0, 160, 640, 320))
+            self._assert_region_matches(f.name, (32, 16, 600, 624))
+        finally:
+            os.unlink(f.name)
+
+    def test_jpeg_without_restart_markers_falls_back(self):
+        """JPEGs without restart markers are decoded in full"""
+        path = self._save_gradient('.jpg')
+        try:
+            with Image.open(path) as img:
+                region, offset = open_region(img, (100, 850, 700, 1050))
+                assert region.size == (1200, 1700)
+                assert offset == (0, 0)
+            self._assert_region_matches(path, (100, 850, 700, 1050))
+        finally:
+            os.unlink(path)
+
+    def test_jpeg_without_restart_markers_reads_header_only(self):
+        """The entropy-coded data is not read when there is no restart interval"""
+        class CountingBytesIO(io.BytesIO):
+            bytes_read = 0
+
+            def read(self, size=-1):
+                data = super().read(size)
+                self.bytes_read += len(data)
+                return data
+
+        path = self._save_gradient('.jpg')
+        try:
+            with open(path, 'rb') as f:
+                source = CountingBytesIO(f.read())
+            with Image.open(source) as img:
+                source.bytes_read = 0
+                open_region(img, (100, 850, 700, 1050))
+                assert source.bytes_read < 1024 < len(source.getvalue())
+        finally:
+            os.unlink(path)
+
+    def test_bmp_bottom_up_rows(self):
+        """Bottom-up BMP rows are read from the right file offset"""
+        path = self._save_gradient('.bmp')
+        try:
+            with Image.open(path) as img:
+                region, offset = open_region(img, (0, 400, 1200, 600))
+                assert region.size == (1200, 200)
+                assert offset == (0, 400)
+            self._assert_region_matches(path, (0, 400, 1200, 600))
+        finally:
+            os.unlink(path)
+
+    def test_png_stops_after_last_row(self):
+        """PNG decoding stops after the bottom of the crop"""
+        path = self._save_gradient('.png')
+        try:
+            with Image.open(path) as img:
+                region, offset = open_region(img, (0, 100, 600, 300))
+                assert region.size == (1200, 300)
+            self._assert_region_matches(path, (0, 100, 600, 300))
+        finally:
+            os.unlink(path)
+
+    def test_crop_outside_image_bounds(self):
+        """Crops extending past the image edge still pad with black"""
+        path = self._save_gradient('.bmp')
+        try:
+            self._assert_region_matches(path, (-20, 1500, 500, 1800))
+        finally:
+            os.unlink(path)
+
+
 class TestCropAndUpscaleLetterbox:
     """Test letterbox functionality in crop_and_upscale"""
 
@@ -341,6 +556,239 @@ class TestCropAndUpscaleLetterbox:
                 os.unlink(output_path)
 
 
+class TestResampling:
+    """Test the resampling planner"""
+
+    def test_plan_single_stage_for_reductions(self):
+        """Reductions and small enlargements are one stage"""
+        assert plan_stages((8000, 4500), (1920, 1080)) == [(1920, 1080)]
+        assert plan_stages((1920, 1080), (3840, 2160)) == [(3840, 2160)]
+
+    def test_plan_stages_large_enlargement(self):
+        """Large enlargements go up at most 2x per stage"""
+        assert plan_stages((640, 360), (3840, 2160)) == [(1280, 720), (2560, 1440), (3840, 2160)]
+
+    def test_progressive_matches_single_pass(self):
+        """Both methods produce the requested size and near-identical images"""
+        img = Image.linear_gradient('L').resize((4000, 2250))
+        for size, box in [((640, 360), None), ((1920, 1080), (100, 50, 3300, 1850))]:
+            single = resize(img, size, box=box, method='single')
+            progressive = resize(img, size, box=box, method='progressive')
+            assert progressive.size == size
+            assert max(ImageChops.difference(single, progressive).getdata()) <= 4
+
+        small = img.resize((320, 180))
+        assert resize(small, (3840, 2160), method='progressive').size == (3840, 2160)
+
+    def test_unknown_method(self):
+        """Unknown methods are rejected"""
+        with pytest.raises(ValueError):
+            resize(Image.new('RGB', (10, 10)), (20, 20), method='bogus')
+
+    def test_banded_resize_matches_single_pass(self):
+        """Bands resized into the frame join up like one full resize"""
+        img = Image.effect_noise((1000, 700), 60).convert('RGB')
+        for size, box in [((3840, 2160), (10.5, 3.25, 990, 690.7)), ((384, 216), None)]:
+            single = resize(img, size, box=box)
+            banded = resize_into(Image.new('RGB', size), (0, 0), img, size, box=box, band_rows=97)
+            assert max(max(channel) for channel in ImageChops.difference(single, banded).getextrema()) <= 1
+
+    def test_cheaper_filters(self):
+        """Both methods and banded resizes use the filter asked for"""
+        img = Image.effect_noise((1000, 700), 60).convert('RGB')
+        size = (1920, 1080)
+        lanczos = resize(img, size)
+        bilinear = img.resize(size, Image.Resampling.BILINEAR)
+        assert resize(img, size, resample_filter='bilinear').tobytes() == bilinear.tobytes()
+        assert resize(img, size, method='progressive', resample_filter='bilinear').tobytes() != lanczos.tobytes()
+        banded = resize_into(Image.new('RGB', size), (0, 0), img, size, band_rows=97, resample_filter='bilinear')
+        assert max(max(channel) for channel in ImageChops.difference(bilinear, banded).getextrema()) <= 1
+
+    def test_resize_into_offset(self):
+        """The resized region lands at the offset; the rest of the frame is untouched"""
+        img = Image.new('RGB', (100, 100), 'white')
+        for method in ('single', 'progressive'):
+            frame = resize_into(Image.new('RGB', (300, 200)), (50, 0), img, (200, 200), method=method, band_rows=64)
+            assert frame.getpixel((49, 100)) == (0, 0, 0)
+            assert frame.getpixel((50, 0)) == (255, 255, 255)
+            assert frame.getpixel((249, 199)) == (255, 255, 255)
+            assert frame.getpixel((250, 100)) == (0, 0, 0)
+
+
+class TestEncodeProfiles:
+    """Test the JPEG encode profiles"""
+
+    def test_profiles_control_jpeg_options(self):
+        """Progressive mode and chroma subsampling follow the profile"""
+        img = Image.linear_gradient('L').convert('RGB').resize((320, 180))
+        fast = Image.open(save_output(img, None, encode_settings('fast', 'jpeg')))
+        archival = Image.open(save_output(img, None, encode_settings('archival', 'jpeg')))
+
+        assert not fast.info.get('progressive')
+        assert JpegImagePlugin.get_sampling(fast) == 2  # 4:2:0
+        assert archival.info.get('progressive')
+        assert JpegImagePlugin.get_sampling(archival) == 0  # 4:4:4
+
+    def test_default_is_balanced(self):
+        """Without options, outputs are encoded with the balanced profile"""
+        img = Image.linear_gradient('L').convert('RGB').resize((320, 180))
+        default = save_output(img, None).getvalue()
+        balanced = save_output(img, None, encode_settings('balanced', 'jpeg')).getvalue()
+        assert default == balanced
+
+    def test_webp_and_avif_outputs(self):
+        """Each output format is encoded with its own settings"""
+        img = Image.linear_gradient('L').convert('RGB').resize((320, 180))
+        for output_format, pillow_format in (('webp', 'WEBP'), ('avif', 'AVIF')):
+            if output_format not in output_formats():
+                continue
+            with Image.open(save_output(img, None, encode_settings('fast', output_format))) as result:
+                assert result.format == pillow_format
+                assert result.size == (320, 180)
+
+
+class TestBudget:
+    """Test decoded-bitmap memory estimates and reservations"""
+
+    def test_bytes_per_pixel(self):
+        """Single-band modes take one byte, multi-band modes four"""
+        assert bytes_per_pixel('L') == 1
+        assert bytes_per_pixel('P') == 1
+        assert bytes_per_pixel('I;16') == 2
+        assert bytes_per_pixel('RGB') == 4
+        assert bytes_per_pixel('RGBA') == 4
+
+    def test_estimate_counts_decode_and_crop(self):
+        """The full frame at the draft scale plus the cropped copy"""
+        header = ('JPEG', (8000, 6000), 'RGB')
+        box = (0, 0, 4000, 2000)
+        assert estimate_decode(header, box) == (8000 * 6000 + 4000 * 2000) * 4
+        assert estimate_decode(header, box, draft_scale=2) == (4000 * 3000 + 2000 * 1000) * 4
+
+    def test_over_budget_message(self):
+        """The error states what was needed and the limit"""
+        error = OverBudget(3 * 2 ** 30, 2 * 2 ** 30)
+        assert '3,072 MB' in str(error)
+        assert '2,048 MB' in str(error)
+
+    def test_reservations_wait_for_room(self):
+        """A reservation waits until others release enough of the budget"""
+        reservations = MemoryReservations(100)
+        reservations.acquire(70)
+        releaser = threading.Timer(0.1, reservations.release, (70,))
+        releaser.start()
+
+        with reservations.reserve(50, timeout=5):
+            assert reservations.reserved == 50
+        releaser.join()
+        assert reservations.reserved == 0
+
+    def test_reservations_time_out(self):
+        """Waiting too long raises MemoryBusy; more than the whole budget raises OverBudget"""
+        reservations = MemoryReservations(100)
+        reservations.acquire(70)
+        with pytest.raises(MemoryBusy):
+            reservations.acquire(50, timeout=0)
+        with pytest.raises(OverBudget):
+            reservations.acquire(150)
+        assert reservations.reserved == 70
+
+
+class TestMetrics:
+    """Test stage timers and histogram rendering"""
+
+    def test_stage_accumulates(self):
+        """Repeated stages add up; None disables timing"""
+        timings = {}
+        with stage(timings, 'resize'):
+            time.sleep(0.01)
+        with stage(timings, 'resize'):
+            pass
+        with stage(None, 'resize'):
+            pass
+        assert list(timings) == ['resize']
+        assert timings['resize'] >= 0.01
+
+    def test_megapixel_bucket(self):
+        """Pixel counts map to coarse labels"""
+        assert megapixel_bucket(800 * 600) == '0-2'
+        assert megapixel_bucket(6000 * 4000) == '24-50'
+        assert megapixel_bucket(200_000_000) == '100+'
+
+    def test_histogram_render(self):
+        """Buckets are cumulative and labelled in the Prometheus format"""
+        histogram = Histogram('stage_seconds', 'Stage time', ('stage',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, stage='decode')
+        histogram.observe(0.5, stage='decode')
+        lines = histogram.render().splitlines()
+
+        assert '# TYPE stage_seconds histogram' in lines
+        assert 'stage_seconds_bucket{stage="decode",le="0.1"} 1' in lines
+        assert 'stage_seconds_bucket{stage="decode",le="1.0"} 2' in lines
+        assert 'stage_seconds_bucket{stage="decode",le="+Inf"} 2' in lines
+        assert 'stage_seconds_count{stage="decode"} 2' in lines
+
+    def test_processing_records_stages(self):
+        """crop_and_upscale and the diptych fill the timings dict"""
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_in:
+            Image.new('RGB', (800, 600), 'red').save(tmp_in.name)
+            input_path = tmp_in.name
+
+        try:
+            timings = {}
+            crop = {'x': 0, 'y': 0, 'width': 800, 'height': 600}
+            crop_and_upscale(input_path, None, crop, 1920, 1080, letterbox=True, timings=timings)
+            assert set(timings) == {'decode', 'crop', 'resize', 'paste', 'encode'}
+
+            timings = {}
+            crop_and_combine_diptych(input_path, input_path, None, crop, crop, 1920, 1080, timings=timings)
+            assert set(timings) == {'decode', 'crop', 'resize', 'paste', 'encode'}
+        finally:
+            os.unlink(input_path)
+
+class TestProfileRing:
+    """Test the bounded profile capture directory"""
+
+    def test_keeps_newest_captures(self):
+        """Captures beyond the limit are deleted oldest first, with their metadata"""
+        with tempfile.TemporaryDirectory() as folder:
+            ring = ProfileRing(folder, max_captures=2)
+            ids = []
+            for i in range(3):
+                profile = start_profile()
+                sum(range(1000))
+                profile.disable()
+                ids.append(ring.save(profile, {'run': i}, label='test'))
+
+            assert ring.captures() == ids[1:]
+            assert sorted(os.listdir(folder)) == sorted(f'{capture_id}{extension}' for capture_id in ids[1:]
+                                                        for extension in ('.pstats', '.json'))
+
+class TestPreviews:
+    """Test cropper preview generation"""
+
+    def test_preview_size(self):
+        """The longest edge is capped; small images keep their size"""
+        assert preview_size(6000, 4000, 2048) == (2048, 1365)
+        assert preview_size(3000, 6000, 2048) == (1024, 2048)
+        assert preview_size(800, 600, 2048) == (800, 600)
+
+    def test_render_preview(self):
+        """Previews are downscaled and encoded as requested"""
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_in:
+            Image.new('RGB', (3000, 2000), 'blue').save(tmp_in.name)
+            input_path = tmp_in.name
+
+        try:
+            timings = {}
+            output = render_preview(input_path, (1500, 1000), encode_settings('fast', 'jpeg'), timings)
+            with Image.open(output) as preview:
+                assert preview.format == 'JPEG'
+                assert preview.size == (1500, 1000)
+            assert set(timings) == {'decode', 'resize', 'encode'}
+        finally:
+            os.unlink(input_path)
+
 class TestPresets:
     """Test preset configurations"""
 
@@ -365,6 +813,56 @@ class TestPresets:
             aspect_ratio = preset['width'] / preset['height']
             assert abs(aspect_ratio - 16/9) < 0.01, f"{preset_key} should be 16:9"
 
+    def test_derived_values(self):
+        """Presets carry their aspect ratio, suffix and defaults"""
+        assert PRESETS['4k']['suffix'] == '_4k'
+        assert PRESETS['fhd']['aspect'] == 1920 / 1080
+        preset = build_preset('panel', {'width': 1080, 'height': 1920, 'suffix': '_portrait',
+                                        'encode_profile': 'fast', 'resampling': 'progressive',
+                                        'filter': 'bicubic'}, ('fast',))
+        assert preset['name'] == 'panel'
+        assert preset['suffix'] == '_portrait'
+        assert preset['aspect'] == 1080 / 1920
+        assert (preset['encode_profile'], preset['resampling'], preset['filter']) == ('fast', 'progressive', 'bicubic')
+
+    @pytest.mark.parametrize('key, spec', [
+        ('8k', {'width': 7680}),
+        ('8k', {'width': 7680, 'height': 0}),
+        ('8k', {'width': 7680.0, 'height': 4320}),
+        ('8k', {'width': 100000, 'height': 4320}),
+        ('8k', {'width': 7680, 'height': 4320, 'colour': 'red'}),
+        ('8k', {'width': 7680, 'height': 4320, 'suffix': '../x'}),
+        ('8k', {'width': 7680, 'height': 4320, 'encode_profile': 'lossless'}),
+        ('8k', {'width': 7680, 'height': 4320, 'resampling': 'nearest'}),
+        ('8k', {'width': 7680, 'height': 4320, 'filter': 'nearest'}),
+        ('8 k', {'width': 7680, 'height': 4320}),
+    ])
+    def test_invalid_presets_rejected(self, key, spec):
+        """Malformed preset definitions raise PresetError"""
+        with pytest.raises(PresetError):
+            build_preset(key, spec, ('fast', 'balanced'))
+
+    def test_load_presets_file(self, tmp_path):
+        """A presets file is loaded in order; bad files name the file in the error"""
+        path = tmp_path / 'presets.json'
+        path.write_text('{"8k": {"width": 7680, "height": 4320}, "1440p": {"width": 2560, "height": 1440}}')
+        assert list(load_presets(path)) == ['8k', '1440p']
+
+        path.write_text('{"8k": {"width": 7680}}')
+        with pytest.raises(PresetError, match='presets.json'):
+            load_presets(path)
+
+        path.write_text('{}')
+        with pytest.raises(PresetError):
+            load_presets(path)
+        with pytest.raises(PresetError):
+            build_presets([])
+
+    def test_example_file_is_valid(self):
+        """The shipped example presets file loads"""
+        path = os.path.join(os.path.dirname(__file__), '..', 'presets.example.json')
+        assert 'portrait-4k' in load_presets(path, ('fast', 'balanced', 'archival'))
+
 
 class TestCropAndCombineDiptych:
     """Test diptych (side-by-side) image combining"""
@@ -517,3 +1015,506 @@ class TestCropAndCombineDiptych:
             for p in [input1, input2, output]:
                 if os.path.exists(p):
                     os.unlink(p)
+
+    def test_diptych_parallel_matches_serial(self):
+        """Processing the panels on threads gives the same image as in turn"""
+        input1 = self._create_temp_image(300, 1000, 'red')
+        input2 = self._create_temp_image(600, 700, 'blue')
+
+        try:
+            crop1 = {'x': 0, 'y': 0, 'width': 300, 'height': 1000}
+            crop2 = {'x': 0, 'y': 0, 'width': 600, 'height': 700}
+            reports = []
+            parallel = crop_and_combine_diptych(input1, input2, None, crop1, crop2, 1920, 1080,
+                                                parallel=True, progress=reports.append)
+            serial = crop_and_combine_diptych(input1, input2, None, crop1, crop2, 1920, 1080, parallel=False)
+
+            assert parallel.getvalue() == serial.getvalue()
+            assert reports == [0.4, 0.8]
+        finally:
+            for p in [input1, input2]:
+                os.unlink(p)
+
+
+class TestCropAndUpscaleBatch:
+    """Test producing several outputs from one decode"""
+
+    def _gradient_image(self, width, height):
+        """Helper to save a PNG gradient so resampling differences show"""
+        f = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
+        img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        img.save(f.name)
+        f.close()
+        return f.name
+
+    def test_outputs_match_individual_processing(self):
+        """Each spec gets the size and content crop_and_upscale would produce"""
+        input_path = self._gradient_image(1600, 1200)
+        specs = [
+            {'crop': {'x': 100, 'y': 100, 'width': 1200, 'height': 675}, 'width': 3840, 'height': 2160},
+            {'crop': {'x': 0, 'y': 300, 'width': 800, 'height': 450}, 'width': 1920, 'height': 1080,
+             'letterbox': True},
+        ]
+
+        try:
+            outputs = crop_and_upscale_batch(input_path, [None, None], specs)
+
+            for spec, output in zip(specs, outputs):
+                expected = crop_and_upscale(input_path, None, spec['crop'], spec['width'], spec['height'],
+                                            letterbox=spec.get('letterbox', False))
+                with Image.open(output) as result, Image.open(expected) as reference:
+                    assert result.size == (spec['width'], spec['height'])
+                    diff = ImageChops.difference(result.convert('L'), reference.convert('L'))
+                    assert max(diff.getdata()) <= 8
+        finally:
+            os.unlink(input_path)
+
+    def test_smaller_output_derived_from_larger(self):
+        """FHD of the same crop is derived from the 4K pass, not the source"""
+        input_path = self._gradient_image(6000, 4000)
+        crop = {'x': 0, 'y': 0, 'width': 6000, 'height': 3375}
+        specs = [
+            {'crop': crop, 'width': 1920, 'height': 1080},
+            {'crop': crop, 'width': 3840, 'height': 2160},
+        ]
+
+        try:
+            calls = []
+            original_resize = Image.Image.resize
+
+            def recording_resize(img, size, *args, **kwargs):
+                calls.append((img.size, size))
+                return original_resize(img, size, *args, **kwargs)
+
+            with pytest.MonkeyPatch.context() as mp:
+                mp.setattr(Image.Image, 'resize', recording_resize)
+                fhd, uhd = crop_and_upscale_batch(input_path, [None, None], specs)
+
+            assert ((3840, 2160), (1920, 1080)) in calls
+            assert Image.open(fhd).size == (1920, 1080)
+            assert Image.open(uhd).size == (3840, 2160)
+        finally:
+            os.unlink(input_path)
+
+    def test_writes_output_paths(self):
+        """Outputs given as paths are written there"""
+        input_path = self._gradient_image(800, 600)
+        output_paths = [tempfile.NamedTemporaryFile(suffix='.jpg', delete=False).name for _ in range(2)]
+        specs = [
+            {'crop': {'x': 0, 'y': 0, 'width': 800, 'height': 450}, 'width': 1920, 'height': 1080},
+            {'crop': {'x': 0, 'y': 150, 'width': 800, 'height': 450}, 'width': 1920, 'height': 1080},
+        ]
+
+        try:
+            assert crop_and_upscale_batch(input_path, output_paths, specs) == output_paths
+            for path in output_paths:
+                with Image.open(path) as result:
+                    assert result.size == (1920, 1080)
+        finally:
+            for p in [input_path] + output_paths:
+                if os.path.exists(p):
+                    os.unlink(p)
+
+
+def _double(value, progress=None):
+    """Job function used by the job queue tests"""
+    progress(0.5)
+    return value * 2
+
+
+def _wait_for(event, progress=None):
+    """Job function that blocks until event is set"""
+    event.wait(5)
+
+
+def _timed(value, progress=None, timings=None):
+    """Job function that records a stage"""
+    timings['work'] = 0.5
+    return value
+
+
+def _explode(progress=None):
+    """Failing job function used by the job queue tests"""
+    raise ValueError('boom')
+
+
+def _die(progress=None):
+    """Job function that kills its worker process, as the OOM killer would"""
+    os._exit(1)
+
+
+class TestJobQueue:
+    """Test the background job queue"""
+
+    def _wait(self, queue, job_id, tries=200):
+        """Wait for a job to leave the queued/running states"""
+        for _ in range(tries):
+            status = queue.status(job_id)
+            if status['status'] in ('done', 'failed'):
+                return status
+            time.sleep(0.01)
+        raise AssertionError('Job did not finish')
+
+    def test_job_result_merged_on_success(self):
+        """Finished jobs report done with their result payload"""
+        queue = JobQueue(max_workers=1, executor='thread')
+        try:
+            job_id = queue.submit(_double, 21, result={'filename': 'out.jpg'})
+            status = self._wait(queue, job_id)
+            assert status['status'] == 'done'
+            assert status['filename'] == 'out.jpg'
+        finally:
+            queue.shutdown()
+
+    def test_failed_job_reports_error(self):
+        """Exceptions in a job are reported as failed with an error"""
+        queue = JobQueue(max_workers=1, executor='thread')
+        try:
+            job_id = queue.submit(_explode)
+            status = self._wait(queue, job_id)
+            assert status['status'] == 'failed'
+            assert 'boom' in status['error']
+        finally:
+            queue.shutdown()
+
+    def test_timed_job_reports_timings(self):
+        """Timed jobs hand their stage timings and wall time to on_success"""
+        queue = JobQueue(max_workers=1, executor='thread')
+        received = []
+        try:
+            job_id = queue.submit(_timed, 3, timed=True,
+                                  on_success=lambda value, timings: received.append((value, timings)))
+            assert self._wait(queue, job_id)['status'] == 'done'
+            value, timings = received[0]
+            assert value == 3
+            assert timings['work'] == 0.5
+            assert 'total' in timings
+        finally:
+            queue.shutdown()
+
+    def test_process_pool(self):
+        """Jobs run in worker processes by default"""
+        queue = JobQueue(max_workers=1)
+        try:
+            job_id = queue.submit(_double, 2)
+            assert self._wait(queue, job_id)['status'] == 'done'
+        finally:
+            queue.shutdown()
+
+    def test_failing_callback_fails_job(self):
+        """An exception in on_success marks the job failed and frees its slot"""
+        queue = JobQueue(max_workers=1, max_pending=1, executor='thread')
+
+        def on_success(value):
+            raise OSError('disk full')
+
+        try:
+            job_id = queue.submit(_double, 2, on_success=on_success)
+            status = self._wait(queue, job_id)
+            assert status['status'] == 'failed'
+            assert 'disk full' in status['error']
+            queue.submit(_double, 1)
+        finally:
+            queue.shutdown()
+
+    def test_status_shared_through_state_folder(self, tmp_path):
+        """Another queue on the same folder (another web process) sees the job"""
+        queue = JobQueue(max_workers=1, executor='thread', state_folder=str(tmp_path))
+        other = JobQueue(executor='thread', state_folder=str(tmp_path))
+        try:
+            job_id = queue.submit(_double, 2, result={'filename': 'out.jpg'})
+            self._wait(queue, job_id)
+            status = other.status(job_id)
+            assert status['status'] == 'done'
+            assert status['filename'] == 'out.jpg'
+
+            assert other.status('0' * 32) is None
+            assert other.status('../etc/passwd') is None
+        finally:
+            queue.shutdown()
+
+    def test_dead_worker_replaces_pool(self):
+        """A job whose worker dies fails, and later jobs run on a new pool"""
+        queue = JobQueue(max_workers=1)
+        try:
+            job_id = queue.submit(_die)
+            status = self._wait(queue, job_id, tries=1000)
+            assert status['status'] == 'failed'
+            assert 'stopped unexpectedly' in status['error']
+
+            job_id = queue.submit(_double, 2)
+            assert self._wait(queue, job_id, tries=1000)['status'] == 'done'
+        finally:
+            queue.shutdown()
+
+    def test_backpressure(self):
+        """submit() refuses work beyond max_pending until jobs finish"""
+        queue = JobQueue(max_workers=1, max_pending=1, executor='thread')
+        release = threading.Event()
+        try:
+            job_id = queue.submit(_wait_for, release)
+            with pytest.raises(QueueFull):
+                queue.submit(_double, 1)
+
+            release.set()
+            self._wait(queue, job_id)
+            queue.submit(_double, 1)
+        finally:
+            release.set()
+            queue.shutdown()
+
+
+class TestResultCache:
+    """Test the LRU result cache"""
+
+    def _write(self, folder, name, size):
+        """Helper to write a file of the given size"""
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(b'x' * size)
+
+    def test_key_is_order_independent(self):
+        """Keys depend on parameter values, not argument order"""
+        assert make_key(a=1, b=[1, 2]) == make_key(b=[1, 2], a=1)
+        assert make_key(a=1) != make_key(a=2)
+
+    def test_lru_eviction_deletes_files(self):
+        """Least recently used outputs are evicted over the byte budget"""
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ResultCache(LocalStorage(folder, shard_depth=0), max_bytes=250)
+            for name in ('a', 'b', 'c'):
+                self._write(folder, name, 100)
+
+            cache.put('ka', 'a')
+            cache.put('kb', 'b')
+            assert cache.get('ka') == 'a'  # a is now most recent
+            cache.put('kc', 'c')
+
+            assert cache.get('kb') is None
+            assert not os.path.exists(os.path.join(folder, 'b'))
+            assert cache.get('ka') == 'a'
+            assert cache.get('kc') == 'c'
+            assert cache.stats()['evictions'] == 1
+
+    def test_missing_file_is_a_miss(self):
+        """Entries whose file was deleted elsewhere are dropped"""
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ResultCache(LocalStorage(folder, shard_depth=0), max_bytes=1000)
+            self._write(folder, 'a', 10)
+            cache.put('ka', 'a')
+            os.unlink(os.path.join(folder, 'a'))
+
+            assert cache.get('ka') is None
+            assert cache.stats()['entries'] == 0
+
+
+class TestUploadStream:
+    """Test hashing and header probing of streamed uploads"""
+
+    def _encode(self, size, fmt, **save_kwargs):
+        """Helper to encode a blank image"""
+        buf = io.BytesIO()
+        Image.new('RGB', size).save(buf, format=fmt, **save_kwargs)
+        return buf.getvalue()
+
+    def test_probe_needs_only_header(self):
+        """Dimensions are available from the first bytes of the file"""
+        for fmt in ('JPEG', 'PNG', 'BMP', 'WEBP'):
+            data = self._encode((640, 360), fmt)
+            assert probe_header(data[:1024]) == (fmt, 640, 360)
+
+    def test_probe_truncated_header(self):
+        """A header cut short asks for more data"""
+        data = self._encode((640, 360), 'JPEG')
+        assert probe_header(data[:10]) is None
+
+    def test_stream_hashes_and_probes(self):
+        """Chunks are hashed and the size known before the upload finishes"""
+        data = self._encode((800, 600), 'JPEG', quality=95)
+        with tempfile.TemporaryDirectory() as folder:
+            storage = LocalStorage(folder)
+            stream = UploadStream(storage.temp_path('upload'))
+            stream.write(data[:4096])
+            assert (stream.width, stream.height) == (800, 600)
+            stream.write(data[4096:])
+
+            assert stream.digest == hashlib.sha256(data).hexdigest()
+            stream.commit(storage, 'stored.jpg')
+            stream.close()
+            assert [name for name, _, _ in storage.iter_files()] == ['stored.jpg']
+            assert not os.path.exists(stream.path)
+
+    def test_stream_rejects_early(self):
+        """Over-limit images are rejected on the first chunk and cleaned up"""
+        data = self._encode((2000, 2000), 'PNG')
+        with tempfile.TemporaryDirectory() as folder:
+            stream = UploadStream(os.path.join(folder, '.upload.part'), max_pixels=1_000_000)
+            with pytest.raises(ImageTooLarge):
+                stream.write(data[:1024])
+            assert os.listdir(folder) == []
+
+
+class TestFolderIndex:
+    """Test retention sweeps over the folder index"""
+
+    def _write(self, folder, name, size, age=0):
+        """Helper to write a file last accessed age seconds ago"""
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+
+    def test_ttl_expires_old_files(self):
+        """Files not accessed within the TTL are deleted"""
+        with tempfile.TemporaryDirectory() as folder:
+            self._write(folder, 'old.jpg', 10, age=600)
+            self._write(folder, 'new.jpg', 10)
+            index = FolderIndex(LocalStorage(folder, shard_depth=0), ttl=300, max_bytes=0)
+
+            assert index.sweep() == ['old.jpg']
+            assert os.listdir(folder) == ['new.jpg']
+
+    def test_budget_evicts_least_recently_used(self):
+        """Over budget, the least recently accessed files go first"""
+        with tempfile.TemporaryDirectory() as folder:
+            self._write(folder, 'a.jpg', 100, age=30)
+            self._write(folder, 'b.jpg', 100, age=20)
+            self._write(folder, 'c.jpg', 100, age=10)
+            index = FolderIndex(LocalStorage(folder, shard_depth=0), ttl=0, max_bytes=250)
+            index.touch('a.jpg')
+
+            assert index.sweep() == ['b.jpg']
+            assert sorted(os.listdir(folder)) == ['a.jpg', 'c.jpg']
+            assert index.total_bytes == 200
+
+    def test_pinned_files_survive(self):
+        """Files pinned by a running download are never deleted"""
+        with tempfile.TemporaryDirectory() as folder:
+            self._write(folder, 'sending.jpg', 10, age=600)
+            index = FolderIndex(LocalStorage(folder, shard_depth=0), ttl=300, max_bytes=0)
+
+            index.pin('sending.jpg')
+            assert index.sweep() == []
+            index.unpin('sending.jpg')
+            assert index.sweep() == ['sending.jpg']
+
+    def test_scan_removes_stale_temp_files(self):
+        """Leftover temporary uploads are cleaned up and not indexed"""
+        with tempfile.TemporaryDirectory() as folder:
+            self._write(folder, '.abc.part', 10, age=2 * 3600)
+            self._write(folder, '.def.part', 10)
+            index = FolderIndex(LocalStorage(folder, shard_depth=0), ttl=0, max_bytes=0)
+
+            assert len(index) == 0
+            assert os.listdir(folder) == ['.def.part']
+
+    def test_deleted_callback(self):
+        """on_delete is told about every deleted file"""
+        with tempfile.TemporaryDirectory() as folder:
+            self._write(folder, 'old.jpg', 10, age=600)
+            deleted = []
+            index = FolderIndex(LocalStorage(folder, shard_depth=0), ttl=300, max_bytes=0, on_delete=deleted.append)
+            index.sweep()
+            assert deleted == ['old.jpg']
+
+
+class TestLocalStorage:
+    """Test the sharded on-disk layout"""
+
+    def test_sharded_path(self):
+        """Files are placed in two levels of hash-prefix directories"""
+        with tempfile.TemporaryDirectory() as folder:
+            storage = LocalStorage(folder)
+            path = storage.path('abc.jpg', create=True)
+
+            relative = os.path.relpath(path, folder).split(os.sep)
+            assert len(relative) == 3
+            assert all(len(part) == 2 for part in relative[:2])
+            assert relative[2] == 'abc.jpg'
+            assert os.path.isdir(os.path.dirname(path))
+
+    def test_rejects_unsafe_names(self):
+        """Names that are not plain filenames never resolve"""
+        with tempfile.TemporaryDirectory() as folder:
+            storage = LocalStorage(folder)
+            for name in ('', '..', '../etc/passwd', '.hidden.part'):
+                assert not storage.exists(name)
+                with pytest.raises(ValueError):
+                    storage.path(name)
+
+    def test_migrate_flat_folder(self):
+        """Files from a flat folder are moved into shards once"""
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ('a.jpg', 'b.jpg', '.upload.part'):
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(b'data')
+
+            storage = LocalStorage(folder)
+            assert storage.migrate() == 2
+            assert storage.migrate() == 0
+
+            assert storage.exists('a.jpg') and storage.exists('b.jpg')
+            assert sorted(name for name, _, _ in storage.iter_files()) == ['a.jpg', 'b.jpg']
+            assert os.path.exists(os.path.join(folder, '.upload.part'))
+
+    def test_put_bytes_round_trip(self):
+        """Bytes written through the interface are readable and listed"""
+        with tempfile.TemporaryDirectory() as folder:
+            storage = LocalStorage(folder)
+            storage.put_bytes('out.jpg', b'encoded')
+
+            with storage.open('out.jpg') as f:
+                assert f.read() == b'encoded'
+            assert storage.size('out.jpg') == 7
+            assert [name for name, _, _ in storage.iter_files()] == ['out.jpg']
+
+
+class TestMemoryStorage:
+    """Test the in-memory storage backend"""
+
+    def test_round_trip(self):
+        """Stored bytes are served from memory with no local path"""
+        storage = MemoryStorage()
+        storage.put_bytes('a.jpg', b'abc')
+
+        assert storage.exists('a.jpg')
+        assert storage.size('a.jpg') == 3
+        assert storage.open('a.jpg').read() == b'abc'
+        assert storage.local_path('a.jpg') is None
+        assert storage.delete('a.jpg')
+        assert not storage.delete('a.jpg')
+        assert not storage.exists('a.jpg')
+
+    def test_evicts_least_recently_used(self):
+        """Reading a file protects it; the oldest unread file is evicted"""
+        evicted = []
+        storage = MemoryStorage(max_bytes=250, on_evict=evicted.append)
+        storage.put_bytes('a.jpg', b'x' * 100)
+        storage.put_bytes('b.jpg', b'x' * 100)
+        storage.open('a.jpg')
+        storage.put_bytes('c.jpg', b'x' * 100)
+
+        assert evicted == ['b.jpg']
+        assert sorted(name for name, _, _ in storage.iter_files()) == ['a.jpg', 'c.jpg']
+        assert storage.total_bytes == 200
+
+    def test_keeps_newest_over_budget(self):
+        """A file larger than the budget is still kept until the next write"""
+        storage = MemoryStorage(max_bytes=10)
+        storage.put_bytes('big.jpg', b'x' * 100)
+        assert storage.exists('big.jpg')
+
+    def test_upload_stream_buffers_in_memory(self):
+        """Uploads to a backend without temp paths never touch the disk"""
+        storage = MemoryStorage()
+        img_bytes = io.BytesIO()
+        Image.new('RGB', (50, 40)).save(img_bytes, format='PNG')
+
+        stream = UploadStream(storage.temp_path('upload'))
+        stream.write(img_bytes.getvalue())
+        stream.finish()
+        stream.commit(storage, 'stored.png')
+        stream.close()
+
+        assert (stream.width, stream.height) == (50, 40)
+        assert storage.open('stored.png').read() == img_bytes.getvalue()
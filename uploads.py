@@ -0,0 +1,188 @@
+"""
+Single-pass upload handling
+
+UploadStream is handed to werkzeug's multipart parser as the container for
+an uploaded file, so every chunk is written out, hashed and (until the
+image header has been seen) probed for dimensions as it arrives from the
+client. Nothing is read back afterwards, and uploads whose header declares
+too many pixels are rejected before the rest of the body is stored.
+"""
+import hashlib
+import io
+import os
+
+from PIL import Image, UnidentifiedImageError
+
+from metrics import stage
+
+# Stop probing for a header after this many bytes and fall back to opening
+# the finished file
+HEADER_PROBE_LIMIT = 512 * 1024
+
+# Formats whose headers Pillow can read from a partial file. Probing is
+# limited to these so a truncated file is never mistaken for another format;
+# anything else is identified by finish() once the upload is complete.
+PROBE_FORMATS = ('JPEG', 'PNG', 'BMP')
+
+
+class ImageTooLarge(Exception):
+    """Raised when an image's declared pixel count exceeds the configured limit"""
+
+    def __init__(self, width, height, max_pixels):
+        self.width = width
+        self.height = height
+        self.max_pixels = max_pixels
+        super().__init__(
+            f'Image is {width}x{height} ({width * height:,} pixels); '
+            f'the limit is {max_pixels:,} pixels'
+        )
+
+
+def probe_webp_size(data):
+    """Read the canvas size from a WebP header, or None if data is too short"""
+    if len(data) < 30 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        return None
+
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+        return (int.from_bytes(data[26:28], 'little') & 0x3FFF,
+                int.from_bytes(data[28:30], 'little') & 0x3FFF)
+    if chunk == b'VP8L' and data[20] == 0x2F:
+        bits = int.from_bytes(data[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        return (int.from_bytes(data[24:27], 'little') + 1,
+                int.from_bytes(data[27:30], 'little') + 1)
+    return None
+
+
+def probe_header(data):
+    """
+    Identify an image from its first bytes
+
+    Returns (format, width, height), or None if more data is needed.
+    Image.open only parses the header, so nothing is decoded here.
+    """
+    if data[:4] == b'RIFF':
+        size = probe_webp_size(data)
+        return ('WEBP',) + size if size else None
+
+    try:
+        with Image.open(io.BytesIO(data), formats=PROBE_FORMATS) as img:
+            return (img.format,) + img.size
+    except Image.DecompressionBombError:
+        raise
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError, EOFError):
+        return None
+
+
+class UploadStream:
+    """
+    Writable upload container that hashes and probes data as it is written
+
+    Args:
+        path: Temporary file to write to; it should be on the same
+              filesystem as the storage commit() moves it into. With None
+              the upload is buffered in memory (for storage backends
+              without local files).
+        max_pixels: Reject images declaring more pixels than this (None for
+                    no limit)
+
+    timings collects the time spent saving (hashing, writing, committing)
+    and probing the header, in seconds.
+    """
+
+    def __init__(self, path, max_pixels=None):
+        self.max_pixels = max_pixels
+        self.path = path
+        self.size = 0
+        self.format = None
+        self.width = None
+        self.height = None
+        self.committed = False
+        self.timings = {'save': 0.0, 'probe': 0.0}
+        self._file = open(self.path, 'w+b') if path else io.BytesIO()
+        self._hash = hashlib.sha256()
+        self._head = bytearray()
+
+    def write(self, data):
+        if self.width is None and len(self._head) < HEADER_PROBE_LIMIT:
+            self._head += data
+            try:
+                with stage(self.timings, 'probe'):
+                    self._probe(probe_header(bytes(self._head)))
+            except (ImageTooLarge, Image.DecompressionBombError):
+                self.close()
+                raise
+
+        with stage(self.timings, 'save'):
+            self._hash.update(data)
+            self.size += len(data)
+            return self._file.write(data)
+
+    def _probe(self, header):
+        """Record a probed header and enforce the pixel limit"""
+        if header is None:
+            return
+        self.format, self.width, self.height = header
+        self._head = bytearray()
+        if self.max_pixels and self.width * self.height > self.max_pixels:
+            raise ImageTooLarge(self.width, self.height, self.max_pixels)
+
+    @property
+    def digest(self):
+        """SHA-256 of everything written so far"""
+        return self._hash.hexdigest()
+
+    def finish(self):
+        """
+        Make sure the image has been identified once all data is written
+
+        Falls back to opening the stored file when the header could not be
+        probed while streaming. Headers parsed by hand (WebP) are checked by
+        opening the file with Pillow too, so a valid-looking header on a
+        non-image is not accepted. Raises UnidentifiedImageError for
+        non-images and ImageTooLarge for images over the pixel limit.
+        """
+        if self.width is None:
+            with stage(self.timings, 'probe'):
+                self._probe(self._open_header())
+        elif self.format not in PROBE_FORMATS:
+            with stage(self.timings, 'probe'):
+                if self._open_header() != (self.format, self.width, self.height):
+                    raise UnidentifiedImageError('Image header does not match its contents')
+
+    def _open_header(self):
+        """(format, width, height) of the written file as opened by Pillow"""
+        self._file.flush()
+        self._file.seek(0)
+        try:
+            with Image.open(self.path or self._file) as img:
+                return (img.format,) + img.size
+        except UnidentifiedImageError:
+            raise
+        except (OSError, SyntaxError, ValueError, EOFError) as e:
+            # e.g. a WebP header Pillow's decoder cannot start on
+            raise UnidentifiedImageError(f'Cannot open image: {e}') from e
+
+    def commit(self, storage, name):
+        """Close the temporary file and move it into storage under name"""
+        with stage(self.timings, 'save'):
+            if self.path:
+                self._file.close()
+                storage.put_file(name, self.path)
+            else:
+                storage.put_bytes(name, self._file.getvalue())
+                self._file.close()
+        self.committed = True
+
+    def close(self):
+        """Close and, unless committed, delete the temporary file"""
+        if not self._file.closed:
+            self._file.close()
+        if self.path and not self.committed and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __getattr__(self, name):
+        # read/seek/readline etc. go to the underlying file
+        return getattr(self._file, name)